@@ -0,0 +1,216 @@
+"""
+Dependency graph of the per-pair pipeline stages.
+
+Each stage's output depends on
+- the parameter keys in STAGE_PARAMETER_KEYS (dotted paths into
+  config.parameters, as narrow as the stage's code allows),
+- its raw input files (quality and combine: path, size and mtime of every file),
+- the outputs of its upstream stages (pair_stages.STAGE_REQUIRES).
+
+A stage's signature hashes its own dependencies and the signatures of its
+upstream stages, so a change anywhere upstream changes every signature below
+it. The scheduler stores the signature and the resolved dependencies with
+each completed checkpoint; plan_pair compares them with the current
+configuration and returns the stages that must rerun, each with the reason
+(e.g., the changed parameter keys), which is also what a dry run reports.
+"""
+
+import os
+import json
+import hashlib
+
+from analysis.tasks.pair_stages import PAIR_STAGES, STAGE_REQUIRES
+from utils.cache import canonical_json, resolve_parameters, file_identity
+
+# Parameter keys each stage reads directly; upstream parameters enter through upstream signatures
+STAGE_PARAMETER_KEYS = {
+    'quality': ['FNIRS_PREPROCESSING.sci', 'EEG_PREPROCESSING.bad_channels_criteria'],
+    'combine': ['COMBINE_PARAMS', 'RECORDING_CLOCKS'],
+    'annotations': ['ANNOTATION_STANDARD'],
+    'preprocess': ['EEG_PREPROCESSING.filter', 'FNIRS_PREPROCESSING.filter', 'FNIRS_PREPROCESSING.apply_tddr',
+                   'FNIRS_PREPROCESSING.remove_mayer', 'FNIRS_PREPROCESSING.sfreq'],
+    'time_delay': ['EEG_PREPROCESSING.bands', 'NVC_ANALYSIS.time_delay', 'STUDY_PIPELINE.analysis_sfreq'],
+    'pac': ['NVC_ANALYSIS.pac'],
+    'glm': ['EEG_PREPROCESSING.bands', 'NVC_ANALYSIS.glm', 'STUDY_PIPELINE.analysis_sfreq'],
+}
+
+# Pair dictionary keys of the raw files a stage reads
+STAGE_INPUTS = {
+    'quality': ('eeg_path', 'fnirs_path'),
+    'combine': ('eeg_path', 'fnirs_path'),
+}
+
+DONE = 'done'
+
+
+def downstream(stages):
+    """Return the given stages and every stage depending on them, in pipeline order."""
+    selected = set(stages)
+    for stage in PAIR_STAGES:
+        if any(required in selected for required in STAGE_REQUIRES[stage]):
+            selected.add(stage)
+    return [stage for stage in PAIR_STAGES if stage in selected]
+
+
+def upstream(stages):
+    """Return the given stages and every stage they depend on, in pipeline order."""
+    selected = set(stages)
+    for stage in reversed(PAIR_STAGES):
+        if stage in selected:
+            selected.update(STAGE_REQUIRES[stage])
+    return [stage for stage in PAIR_STAGES if stage in selected]
+
+
+def parameter_dependents(key):
+    """
+    Stages whose output changes when a parameter changes.
+
+    Parameters
+    ----------
+    key : str
+        Dotted parameter path, e.g. 'NVC_ANALYSIS.time_delay.max_lag_seconds'
+
+    Returns
+    -------
+    list of str
+        Stages reading the key directly and all their downstream stages
+    """
+    direct = [stage for stage, paths in STAGE_PARAMETER_KEYS.items()
+              if any(key == path or key.startswith(path + '.') or path.startswith(key + '.') for path in paths)]
+    return downstream(direct)
+
+
+def stage_dependencies(stage, pair, overrides=None):
+    """
+    Resolved direct dependencies of one stage of one pair.
+
+    Parameters
+    ----------
+    stage : str
+        Stage name
+    pair : dict
+        Pair dictionary
+    overrides : dict, optional
+        Dotted path -> value replacing configured parameters
+
+    Returns
+    -------
+    dict
+        {'params': {dotted path: value}, 'inputs': [file identities]}
+    """
+    inputs = []
+    for field in STAGE_INPUTS.get(stage, ()):
+        try:
+            inputs.append(file_identity(pair[field]))
+        except OSError:
+            inputs.append([pair[field], None])
+    return {'params': resolve_parameters(STAGE_PARAMETER_KEYS[stage], overrides), 'inputs': inputs}
+
+
+def stage_signatures(pair, overrides=None):
+    """
+    Signatures of all stages of one pair.
+
+    Returns
+    -------
+    dict
+        {stage: (signature, canonical JSON of the direct dependencies)}
+    """
+    signatures = {}
+    for stage in PAIR_STAGES:
+        dependencies = canonical_json(stage_dependencies(stage, pair, overrides))
+        material = canonical_json({
+            'stage': stage,
+            'dependencies': dependencies,
+            'upstream': [signatures[required][0] for required in STAGE_REQUIRES[stage]]
+        })
+        signatures[stage] = (hashlib.sha256(material.encode()).hexdigest(), dependencies)
+    return signatures
+
+
+def _leaf_values(value, prefix):
+    """Flatten nested dicts to {dotted leaf path: value}."""
+    if isinstance(value, dict):
+        leaves = {}
+        for key, item in value.items():
+            leaves.update(_leaf_values(item, f"{prefix}.{key}"))
+        return leaves
+    return {prefix: value}
+
+
+def changed_parameters(stored, current):
+    """
+    Leaf parameter keys differing between two stage_dependencies records.
+
+    Parameters
+    ----------
+    stored, current : dict
+        stage_dependencies outputs (or their JSON round-trip)
+
+    Returns
+    -------
+    list of str
+        Sorted dotted paths of changed, added or removed leaf values
+    """
+    old, new = {}, {}
+    for path, value in stored.get('params', {}).items():
+        old.update(_leaf_values(value, path))
+    for path, value in current.get('params', {}).items():
+        new.update(_leaf_values(value, path))
+    return sorted(key for key in set(old) | set(new)
+                  if canonical_json(old.get(key)) != canonical_json(new.get(key)))
+
+
+def plan_pair(ctx, records, targets=None, overrides=None, signatures=None):
+    """
+    Stages of one pair that must (re)run, with reasons.
+
+    Parameters
+    ----------
+    ctx : PairContext
+        Paths of the pair's outputs
+    records : dict
+        {stage: {'status', 'signature', 'dependencies'}} from the checkpoint store
+    targets : list of str, optional
+        Stages wanted up to date. Their stale upstream stages are included.
+        Defaults to all stages.
+    overrides : dict, optional
+        Dotted path -> value replacing configured parameters
+    signatures : dict, optional
+        stage_signatures output, if already computed
+
+    Returns
+    -------
+    dict
+        {stage: reason} in pipeline order; empty if everything is up to date
+    """
+    signatures = signatures or stage_signatures(ctx.pair, overrides)
+    wanted = upstream(targets or PAIR_STAGES)
+    plan = {}
+    for stage in wanted:
+        record = records.get(stage) or {}
+        signature, dependencies = signatures[stage]
+        stale_upstream = [required for required in STAGE_REQUIRES[stage] if required in plan]
+        if not record or record.get('status') != DONE:
+            reason = record.get('status') or 'not run'
+        elif not all(os.path.exists(path) for path in ctx.outputs(stage)):
+            reason = 'outputs missing'
+        elif stale_upstream:
+            reason = f"upstream {', '.join(stale_upstream)} reruns"
+        elif record.get('signature') != signature:
+            if record.get('dependencies') is None:
+                reason = 'no dependency record'
+            else:
+                stored = json.loads(record['dependencies'])
+                current = json.loads(dependencies)
+                changed = changed_parameters(stored, current)
+                if changed:
+                    reason = f"parameters changed: {', '.join(changed)}"
+                elif stored.get('inputs') != current.get('inputs'):
+                    reason = 'inputs changed'
+                else:
+                    reason = 'upstream changed'
+        else:
+            continue
+        plan[stage] = reason
+    return plan
@@ -0,0 +1,420 @@
+"""
+Resumable, parallel study pipeline over the pair database.
+
+Every pair runs through STUDY_PIPELINE['stages'] (see
+analysis.tasks.pair_stages) in a worker process. Completion is checkpointed
+per pair and stage in an SQLite file next to the outputs, written by the
+workers as each stage finishes, so a run that crashed or was stopped resumes
+with the first unfinished stage of every pair.
+
+Each checkpoint also stores the stage's dependency signature
+(analysis.dependencies). A run only recomputes stages that are unfinished,
+whose outputs are missing, or whose parameters, raw inputs or upstream
+results changed since they completed; dry_run() reports these stages and the
+reasons without running anything.
+
+Failures are isolated: an exception fails only the stage it occurred in and
+blocks the later stages of that pair; all other pairs, of the same and of
+other subjects, continue. A worker process that dies (e.g., killed for
+exceeding memory) breaks the whole pool, and the futures of every pair in
+flight fail alike, so the dead worker's pair cannot be told apart from the
+others. The pool is restarted and each of these pairs is rerun alone; only
+a pair that breaks the pool while running alone is failed. Failed stages are
+retried on the next run.
+
+Pairs are admitted to the pool while the estimated memory of all running
+pairs (STUDY_PIPELINE['memory_per_input_byte'] times the size of their raw
+input files) fits in the memory budget; a pair larger than the budget runs
+alone.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from config.parameters import STUDY_PIPELINE
+from analysis.tasks.pair_stages import PAIR_STAGES, STAGE_REQUIRES, STAGE_FUNCTIONS, PairContext, release_caches
+from analysis.dependencies import plan_pair, stage_signatures
+from utils.instrumentation import stage as instrumented_stage
+
+CHECKPOINT_FILE = "pipeline_checkpoints.sqlite"
+
+CHECKPOINT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    pair_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    subject TEXT,
+    status TEXT NOT NULL,
+    started REAL,
+    finished REAL,
+    pid INTEGER,
+    error TEXT,
+    signature TEXT,
+    dependencies TEXT,
+    PRIMARY KEY (pair_id, stage)
+);
+CREATE INDEX IF NOT EXISTS idx_checkpoints_status ON checkpoints (status);
+"""
+
+DONE = 'done'
+RUNNING = 'running'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+
+
+class CheckpointStore:
+    """
+    Per-pair, per-stage completion records shared by the scheduler and its workers.
+
+    Parameters
+    ----------
+    checkpoint_file : str
+        Path to the SQLite file
+    timeout : float, optional
+        Seconds to wait for a lock held by another process
+    """
+
+    def __init__(self, checkpoint_file, timeout=60.0):
+        self.checkpoint_file = checkpoint_file
+        os.makedirs(os.path.dirname(os.path.abspath(checkpoint_file)), exist_ok=True)
+        self.conn = sqlite3.connect(checkpoint_file, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(CHECKPOINT_SCHEMA)
+        # Checkpoint files written before dependency tracking lack the signature columns
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(checkpoints)")}
+        for column in ('signature', 'dependencies'):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE checkpoints ADD COLUMN {column} TEXT")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the database connection."""
+        self.conn.close()
+
+    def set(self, pair_id, stage, status, subject=None, error=None, signature=None, dependencies=None):
+        """Record the status of one stage of one pair (with its dependency signature once done)."""
+        now = time.time()
+        started = now if status == RUNNING else None
+        self.conn.execute(
+            "INSERT INTO checkpoints (pair_id, stage, subject, status, started, finished, pid, error, "
+            "signature, dependencies) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (pair_id, stage) DO UPDATE SET status = excluded.status, subject = excluded.subject, "
+            "started = COALESCE(excluded.started, started), finished = excluded.finished, "
+            "pid = excluded.pid, error = excluded.error, signature = excluded.signature, "
+            "dependencies = excluded.dependencies",
+            (pair_id, stage, subject, status, started, None if status == RUNNING else now, os.getpid(), error,
+             signature, dependencies)
+        )
+
+    def statuses(self, pair_id):
+        """Return {stage: status} of one pair."""
+        rows = self.conn.execute("SELECT stage, status FROM checkpoints WHERE pair_id = ?", (pair_id,))
+        return dict(rows.fetchall())
+
+    def records(self, pair_id):
+        """Return {stage: {'status', 'signature', 'dependencies'}} of one pair."""
+        rows = self.conn.execute("SELECT stage, status, signature, dependencies FROM checkpoints "
+                                 "WHERE pair_id = ?", (pair_id,))
+        return {stage: {'status': status, 'signature': signature, 'dependencies': dependencies}
+                for stage, status, signature, dependencies in rows}
+
+    def fail_running(self, pair_id, error):
+        """Mark the running stages of a pair as failed (after its worker died)."""
+        self.conn.execute("UPDATE checkpoints SET status = ?, error = ?, finished = ? "
+                          "WHERE pair_id = ? AND status = ?", (FAILED, error, time.time(), pair_id, RUNNING))
+
+    def failures(self):
+        """Return [(subject, pair_id, stage, error), ...] of all failed stages."""
+        rows = self.conn.execute("SELECT subject, pair_id, stage, error FROM checkpoints WHERE status = ? "
+                                 "ORDER BY subject, pair_id", (FAILED,))
+        return rows.fetchall()
+
+    def summary(self):
+        """Return {stage: {status: count}}."""
+        summary = {}
+        for stage, status, count in self.conn.execute(
+                "SELECT stage, status, COUNT(*) FROM checkpoints GROUP BY stage, status"):
+            summary.setdefault(stage, {})[status] = count
+        return summary
+
+    def reset(self, stages=None, pair_ids=None):
+        """Forget the records of some stages and/or pairs (all if both are None), forcing them to rerun."""
+        query, params = "DELETE FROM checkpoints WHERE 1 = 1", []
+        if stages is not None:
+            query += f" AND stage IN ({', '.join('?' * len(stages))})"
+            params.extend(stages)
+        if pair_ids is not None:
+            query += f" AND pair_id IN ({', '.join('?' * len(pair_ids))})"
+            params.extend(pair_ids)
+        self.conn.execute(query, params)
+
+
+def run_pair(pair_id, pair, stages, output_dir, checkpoint_file):
+    """
+    Run the stale stages of one pair needed for the target stages, checkpointing each (worker task).
+
+    Returns
+    -------
+    dict
+        {'pair_id', 'subject', 'ran': [stages], 'failed': stage or None, 'blocked': [stages]}
+    """
+    ctx = PairContext(pair_id, pair, output_dir)
+    report = {'pair_id': pair_id, 'subject': ctx.subject, 'ran': [], 'failed': None, 'blocked': []}
+    with CheckpointStore(checkpoint_file) as store:
+        signatures = stage_signatures(pair)
+        plan = plan_pair(ctx, store.records(pair_id), stages, signatures=signatures)
+        unavailable = set()
+        for stage in plan:
+            missing = [required for required in STAGE_REQUIRES[stage] if required in unavailable]
+            if missing:
+                store.set(pair_id, stage, BLOCKED, ctx.subject, f"requires {', '.join(missing)}")
+                report['blocked'].append(stage)
+                unavailable.add(stage)
+                continue
+            store.set(pair_id, stage, RUNNING, ctx.subject)
+            try:
+                with instrumented_stage(stage, subject=ctx.subject, pair_id=pair_id):
+                    STAGE_FUNCTIONS[stage](ctx)
+            except Exception:
+                store.set(pair_id, stage, FAILED, ctx.subject, traceback.format_exc(limit=5))
+                report['failed'] = stage
+                unavailable.add(stage)
+                continue
+            store.set(pair_id, stage, DONE, ctx.subject, signature=signatures[stage][0],
+                      dependencies=signatures[stage][1])
+            report['ran'].append(stage)
+    release_caches(ctx)
+    return report
+
+
+def estimate_memory(pair):
+    """Estimated peak memory in bytes of one pair's pipeline, from the size of its raw inputs."""
+    size = 0
+    for path in (pair['eeg_path'], pair['fnirs_path']):
+        folder = path if os.path.isdir(path) else None
+        try:
+            if folder:
+                size += sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+            else:
+                size += os.path.getsize(path)
+        except OSError:
+            continue
+    return size * STUDY_PIPELINE['memory_per_input_byte']
+
+
+class StudyScheduler:
+    """
+    Run the per-pair pipeline for every pair of the pair database.
+
+    Parameters
+    ----------
+    db_file : str, optional
+        Pair database. If None, uses the default database.
+    output_dir : str, optional
+        Root directory of combined recordings and results. If None, uses the
+        default combined data directory.
+    stages : list of str, optional
+        Stages to bring up to date; stale upstream stages they need are
+        included. Defaults to STUDY_PIPELINE['stages'].
+    n_workers : int, optional
+        Worker processes. Defaults to STUDY_PIPELINE['n_workers'].
+    memory_budget_gb : float, optional
+        Budget for the estimated memory of running pairs. Defaults to STUDY_PIPELINE.
+    checkpoint_file : str, optional
+        Checkpoint database. Defaults to <output_dir>/pipeline_checkpoints.sqlite.
+    """
+
+    def __init__(self, db_file=None, output_dir=None, stages=None, n_workers=None, memory_budget_gb=None,
+                 checkpoint_file=None):
+        from config.data_paths_and_config import INTERNAL_DATA_PATHS
+
+        self.db_file = db_file
+        self.output_dir = output_dir or INTERNAL_DATA_PATHS['motor_data_combined_sorted_annotations']
+        self.stages = [stage for stage in PAIR_STAGES if stage in (stages or STUDY_PIPELINE['stages'])]
+        unknown = set(stages or []) - set(PAIR_STAGES)
+        if unknown:
+            raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}. Available: {', '.join(PAIR_STAGES)}")
+        self.n_workers = n_workers or STUDY_PIPELINE['n_workers']
+        self.memory_budget = (memory_budget_gb or STUDY_PIPELINE['memory_budget_gb']) * 1024 ** 3
+        self.checkpoint_file = checkpoint_file or os.path.join(self.output_dir, CHECKPOINT_FILE)
+
+    def pairs(self, subjects=None):
+        """Return [(pair_id, pair), ...] of the pair database, optionally for some subjects only."""
+        from io_mgmt.pairs_db import open_pair_database
+
+        with open_pair_database(self.db_file) as db:
+            rows = db.conn.execute("SELECT id, eeg_path, fnirs_path, subject, metadata FROM pairs ORDER BY id")
+            return [(pair_id, {'eeg_path': eeg_path, 'fnirs_path': fnirs_path, 'metadata': json.loads(metadata)})
+                    for pair_id, eeg_path, fnirs_path, subject, metadata in rows
+                    if subjects is None or subject in subjects]
+
+    def plans(self, subjects=None):
+        """Return [(pair_id, pair, {stage: reason}), ...] of the pairs with stages to (re)run."""
+        plans = []
+        with CheckpointStore(self.checkpoint_file) as store:
+            for pair_id, pair in self.pairs(subjects):
+                ctx = PairContext(pair_id, pair, self.output_dir)
+                plan = plan_pair(ctx, store.records(pair_id), self.stages)
+                if plan:
+                    plans.append((pair_id, pair, plan))
+        return plans
+
+    def pending(self, subjects=None):
+        """Return [(pair_id, pair), ...] of the pairs with stages to (re)run."""
+        return [(pair_id, pair) for pair_id, pair, _ in self.plans(subjects)]
+
+    def dry_run(self, subjects=None):
+        """
+        Report what a run would recompute, without running anything.
+
+        Parameters
+        ----------
+        subjects : list of str, optional
+            Only consider these subjects
+
+        Returns
+        -------
+        dict
+            {pair_id: {'subject': str, 'stages': {stage: reason}}}
+        """
+        report = {}
+        counts = {}
+        for pair_id, pair, plan in self.plans(subjects):
+            subject = pair.get('metadata', {}).get('auto', {}).get('subject')
+            report[pair_id] = {'subject': subject, 'stages': plan}
+            print(f"Pair {pair_id} ({subject}):")
+            for stage, reason in plan.items():
+                print(f"  {stage:<12} {reason}")
+                counts[stage] = counts.get(stage, 0) + 1
+        print(f"\n{len(report)} pairs would rerun" +
+              (": " + ', '.join(f"{stage} x{count}" for stage, count in counts.items()) if counts else ""))
+        return report
+
+    def run(self, subjects=None):
+        """
+        Run all stale stages of all (or some subjects') pairs.
+
+        Parameters
+        ----------
+        subjects : list of str, optional
+            Only process these subjects
+
+        Returns
+        -------
+        dict
+            {'completed': [pair_ids], 'failed': {subject: [(pair_id, stage)]}, 'blocked': [pair_ids]}
+        """
+        # (pair_id, pair, memory, alone): pairs in flight when the pool broke run alone
+        queue = [(pair_id, pair, estimate_memory(pair), False) for pair_id, pair in self.pending(subjects)]
+        results = {'completed': [], 'failed': {}, 'blocked': []}
+        print(f"{len(queue)} pairs with stages to run, {self.n_workers} workers, "
+              f"{self.memory_budget / 1024 ** 3:.1f} GB budget")
+
+        pool = ProcessPoolExecutor(max_workers=self.n_workers)
+        running = {}  # future -> (pair_id, pair, memory, alone)
+        try:
+            while queue or running:
+                # Admit pairs in order while they fit in the budget; the first one always fits if nothing runs.
+                # A pair marked alone starts only on an idle pool and nothing is admitted next to it.
+                used = sum(item[2] for item in running.values())
+                while queue and len(running) < self.n_workers and not any(item[3] for item in running.values()) \
+                        and (not running or (used + queue[0][2] <= self.memory_budget and not queue[0][3])):
+                    pair_id, pair, memory, alone = queue.pop(0)
+                    future = pool.submit(run_pair, pair_id, pair, self.stages, self.output_dir, self.checkpoint_file)
+                    running[future] = (pair_id, pair, memory, alone)
+                    used += memory
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                in_flight = len(running)
+                broken = False
+                suspects = []
+                for future in done:
+                    pair_id, pair, memory, alone = running.pop(future)
+                    subject = pair.get('metadata', {}).get('auto', {}).get('subject')
+                    try:
+                        report = future.result()
+                    except BrokenProcessPool:
+                        broken = True
+                        if in_flight == 1:
+                            # The pair ran alone, so its own worker died
+                            report = self._worker_died(pair_id, subject)
+                        else:
+                            suspects.append((pair_id, pair, memory, True))
+                            continue
+                    except Exception as e:
+                        report = self._worker_died(pair_id, subject, f"{type(e).__name__}: {e}")
+                    self._collect(report, results)
+
+                if broken:
+                    # Every pair still in flight shared the broken pool; rerun each alone to find the culprit
+                    suspects += [(pair_id, pair, memory, True) for pair_id, pair, memory, _ in running.values()]
+                    queue[:0] = suspects
+                    running.clear()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = ProcessPoolExecutor(max_workers=self.n_workers)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        n_failed = sum(len(items) for items in results['failed'].values())
+        print(f"\nCompleted {len(results['completed'])} pairs, {n_failed} failed "
+              f"({len(results['failed'])} subjects), {len(results['blocked'])} blocked")
+        for subject, items in results['failed'].items():
+            print(f"  {subject}: " + ', '.join(f"pair {pair_id} at {stage}" for pair_id, stage in items))
+        return results
+
+    def _worker_died(self, pair_id, subject, error="worker process died"):
+        """Fail the running stages of a pair whose worker did not return."""
+        with CheckpointStore(self.checkpoint_file) as store:
+            store.fail_running(pair_id, error)
+            statuses = store.statuses(pair_id)
+        failed = next((stage for stage, status in statuses.items() if status == FAILED), 'unknown')
+        return {'pair_id': pair_id, 'subject': subject, 'ran': [], 'failed': failed, 'blocked': []}
+
+    @staticmethod
+    def _collect(report, results):
+        if report['failed']:
+            results['failed'].setdefault(report['subject'], []).append((report['pair_id'], report['failed']))
+        elif report['blocked']:
+            results['blocked'].append(report['pair_id'])
+        else:
+            results['completed'].append(report['pair_id'])
+
+    def status(self):
+        """Return {stage: {status: count}} of the checkpoints."""
+        with CheckpointStore(self.checkpoint_file) as store:
+            return store.summary()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Run the study pipeline over the pair database, resuming where it stopped.")
+    parser.add_argument('--db', default=None, help="Pair database file")
+    parser.add_argument('--output-dir', default=None, help="Root directory of combined recordings and results")
+    parser.add_argument('--stages', nargs='+', default=None, choices=PAIR_STAGES, help="Stages to run")
+    parser.add_argument('--subjects', nargs='+', default=None, help="Only process these subjects")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes")
+    parser.add_argument('--memory-gb', type=float, default=None, help="Memory budget in GB")
+    parser.add_argument('--status', action='store_true', help="Only print the checkpoint summary")
+    parser.add_argument('--dry-run', action='store_true', help="Only report which stages would rerun and why")
+    args = parser.parse_args()
+
+    scheduler = StudyScheduler(args.db, args.output_dir, args.stages, args.workers, args.memory_gb)
+    if args.dry_run:
+        scheduler.dry_run(args.subjects)
+    elif args.status:
+        for stage, counts in scheduler.status().items():
+            print(f"{stage:<12} " + ', '.join(f"{status}: {count}" for status, count in sorted(counts.items())))
+    else:
+        scheduler.run(args.subjects)
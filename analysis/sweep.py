@@ -0,0 +1,430 @@
+"""
+Parameter sweeps that share intermediate results across configurations.
+
+A grid maps dotted parameter keys to the values to try, e.g.
+
+    grid = {
+        'NVC_ANALYSIS.time_delay.max_lag_seconds': [8.0, 10.0, 15.0],
+        'EEG_PREPROCESSING.bands': [{'alpha': (8, 13), 'beta': (13, 30)},
+                                    {'alpha': (8, 12), 'beta': (12, 30)}],
+        'NVC_ANALYSIS.pac.low_fq_width': [0.05, 0.1],
+        'NVC_ANALYSIS.pac.method': ['tort', 'ozkurt'],
+    }
+
+and every combination is one configuration. SweepPlan resolves each
+configuration and identifies the upstream products it needs; the sweep then
+computes every distinct product once and fans it out:
+
+- preprocessed EEG/fNIRS once per distinct preprocessing sub-configuration
+  (usually one, read from the pipeline outputs),
+- band envelopes once per distinct band edge (shared across band sets) and
+  analysis rate, in one FilterBank cache,
+- lagged correlations once per analysis rate and fNIRS selection, over the
+  union of all lag windows and all band edges; each configuration takes its
+  lags and bands from it (correlations at a lag do not depend on the window),
+- PAC phases once per low-frequency grid and amplitudes once per
+  high-frequency grid, at one common decimated rate, so each configuration
+  only evaluates its coupling method,
+- GLMs once per distinct (bands, GLM parameters, rate).
+
+Configurations with identical sub-configurations for a method share the same
+result object.
+"""
+
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from analysis.dependencies import STAGE_PARAMETER_KEYS
+from utils.cache import canonical_json, get_parameter, resolve_parameters
+
+SWEEP_METHODS = ('time_delay', 'pac', 'glm')
+SWEEPABLE_PARAMETERS = ('EEG_PREPROCESSING', 'FNIRS_PREPROCESSING', 'NVC_ANALYSIS', 'STUDY_PIPELINE.analysis_sfreq')
+
+
+def expand_grid(grid):
+    """
+    All combinations of a parameter grid.
+
+    Parameters
+    ----------
+    grid : dict
+        Dotted parameter path -> list of values
+
+    Returns
+    -------
+    list of dict
+        One overrides dict (dotted path -> value) per configuration
+    """
+    for path, values in grid.items():
+        if not any(path == prefix or path.startswith(prefix + '.') for prefix in SWEEPABLE_PARAMETERS):
+            raise ValueError(f"Cannot sweep '{path}'. Sweepable: {', '.join(SWEEPABLE_PARAMETERS)}")
+        try:
+            get_parameter(path)
+        except (AttributeError, KeyError):
+            raise ValueError(f"Unknown parameter '{path}'")
+        if not isinstance(values, (list, tuple)) or not values:
+            raise ValueError(f"Grid values of '{path}' must be a non-empty list")
+    paths = list(grid)
+    return [dict(zip(paths, combination)) for combination in itertools.product(*(grid[path] for path in paths))]
+
+
+def resolve_configuration(overrides):
+    """Resolve the parameters the sweep methods read, with overrides applied."""
+    params = resolve_parameters(['EEG_PREPROCESSING', 'FNIRS_PREPROCESSING', 'NVC_ANALYSIS',
+                                 'STUDY_PIPELINE.analysis_sfreq'], overrides)
+    return {
+        'preprocess_key': canonical_json(resolve_parameters(STAGE_PARAMETER_KEYS['preprocess'], overrides)),
+        'eeg_filter': params['EEG_PREPROCESSING']['filter'],
+        'fnirs': params['FNIRS_PREPROCESSING'],
+        'bands': dict(params['EEG_PREPROCESSING']['bands']),
+        'time_delay': params['NVC_ANALYSIS']['time_delay'],
+        'pac': params['NVC_ANALYSIS']['pac'],
+        'glm': params['NVC_ANALYSIS']['glm'],
+        'analysis_sfreq': float(params['STUDY_PIPELINE.analysis_sfreq']),
+    }
+
+
+def _edges(edges):
+    return (float(edges[0]), float(edges[1]))
+
+
+def _edge_label(edges):
+    """Filter bank band name of one band edge pair, shared by all band sets using it."""
+    return f"{edges[0]:g}-{edges[1]:g}Hz"
+
+
+class SweepPlan:
+    """
+    Configurations of a sweep and the distinct products they need.
+
+    Parameters
+    ----------
+    grid : dict
+        Dotted parameter path -> list of values
+    methods : list of str, optional
+        Methods evaluated per configuration: 'time_delay', 'pac', 'glm'
+    """
+
+    def __init__(self, grid, methods=SWEEP_METHODS):
+        from methods.pac import default_decim_sfreq
+
+        unknown = set(methods) - set(SWEEP_METHODS)
+        if unknown:
+            raise ValueError(f"Unknown sweep methods: {', '.join(sorted(unknown))}. Available: {SWEEP_METHODS}")
+        self.grid = grid
+        self.methods = [method for method in SWEEP_METHODS if method in methods]
+        self.configurations = expand_grid(grid)
+        self.settings = [resolve_configuration(overrides) for overrides in self.configurations]
+        # One decimated rate for all PAC grids, so phases and amplitudes of different grids combine
+        self.pac_decim_sfreq = max(default_decim_sfreq(settings['pac']) for settings in self.settings)
+
+    def __len__(self):
+        return len(self.configurations)
+
+    def preprocess_groups(self):
+        """Return {preprocess sub-configuration: [configuration indices]} in first-use order."""
+        groups = {}
+        for index, settings in enumerate(self.settings):
+            groups.setdefault(settings['preprocess_key'], []).append(index)
+        return groups
+
+    def products(self):
+        """
+        Distinct products and method evaluations of the sweep.
+
+        Returns
+        -------
+        dict
+            {product: number of distinct computations}
+        """
+        keys = {name: set() for name in ('preprocess', 'envelopes', 'lagged_correlations', 'phases', 'amplitudes',
+                                         'time_delay', 'pac', 'glm')}
+        for settings in self.settings:
+            pre = settings['preprocess_key']
+            keys['preprocess'].add(pre)
+            rate = settings['analysis_sfreq']
+            if 'time_delay' in self.methods or 'glm' in self.methods:
+                keys['envelopes'].update((pre, _edges(edges), rate) for edges in settings['bands'].values())
+            if 'time_delay' in self.methods:
+                keys['lagged_correlations'].add((pre, rate, settings['time_delay']['correlate_with']))
+                keys['time_delay'].add((pre, canonical_json([settings['bands'], settings['time_delay'], rate])))
+            if 'pac' in self.methods:
+                pac = settings['pac']
+                keys['phases'].add((pre, canonical_json([pac['low_fq_range'], pac['low_fq_width']])))
+                keys['amplitudes'].add((pre, canonical_json([pac['high_fq_range'], pac['high_fq_width']])))
+                keys['pac'].add((pre, canonical_json(pac)))
+            if 'glm' in self.methods:
+                keys['glm'].add((pre, canonical_json([settings['bands'], settings['glm'], rate])))
+        return {name: len(values) for name, values in keys.items()}
+
+    def describe(self):
+        """Print the number of configurations and of distinct computations."""
+        print(f"{len(self)} configurations over {', '.join(self.grid) or 'the current parameters'}")
+        for name, count in self.products().items():
+            if count:
+                print(f"  {name:<20} {count}")
+
+
+class _RecordingSweep:
+    """Memoized evaluation of all configurations of one preprocessing group of one recording."""
+
+    def __init__(self, plan, eeg, fnirs, sfreq, fnirs_types, key, n_jobs):
+        from preprocessing.filter_bank import FilterBank
+
+        self.plan = plan
+        self.eeg = eeg
+        self.fnirs = fnirs
+        self.sfreq = float(sfreq)
+        self.fnirs_types = list(fnirs_types)
+        self.key = key
+        self.n_jobs = n_jobs
+        self._resampled = {}
+        self._memo = {}
+        edges = {_edges(e) for settings in plan.settings for e in settings['bands'].values()}
+        self.bank = FilterBank(self.sfreq, {_edge_label(e): e for e in sorted(edges)})
+
+    def _once(self, name, key, compute):
+        memo_key = (name, key)
+        if memo_key not in self._memo:
+            self._memo[memo_key] = compute()
+        return self._memo[memo_key]
+
+    def fnirs_at(self, sfreq_out):
+        """fNIRS signals resampled to an analysis rate (once per rate)."""
+        from preprocessing.resample import resample
+
+        if sfreq_out not in self._resampled:
+            self._resampled[sfreq_out] = (np.asarray(self.fnirs) if sfreq_out == self.sfreq
+                                          else resample(self.fnirs, self.sfreq, sfreq_out))
+        return self._resampled[sfreq_out]
+
+    def envelopes(self, band_edges, sfreq_out):
+        """Envelopes (n_eeg, n_bands, n_times) of band edges, each band filtered once per recording and rate."""
+        return self.bank.envelopes(self.eeg, key=self.key, sfreq_out=sfreq_out,
+                                   bands=[_edge_label(_edges(e)) for e in band_edges])
+
+    def time_delay(self, settings, indices):
+        from methods.time_delay import lagged_correlation, select_fnirs_channels
+
+        rate = settings['analysis_sfreq']
+        correlate_with = settings['time_delay']['correlate_with']
+
+        def correlate():
+            # Union of the lag windows and band edges of every configuration sharing rate and fNIRS selection
+            members = [self.plan.settings[i] for i in indices
+                       if self.plan.settings[i]['analysis_sfreq'] == rate
+                       and self.plan.settings[i]['time_delay']['correlate_with'] == correlate_with]
+            all_edges = sorted({_edges(e) for member in members for e in member['bands'].values()})
+            min_lag = min(member['time_delay']['min_lag_seconds'] for member in members)
+            max_lag = max(member['time_delay']['max_lag_seconds'] for member in members)
+            picks = select_fnirs_channels(self.fnirs_types, correlate_with)
+            envelopes = self.envelopes(all_edges, rate)
+            fnirs = self.fnirs_at(rate)[picks]
+            n_times = min(envelopes.shape[-1], fnirs.shape[-1])
+            result = lagged_correlation(envelopes[..., :n_times], fnirs[..., :n_times], rate, min_lag, max_lag)
+            return all_edges, picks, result
+
+        all_edges, picks, union = self._once('lagged_correlation', (rate, correlate_with), correlate)
+
+        def select():
+            params = settings['time_delay']
+            tolerance = 0.5 / rate
+            lags = (union['lags'] >= params['min_lag_seconds'] - tolerance) & \
+                   (union['lags'] <= params['max_lag_seconds'] + tolerance)
+            bands = [all_edges.index(_edges(e)) for e in settings['bands'].values()]
+            return {'lags': union['lags'][lags], 'corr': union['corr'][lags][:, :, bands],
+                    'bands': list(settings['bands']), 'fnirs_picks': picks}
+
+        return self._once('time_delay', canonical_json([settings['bands'], settings['time_delay'], rate]), select)
+
+    def pac(self, settings):
+        from methods.pac import PACEngine, NATIVE_METHODS
+
+        params = settings['pac']
+        engine = PACEngine(self.sfreq, params=params, decim_sfreq=self.plan.pac_decim_sfreq, n_jobs=self.n_jobs)
+
+        def evaluate():
+            if params['method'] not in NATIVE_METHODS:
+                comod = engine.comodulogram(self.fnirs, self.eeg, params['method'])
+            else:
+                phase = self._once('phases', canonical_json([params['low_fq_range'], params['low_fq_width']]),
+                                   lambda: engine.phases(np.asarray(self.fnirs)))
+                amplitude = self._once('amplitudes',
+                                       canonical_json([params['high_fq_range'], params['high_fq_width']]),
+                                       lambda: engine.amplitudes(np.asarray(self.eeg)))
+                comod = engine.comodulogram_from_cache(phase, amplitude, params['method'])
+            return {'low_fq': engine.low_fq, 'high_fq': engine.high_fq, 'comod': comod}
+
+        return self._once('pac', canonical_json(params), evaluate)
+
+    def glm(self, settings):
+        from methods.glm import eeg_informed_glm
+
+        rate = settings['analysis_sfreq']
+        params = settings['glm']
+
+        def fit():
+            envelopes = self.envelopes(list(settings['bands'].values()), rate).mean(axis=0)
+            fnirs = self.fnirs_at(rate)
+            n_times = min(envelopes.shape[-1], fnirs.shape[-1])
+            return eeg_informed_glm(envelopes[:, :n_times], fnirs[:, :n_times], rate,
+                                    regressor_names=list(settings['bands']), high_pass=params['high_pass'],
+                                    drift_model=params['drift_model'], hrf_model=params['hrf_model'])
+
+        return self._once('glm', canonical_json([settings['bands'], params, rate]), fit)
+
+
+def _run_sweep(plan, load, sfreq, fnirs_types, key=None, n_jobs=1):
+    """Evaluate all configurations, one preprocessing group at a time."""
+    results = [{'overrides': overrides} for overrides in plan.configurations]
+    for preprocess_key, indices in plan.preprocess_groups().items():
+        eeg, fnirs = load(plan.settings[indices[0]])
+        recording = _RecordingSweep(plan, eeg, fnirs, sfreq, fnirs_types, (key, preprocess_key), n_jobs)
+        for index in indices:
+            settings = plan.settings[index]
+            if 'time_delay' in plan.methods:
+                results[index]['time_delay'] = recording.time_delay(settings, indices)
+            if 'pac' in plan.methods:
+                results[index]['pac'] = recording.pac(settings)
+            if 'glm' in plan.methods:
+                results[index]['glm'] = recording.glm(settings)
+        del recording, eeg, fnirs
+    return results
+
+
+def sweep_arrays(eeg, fnirs, sfreq, fnirs_types, grid=None, methods=SWEEP_METHODS, plan=None, n_jobs=1):
+    """
+    Sweep the analysis of one recording given its preprocessed signals.
+
+    Parameters
+    ----------
+    eeg : ndarray, shape (n_eeg, n_times)
+        Preprocessed EEG
+    fnirs : ndarray, shape (n_fnirs, n_times)
+        Preprocessed fNIRS at the same rate
+    sfreq : float
+        Sampling rate in Hz
+    fnirs_types : list of str
+        Channel types of the fNIRS rows ('hbo', 'hbr')
+    grid : dict, optional
+        Dotted parameter path -> list of values (ignored if plan is given)
+    methods : list of str, optional
+        Methods to evaluate
+    plan : SweepPlan, optional
+        Precomputed plan
+    n_jobs : int, optional
+        Threads of the PAC evaluation
+
+    Returns
+    -------
+    list of dict
+        Per configuration: {'overrides', and one result per method}
+
+    Raises
+    ------
+    ValueError
+        If the grid sweeps preprocessing parameters (use sweep_pair)
+    """
+    plan = plan or SweepPlan(grid or {}, methods)
+    if len(plan.preprocess_groups()) > 1:
+        raise ValueError("The grid sweeps preprocessing parameters; use sweep_pair with the combined recording")
+    return _run_sweep(plan, lambda settings: (eeg, fnirs), sfreq, fnirs_types, n_jobs=n_jobs)
+
+
+def sweep_pair(ctx, grid=None, methods=SWEEP_METHODS, plan=None, n_jobs=1):
+    """
+    Sweep the analysis of one pair of the study pipeline.
+
+    The configured preprocessing is read from the pipeline outputs; other
+    preprocessing sub-configurations are computed in memory from the combined
+    recording, once each.
+
+    Parameters
+    ----------
+    ctx : PairContext
+        Paths of the pair (the combine stage must be done)
+    grid, methods, plan, n_jobs
+        As in sweep_arrays
+
+    Returns
+    -------
+    list of dict
+        Per configuration: {'overrides', and one result per method}
+    """
+    from io_mgmt.combined_format import open_combined
+    from preprocessing.eeg import filter_eeg
+    from preprocessing.fnirs import preprocess_fnirs_resampled
+
+    plan = plan or SweepPlan(grid or {}, methods)
+    sfreq, eeg_picks, fnirs_picks, fnirs_types = ctx.channel_picks()
+    configured = resolve_configuration({})['preprocess_key']
+
+    def load(settings):
+        if settings['preprocess_key'] == configured:
+            try:
+                return ctx.preprocessed()
+            except OSError:
+                pass
+        data = open_combined(ctx.combined_path)
+        eeg = filter_eeg(data, sfreq, picks=eeg_picks, params=settings['eeg_filter'])
+        fnirs = preprocess_fnirs_resampled(data[fnirs_picks], sfreq, ctx.fnirs_sfreq(settings['fnirs']),
+                                           params=settings['fnirs'])
+        return eeg, fnirs
+
+    return _run_sweep(plan, load, sfreq, fnirs_types, key=ctx.stem, n_jobs=n_jobs)
+
+
+def _sweep_pair_task(pair_id, pair, output_dir, plan):
+    from analysis.tasks.pair_stages import PairContext
+
+    return pair_id, sweep_pair(PairContext(pair_id, pair, output_dir), plan=plan)
+
+
+def sweep_study(grid, methods=SWEEP_METHODS, db_file=None, output_dir=None, subjects=None, n_workers=None):
+    """
+    Sweep the analysis over every pair of the study.
+
+    Stale combine and preprocessing stages are first brought up to date with
+    the study scheduler, then pairs are swept in parallel.
+
+    Parameters
+    ----------
+    grid : dict
+        Dotted parameter path -> list of values
+    methods : list of str, optional
+        Methods to evaluate
+    db_file, output_dir : str, optional
+        Pair database and pipeline output root, as in StudyScheduler
+    subjects : list of str, optional
+        Only sweep these subjects
+    n_workers : int, optional
+        Worker processes. Defaults to STUDY_PIPELINE['n_workers'].
+
+    Returns
+    -------
+    dict
+        {'configurations': [overrides], 'results': {pair_id: [per-configuration results]}}
+    """
+    from analysis.scheduler import StudyScheduler
+
+    plan = SweepPlan(grid, methods)
+    plan.describe()
+    scheduler = StudyScheduler(db_file, output_dir, stages=['preprocess'], n_workers=n_workers)
+    scheduler.run(subjects)
+
+    results = {}
+    pairs = scheduler.pairs(subjects)
+    with ProcessPoolExecutor(max_workers=scheduler.n_workers) as pool:
+        futures = {pool.submit(_sweep_pair_task, pair_id, pair, scheduler.output_dir, plan): pair_id
+                   for pair_id, pair in pairs}
+        for future, pair_id in futures.items():
+            try:
+                _, pair_results = future.result()
+            except Exception as e:
+                print(f"Sweep failed for pair {pair_id}: {type(e).__name__}: {e}")
+                continue
+            results[pair_id] = pair_results
+    print(f"Swept {len(results)} of {len(pairs)} pairs")
+    return {'configurations': plan.configurations, 'results': results}
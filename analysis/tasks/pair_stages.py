@@ -0,0 +1,219 @@
+"""
+Per-pair pipeline stages run by analysis.scheduler.
+
+Stages and the files they write, all next to the combined recording
+(combine_fnirs_eeg.combined_output_path):
+
+    quality      <name>_quality.npz          recording_quality (raw recordings)
+    combine      <name>.nvc + <name>.json    combine_pair
+    annotations  <name>.json (in place)      standardize_sidecar
+    preprocess   <name>_eeg.npy, <name>_fnirs.npy
+                                             filter_eeg, preprocess_fnirs_resampled
+    time_delay   <name>_time_delay.npz       band_envelope_correlation
+    pac          <name>_pac.npz              compute_comodulogram
+    glm          <name>_glm.npz              eeg_band_glm
+
+QC runs first and reads only the raw recordings, since the combined
+recording no longer holds the wavelengths the scalp coupling index needs.
+Every other stage reads only the files of the stages in STAGE_REQUIRES and
+memory-maps large arrays (the combined recording through
+io_mgmt.combined_format), so a stage can run in a fresh worker process.
+"""
+
+import os
+import json
+
+import numpy as np
+
+from config.parameters import STUDY_PIPELINE
+
+PAIR_STAGES = ('quality', 'combine', 'annotations', 'preprocess', 'time_delay', 'pac', 'glm')
+
+STAGE_REQUIRES = {
+    'quality': (),
+    'combine': (),
+    'annotations': ('combine',),
+    'preprocess': ('combine',),
+    'time_delay': ('preprocess',),
+    'pac': ('preprocess',),
+    'glm': ('preprocess',),
+}
+
+
+class PairContext:
+    """
+    Paths of the files one pair's stages read and write.
+
+    Parameters
+    ----------
+    pair_id : int
+        Row ID in the pair database
+    pair : dict
+        Pair dictionary with 'eeg_path', 'fnirs_path' and 'metadata'
+    output_dir : str, optional
+        Root directory of combined recordings and results
+    """
+
+    def __init__(self, pair_id, pair, output_dir=None):
+        from io_mgmt.combine_fnirs_eeg import combined_output_path
+
+        self.pair_id = pair_id
+        self.pair = pair
+        self.subject = pair.get('metadata', {}).get('auto', {}).get('subject')
+        self.combined_path = combined_output_path(pair, output_dir)
+        self.stem = os.path.splitext(self.combined_path)[0]
+        self.sidecar_path = self.stem + '.json'
+        self.eeg_path = self.stem + '_eeg.npy'
+        self.fnirs_path = self.stem + '_fnirs.npy'
+
+    def result_path(self, stage):
+        """Return the .npz file of an analysis stage."""
+        return f"{self.stem}_{stage}.npz"
+
+    def outputs(self, stage):
+        """Return the files a stage writes."""
+        if stage == 'combine':
+            return [self.combined_path, self.sidecar_path]
+        if stage == 'annotations':
+            return [self.sidecar_path]
+        if stage == 'preprocess':
+            return [self.eeg_path, self.fnirs_path]
+        return [self.result_path(stage)]
+
+    def sidecar(self):
+        with open(self.sidecar_path, 'r') as f:
+            return json.load(f)
+
+    def channel_picks(self):
+        """
+        Return (sfreq, EEG rows, fNIRS rows, fNIRS channel types) of the combined recording.
+
+        Raises ValueError if the recording has no EEG or no HbO/HbR channels
+        (e.g., raw fNIRS intensities combined before combine_pair converted them).
+        """
+        sidecar = self.sidecar()
+        ch_types = np.array(sidecar['ch_types'])
+        eeg_picks = np.flatnonzero(ch_types == 'eeg')
+        fnirs_picks = np.flatnonzero(np.isin(ch_types, ['hbo', 'hbr']))
+        if not len(eeg_picks) or not len(fnirs_picks):
+            raise ValueError(f"{self.combined_path} needs EEG and HbO/HbR channels, "
+                             f"found {len(eeg_picks)} EEG and {len(fnirs_picks)} HbO/HbR")
+        return sidecar['sfreq'], eeg_picks, fnirs_picks, list(ch_types[fnirs_picks])
+
+    def fnirs_sfreq(self, params=None):
+        """Rate fNIRS preprocessing runs at: params['sfreq'], else the native rate of the fNIRS recording."""
+        from config.parameters import FNIRS_PREPROCESSING
+
+        params = params or FNIRS_PREPROCESSING
+        return params.get('sfreq') or self.sidecar().get('source_sfreq', {}).get('fnirs')
+
+    def preprocessed(self):
+        """Memory-map the preprocessed EEG and fNIRS signals."""
+        return np.load(self.eeg_path, mmap_mode='r'), np.load(self.fnirs_path, mmap_mode='r')
+
+
+def _save_results(path, result):
+    """Write the array and scalar values of a result dict atomically as .npz."""
+    arrays = {name: np.asarray(value) for name, value in result.items()
+              if value is not None and not isinstance(value, dict)}
+    tmp_file = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_file, **arrays)
+    os.replace(tmp_file, path)
+
+
+def run_quality(ctx):
+    from io_mgmt.combine_fnirs_eeg import open_raw
+    from preprocessing.quality import recording_quality
+
+    result = recording_quality(open_raw(ctx.pair['eeg_path']), open_raw(ctx.pair['fnirs_path']))
+    os.makedirs(os.path.dirname(ctx.result_path('quality')), exist_ok=True)
+    _save_results(ctx.result_path('quality'), result)
+
+
+def run_combine(ctx):
+    from io_mgmt.combine_fnirs_eeg import combine_pair
+
+    combine_pair(ctx.pair, ctx.combined_path)
+
+
+def run_annotations(ctx):
+    from io_mgmt.change_annots import standardize_sidecar
+
+    standardize_sidecar(ctx.sidecar_path)
+
+
+def run_preprocess(ctx):
+    from io_mgmt.combined_format import open_combined
+    from preprocessing.eeg import filter_eeg
+    from preprocessing.fnirs import preprocess_fnirs_resampled
+
+    sfreq, eeg_picks, fnirs_picks, _ = ctx.channel_picks()
+    data = open_combined(ctx.combined_path)
+    n_times = data.shape[-1]
+
+    tmp_file = f"{ctx.eeg_path}.{os.getpid()}.tmp.npy"
+    eeg = np.lib.format.open_memmap(tmp_file, mode='w+', shape=(len(eeg_picks), n_times))
+    filter_eeg(data, sfreq, out=eeg, picks=eeg_picks)
+    del eeg
+    os.replace(tmp_file, ctx.eeg_path)
+
+    # fNIRS rows follow the EEG rows, so a contiguous slice stays lazy
+    contiguous = np.all(np.diff(fnirs_picks) == 1)
+    fnirs_in = data[fnirs_picks[0]:fnirs_picks[-1] + 1] if contiguous else np.asarray(data[fnirs_picks])
+    tmp_file = f"{ctx.fnirs_path}.{os.getpid()}.tmp.npy"
+    fnirs = np.lib.format.open_memmap(tmp_file, mode='w+', shape=(len(fnirs_picks), n_times))
+    preprocess_fnirs_resampled(fnirs_in, sfreq, ctx.fnirs_sfreq(), out=fnirs)
+    del fnirs
+    os.replace(tmp_file, ctx.fnirs_path)
+
+
+def run_time_delay(ctx):
+    from methods.time_delay import band_envelope_correlation, select_fnirs_channels, peak_lags
+
+    sfreq, _, _, fnirs_types = ctx.channel_picks()
+    eeg, fnirs = ctx.preprocessed()
+    picks = select_fnirs_channels(fnirs_types)
+    result = band_envelope_correlation(eeg, fnirs[picks], sfreq, key=ctx.stem,
+                                       sfreq_out=STUDY_PIPELINE['analysis_sfreq'])
+    peaks = peak_lags(result)
+    result.update(peak_lag=peaks['lag'], peak_corr=peaks['corr'], fnirs_picks=picks)
+    _save_results(ctx.result_path('time_delay'), result)
+
+
+def run_pac(ctx):
+    from methods.pac import compute_comodulogram
+
+    sfreq, _, _, _ = ctx.channel_picks()
+    eeg, fnirs = ctx.preprocessed()
+    _save_results(ctx.result_path('pac'), compute_comodulogram(fnirs, eeg, sfreq))
+
+
+def run_glm(ctx):
+    from methods.glm import eeg_band_glm
+
+    sfreq, _, _, _ = ctx.channel_picks()
+    eeg, fnirs = ctx.preprocessed()
+    result = eeg_band_glm(eeg, fnirs, sfreq, key=ctx.stem, sfreq_out=STUDY_PIPELINE['analysis_sfreq'])
+    _save_results(ctx.result_path('glm'), result)
+
+
+STAGE_FUNCTIONS = {
+    'quality': run_quality,
+    'combine': run_combine,
+    'annotations': run_annotations,
+    'preprocess': run_preprocess,
+    'time_delay': run_time_delay,
+    'pac': run_pac,
+    'glm': run_glm,
+}
+
+
+def release_caches(ctx):
+    """Drop the cached envelopes of a pair from the shared filter bank after its last stage."""
+    from preprocessing.filter_bank import get_filter_bank
+
+    try:
+        sfreq = ctx.sidecar()['sfreq']
+    except (OSError, ValueError, KeyError):
+        return
+    get_filter_bank(sfreq).clear_cache(ctx.stem)
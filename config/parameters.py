@@ -32,12 +32,27 @@ FNIRS_PREPROCESSING = {
         'time_window': 60  # Seconds
     },
     'remove_mayer': False,  # Whether to remove Mayer wave component
-    'apply_tddr': True      # Apply Temporal Derivative Distribution Repair
+    'apply_tddr': True,     # Apply Temporal Derivative Distribution Repair
+    'sfreq': None           # Rate preprocessing runs at (Hz); None = native rate of the fNIRS recording
+}
+
+# Acquisition clocks
+RECORDING_CLOCKS = {
+    # IANA time zone of the NIRx acquisition computer (e.g., 'Europe/Berlin'). NIRx headers store local
+    # wall-clock times; None uses the time zone of this machine. EEG .fif files store UTC.
+    'nirx_timezone': None
 }
 
 # Combined Data Parameters
 COMBINE_PARAMS = {
-    'resample_to': 250  # Resample combined data to this frequency (Hz)
+    'resample_to': 250,  # Resample combined data to this frequency (Hz)
+    'storage': {
+        'dtype': 'float64',      # 'float64' or 'float32' samples on disk
+        'chunk_seconds': 10.0    # Length of the time chunks of each channel group
+    },
+    'beer_lambert': {
+        'ppf': 6.0               # Partial pathlength factor of the raw intensity to HbO/HbR conversion
+    }
 }
 
 # Neurovascular Coupling Analysis Parameters
@@ -58,9 +73,26 @@ NVC_ANALYSIS = {
         'drift_model': 'cosine',
         'high_pass': 0.005,
         'hrf_model': 'spm'
+    },
+    'surrogates': {
+        'n_surrogates': 1000,
+        'method': 'time_shift',     # 'time_shift' (circular) or 'block_shuffle' of the fNIRS signals
+        'min_shift_seconds': 30.0,  # Smallest circular shift
+        'block_seconds': 30.0,      # Block length for 'block_shuffle'
+        'chunk_size': 50,           # Surrogates per worker task
+        'seed': 0
     }
 }
 
+# Study pipeline (analysis/scheduler.py)
+STUDY_PIPELINE = {
+    'stages': ['quality', 'combine', 'annotations', 'preprocess', 'time_delay', 'pac', 'glm'],
+    'analysis_sfreq': 10.0,        # Rate of the lagged correlation and the GLM (Hz)
+    'n_workers': 4,                # Pairs processed in parallel
+    'memory_budget_gb': 16.0,      # Estimated memory of all running pairs
+    'memory_per_input_byte': 8.0   # Estimated peak memory per byte of raw input files
+}
+
 # Task-specific Parameters
 MOTOR_TASK = {
     'epoch': {
@@ -73,4 +105,18 @@ MOTOR_TASK = {
 RESTING_STATE = {
     'epoch_duration': 30,  # Duration of resting state epochs (seconds)
     'epoch_overlap': 15    # Overlap between epochs (seconds)
-}
\ No newline at end of file
+}
+
+# Annotation standardization (step 3 in io_mgmt/io_cli.py)
+ANNOTATION_STANDARD = {
+    'rules': [
+        # 'exact': full description, 'regex': re.search pattern, 'code': numeric trigger code
+        {'type': 'code', 'pattern': 1, 'label': 'tapping/start'},
+        {'type': 'code', 'pattern': 2, 'label': 'tapping/stop'},
+        {'type': 'regex', 'pattern': r'(?i)^rest', 'label': 'rest'},
+        {'type': 'regex', 'pattern': r'(?i)^bad', 'label': 'BAD'}
+    ],
+    'onset_shift': {},       # Standard label -> onset shift in seconds
+    'merge_window': 0.1,     # Merge annotations with the same label closer than this (seconds)
+    'keep_unmatched': True   # Keep annotations no rule matches under their original description
+}
@@ -0,0 +1,323 @@
+"""
+Synthetic EEG-fNIRS recordings with known neurovascular coupling.
+
+The manual fields of SYNTHETIC_DATA_METADATA control the simulation:
+- simulated_activity: 'motor' adds tapping blocks (annotated with trigger
+  codes 1/2) that raise the source envelopes; 'resting' and 'custom' use
+  spontaneous envelope fluctuations only.
+- noise_level: sensor noise relative to the signal ('low', 'medium', 'high').
+- coupling_strength: gain of the hemodynamic response to the EEG envelopes
+  ('weak', 'moderate', 'strong').
+- delay_seconds: extra delay of the hemodynamic response.
+
+Each subject has a few latent sources, one per EEG band. Their band-limited
+activity is mixed into the EEG channels. Their envelopes, convolved with the
+SPM HRF and delayed, drive HbO (and, inverted and scaled, HbR) through a
+known channel weight matrix on top of cardiac, respiratory and Mayer-wave
+physiology. All channels and sources are generated as array operations.
+
+Recordings are written in the project layout (<root>/EEG/<subject>/ and
+<root>/fNIRS/<subject>/, both as .fif) with a ground-truth JSON next to the
+EEG file. Subjects are generated in parallel with per-subject seeds and
+registered in the pair database.
+"""
+
+import os
+import json
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.fft import rfft, irfft, rfftfreq
+from scipy.signal import fftconvolve
+
+from config.data_paths_and_config import DATA_ROOT
+from config.data_descriptions import SYNTHETIC_DATA_METADATA
+from config.parameters import EEG_PREPROCESSING
+from methods.glm import spm_hrf
+
+DEFAULT_OUTPUT_ROOT = os.path.join(DATA_ROOT, "synthetic")
+
+NOISE_LEVELS = {'low': 0.5, 'medium': 1.0, 'high': 2.0}
+COUPLING_STRENGTHS = {'weak': 0.25, 'moderate': 0.5, 'strong': 1.0}
+
+DEFAULT_SETTINGS = {
+    'simulated_activity': 'motor',
+    'noise_level': 'medium',
+    'coupling_strength': 'moderate',
+    'delay_seconds': 2.0,
+    'duration': 600.0,          # seconds
+    'eeg_sfreq': 500.0,
+    'fnirs_sfreq': 7.8125,      # NIRx sampling rate
+    'n_eeg': 64,
+    'n_fnirs_pairs': 20,        # source-detector pairs, each with HbO and HbR
+    'bands': ['alpha', 'beta'],  # one latent source per band (EEG_PREPROCESSING['bands'])
+    'tapping_seconds': 15.0,    # motor blocks
+    'isi': 30.0,                # seconds between block onsets
+    'fnirs_start_offset': 2.0,  # fNIRS starts this much later than EEG (seconds)
+}
+
+EEG_SCALE = 10e-6     # V
+FNIRS_SCALE = 1e-6    # M
+HBR_RATIO = -0.3
+PHYSIOLOGY = {'cardiac': (1.1, 0.3), 'respiration': (0.25, 0.2), 'mayer': (0.1, 0.4)}  # (Hz, relative amplitude)
+
+
+def subject_rng(seed, subject_index):
+    """Random generator of one subject, independent of the worker it runs on."""
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(subject_index,)))
+
+
+def band_limited_noise(rng, n_signals, n_times, sfreq, bands):
+    """
+    Unit-variance noise restricted to one frequency band per signal.
+
+    Parameters
+    ----------
+    rng : numpy.random.Generator
+        Random generator
+    n_signals : int
+        Number of signals
+    n_times : int
+        Samples per signal
+    sfreq : float
+        Sampling rate in Hz
+    bands : array-like, shape (n_signals, 2)
+        Band edges in Hz
+
+    Returns
+    -------
+    ndarray, shape (n_signals, n_times)
+        Band-limited signals
+    """
+    bands = np.asarray(bands, dtype=float)
+    freqs = rfftfreq(n_times, 1.0 / sfreq)
+    mask = (freqs[None, :] >= bands[:, :1]) & (freqs[None, :] <= bands[:, 1:])
+    signals = irfft(rfft(rng.standard_normal((n_signals, n_times)), axis=-1) * mask, n=n_times, axis=-1)
+    return signals / signals.std(axis=-1, keepdims=True)
+
+
+def task_boxcar(n_times, sfreq, block_seconds, isi):
+    """Boxcar of tapping blocks starting every isi seconds after one isi of rest, and their onsets."""
+    onsets = np.arange(isi, n_times / sfreq - block_seconds, isi)
+    times = np.arange(n_times) / sfreq
+    since_onset = times[None, :] - onsets[:, None]
+    boxcar = ((since_onset >= 0) & (since_onset < block_seconds)).any(axis=0).astype(float)
+    return boxcar, onsets
+
+
+def source_envelopes(rng, n_sources, n_times, sfreq, boxcar=None):
+    """
+    Positive, slowly varying amplitude envelopes of the latent sources.
+
+    Spontaneous fluctuations are band-limited to 0.01-0.2 Hz. A task boxcar,
+    if given, raises every envelope by a source-specific gain.
+    """
+    fluctuations = band_limited_noise(rng, n_sources, n_times, sfreq, [(0.01, 0.2)] * n_sources)
+    envelopes = np.exp(0.4 * fluctuations)
+    if boxcar is not None:
+        envelopes += rng.uniform(0.5, 1.5, size=(n_sources, 1)) * boxcar[None, :]
+    return envelopes
+
+
+def simulate_subject(rng, settings):
+    """
+    Simulate one EEG and one fNIRS recording.
+
+    Parameters
+    ----------
+    rng : numpy.random.Generator
+        Random generator
+    settings : dict
+        DEFAULT_SETTINGS with overrides
+
+    Returns
+    -------
+    dict
+        {'eeg': (n_eeg, n_eeg_times), 'fnirs': (2 * n_fnirs_pairs, n_fnirs_times) HbO/HbR interleaved,
+         'onsets': tapping onsets in seconds (EEG time), 'ground_truth': dict}
+    """
+    noise = NOISE_LEVELS[settings['noise_level']]
+    coupling = COUPLING_STRENGTHS[settings['coupling_strength']]
+    bands = [EEG_PREPROCESSING['bands'][band] for band in settings['bands']]
+    n_sources = len(bands)
+    fnirs_sfreq, eeg_sfreq = settings['fnirs_sfreq'], settings['eeg_sfreq']
+    n_fnirs_times = int(settings['duration'] * fnirs_sfreq)
+    n_eeg_times = int(settings['duration'] * eeg_sfreq)
+
+    # Envelopes on the fNIRS grid; the motor task drives them through a boxcar
+    boxcar, onsets = None, np.array([])
+    if settings['simulated_activity'] == 'motor':
+        boxcar, onsets = task_boxcar(n_fnirs_times, fnirs_sfreq, settings['tapping_seconds'], settings['isi'])
+    envelopes = source_envelopes(rng, n_sources, n_fnirs_times, fnirs_sfreq, boxcar)
+
+    # EEG: band-limited sources modulated by the envelopes, mixed into the channels, plus noise
+    fnirs_times = np.arange(n_fnirs_times) / fnirs_sfreq
+    eeg_times = np.arange(n_eeg_times) / eeg_sfreq
+    eeg_envelopes = np.stack([np.interp(eeg_times, fnirs_times, envelope) for envelope in envelopes])
+    sources = eeg_envelopes * band_limited_noise(rng, n_sources, n_eeg_times, eeg_sfreq, bands)
+    eeg_mixing = rng.standard_normal((settings['n_eeg'], n_sources))
+    eeg = eeg_mixing @ sources + noise * rng.standard_normal((settings['n_eeg'], n_eeg_times))
+
+    # fNIRS: HRF responses to the envelopes, delayed and weighted per channel, plus physiology and noise
+    hrf = spm_hrf(float(fnirs_sfreq))
+    responses = fftconvolve(envelopes - envelopes.mean(axis=-1, keepdims=True), hrf[None, :], axes=-1)
+    responses = responses[:, :n_fnirs_times] / responses.std(axis=-1, keepdims=True)
+    delay = int(round(settings['delay_seconds'] * fnirs_sfreq))
+    responses = np.pad(responses, ((0, 0), (delay, 0)))[:, :n_fnirs_times]
+    n_pairs = settings['n_fnirs_pairs']
+    fnirs_weights = coupling * rng.uniform(0, 1, size=(n_pairs, n_sources)) * (rng.random((n_pairs, n_sources)) < 0.6)
+    physiology = sum(amplitude * np.sin(2 * np.pi * freq * fnirs_times[None, :] + rng.uniform(0, 2 * np.pi, (n_pairs, 1)))
+                     for freq, amplitude in PHYSIOLOGY.values())
+    hbo = fnirs_weights @ responses + physiology + 0.5 * noise * rng.standard_normal((n_pairs, n_fnirs_times))
+    hbr = HBR_RATIO * (fnirs_weights @ responses) + 0.3 * physiology \
+        + 0.5 * noise * rng.standard_normal((n_pairs, n_fnirs_times))
+    fnirs = np.empty((2 * n_pairs, n_fnirs_times))
+    fnirs[0::2], fnirs[1::2] = hbo, hbr
+
+    return {
+        'eeg': eeg * EEG_SCALE,
+        'fnirs': fnirs * FNIRS_SCALE,
+        'onsets': onsets,
+        'ground_truth': {
+            'bands': settings['bands'],
+            'eeg_mixing': eeg_mixing,
+            'fnirs_weights': fnirs_weights,
+            'hbr_ratio': HBR_RATIO,
+            'delay_seconds': settings['delay_seconds'],
+            'coupling_gain': coupling,
+            'noise_std': noise,
+            'settings': settings
+        }
+    }
+
+
+def _write_subject(task):
+    """Simulate one subject and write it in the project layout (worker task)."""
+    import mne
+
+    subject_id, subject_index, output_root, settings, seed = task
+    simulation = simulate_subject(subject_rng(seed, subject_index), settings)
+    meas_date = datetime(2000, 1, 1, tzinfo=timezone.utc) + timedelta(days=subject_index)
+
+    eeg_dir = os.path.join(output_root, 'EEG', subject_id)
+    fnirs_dir = os.path.join(output_root, 'fNIRS', subject_id)
+    os.makedirs(eeg_dir, exist_ok=True)
+    os.makedirs(fnirs_dir, exist_ok=True)
+    stem = f"{subject_id}_synthetic_{settings['simulated_activity']}"
+
+    eeg_info = mne.create_info([f"EEG{i + 1:03d}" for i in range(settings['n_eeg'])],
+                               settings['eeg_sfreq'], 'eeg')
+    eeg_raw = mne.io.RawArray(simulation['eeg'], eeg_info, verbose='error')
+    eeg_raw.set_meas_date(meas_date)
+    onsets = simulation['onsets']
+    if len(onsets):
+        stops = onsets + settings['tapping_seconds']
+        eeg_raw.set_annotations(mne.Annotations(np.concatenate([onsets, stops]), 0.0,
+                                                ['1'] * len(onsets) + ['2'] * len(stops),
+                                                orig_time=meas_date))
+    eeg_path = os.path.join(eeg_dir, f"{stem}_eeg_raw.fif")
+    eeg_raw.save(eeg_path, overwrite=True, verbose='error')
+
+    fnirs_names = [f"S{i + 1}_D{i + 1} {kind}" for i in range(settings['n_fnirs_pairs']) for kind in ('hbo', 'hbr')]
+    fnirs_info = mne.create_info(fnirs_names, settings['fnirs_sfreq'], ['hbo', 'hbr'] * settings['n_fnirs_pairs'])
+    fnirs_raw = mne.io.RawArray(simulation['fnirs'], fnirs_info, verbose='error')
+    fnirs_raw.set_meas_date(meas_date + timedelta(seconds=settings['fnirs_start_offset']))
+    fnirs_path = os.path.join(fnirs_dir, f"{stem}_fnirs_raw.fif")
+    fnirs_raw.save(fnirs_path, overwrite=True, verbose='error')
+
+    ground_truth = dict(simulation['ground_truth'], subject=subject_id, seed=seed, subject_index=subject_index,
+                        eeg_mixing=simulation['ground_truth']['eeg_mixing'].tolist(),
+                        fnirs_weights=simulation['ground_truth']['fnirs_weights'].tolist())
+    with open(os.path.join(eeg_dir, f"{stem}_ground_truth.json"), 'w') as f:
+        json.dump(ground_truth, f, indent=2)
+
+    return {'subject': subject_id, 'eeg_path': eeg_path, 'fnirs_path': fnirs_path}
+
+
+def generate_dataset(n_subjects, output_root=None, settings=None, seed=0, subject_prefix='SYN', first_index=0,
+                     n_jobs=1, register=True, db_file=None):
+    """
+    Generate synthetic subjects in the project layout and register them as pairs.
+
+    Parameters
+    ----------
+    n_subjects : int
+        Number of subjects
+    output_root : str, optional
+        Root directory. Defaults to DATA_ROOT/synthetic.
+    settings : dict, optional
+        Overrides of DEFAULT_SETTINGS
+    seed : int, optional
+        Base seed; subject i uses SeedSequence(seed, spawn_key=(i,))
+    subject_prefix : str, optional
+        Subject IDs are <prefix><index:03d>
+    first_index : int, optional
+        Index of the first subject (to extend an existing dataset)
+    n_jobs : int, optional
+        Number of worker processes
+    register : bool, optional
+        Whether to add the pairs to the pair database
+    db_file : str, optional
+        Pair database. If None, uses the default database.
+
+    Returns
+    -------
+    list
+        Pair dictionaries with 'eeg_path', 'fnirs_path' and 'metadata'
+    """
+    from io_mgmt.make_pairs import describe_pairs_headless
+    from io_mgmt.pairs_db import open_pair_database
+
+    output_root = output_root or DEFAULT_OUTPUT_ROOT
+    settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+    for field, options in (('noise_level', NOISE_LEVELS), ('coupling_strength', COUPLING_STRENGTHS)):
+        if settings[field] not in options:
+            raise ValueError(f"Unknown {field} '{settings[field]}'. Use one of {list(options)}")
+
+    tasks = [(f"{subject_prefix}{index:03d}", index, output_root, settings, seed)
+             for index in range(first_index, first_index + n_subjects)]
+    if n_jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            written = list(pool.map(_write_subject, tasks))
+    else:
+        written = [_write_subject(task) for task in tasks]
+
+    manual_fields = {field: settings.get(field, '') for field in SYNTHETIC_DATA_METADATA['manual']}
+    manual_fields['description'] = f"Generated with data/synthetic.py (seed {seed})"
+    pairs = []
+    for recording in written:
+        pairs.extend(describe_pairs_headless([recording], recording['subject'], SYNTHETIC_DATA_METADATA['type'],
+                                             manual_fields=manual_fields))
+
+    if register:
+        with open_pair_database(db_file) as db:
+            inserted = db.add_pairs(pairs)
+        print(f"Registered {inserted} of {len(pairs)} synthetic pairs in {db.db_file}")
+    return pairs
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate synthetic EEG-fNIRS subjects with known coupling.")
+    parser.add_argument('n_subjects', type=int, help="Number of subjects")
+    parser.add_argument('--output-root', default=None, help="Root directory (default: data/synthetic)")
+    parser.add_argument('--seed', type=int, default=0, help="Base random seed")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes")
+    parser.add_argument('--duration', type=float, default=DEFAULT_SETTINGS['duration'], help="Seconds per recording")
+    parser.add_argument('--activity', default=DEFAULT_SETTINGS['simulated_activity'],
+                        choices=SYNTHETIC_DATA_METADATA['manual']['simulated_activity'])
+    parser.add_argument('--noise-level', default=DEFAULT_SETTINGS['noise_level'], choices=list(NOISE_LEVELS))
+    parser.add_argument('--coupling-strength', default=DEFAULT_SETTINGS['coupling_strength'],
+                        choices=list(COUPLING_STRENGTHS))
+    parser.add_argument('--delay-seconds', type=float, default=DEFAULT_SETTINGS['delay_seconds'])
+    parser.add_argument('--no-register', action='store_true', help="Do not add the pairs to the pair database")
+    parser.add_argument('--db', default=None, help="Pair database file")
+    args = parser.parse_args()
+
+    generate_dataset(args.n_subjects, args.output_root,
+                     settings={'duration': args.duration, 'simulated_activity': args.activity,
+                               'noise_level': args.noise_level, 'coupling_strength': args.coupling_strength,
+                               'delay_seconds': args.delay_seconds},
+                     seed=args.seed, n_jobs=args.workers, register=not args.no_register, db_file=args.db)
@@ -0,0 +1,258 @@
+"""
+Standardize annotations of combined recordings (step 3 in io_cli.py).
+
+A rule table (exact names, regular expressions, numeric trigger codes) is
+compiled once into a lookup. Per recording, rules are only evaluated for the
+distinct descriptions; relabeling, onset shifts and merging of close
+annotations with the same label are then NumPy array operations over all
+annotations at once.
+
+The original annotations are kept in the sidecar under 'annotations_raw', so
+a recording can be re-standardized whenever the convention changes.
+"""
+
+import os
+import re
+import json
+
+import numpy as np
+
+from config.parameters import ANNOTATION_STANDARD
+from utils.instrumentation import instrumented
+
+# Descriptions that are a trigger code only, e.g. '1', '1.0', 'S  1', 'Stimulus/S  1'; numbers inside
+# other descriptions ('Rest_block1', 'BAD_acq 1') are not trigger codes
+TRIGGER_CODE_PATTERN = re.compile(r'^\s*(?:Stimulus/)?(?:S\s*)?(\d+(?:\.\d+)?)\s*$')
+
+
+class AnnotationRuleTable:
+    """
+    Compiled lookup from annotation descriptions to standard labels.
+
+    Rules are tried in the order exact name, numeric trigger code, regular
+    expression (regular expressions in the order given).
+
+    Parameters
+    ----------
+    rules : list
+        [{'type': 'exact' | 'regex' | 'code', 'pattern': ..., 'label': str}, ...]
+    """
+
+    def __init__(self, rules):
+        self.exact = {}
+        self.codes = {}
+        self.regexes = []
+        for rule in rules:
+            if rule['type'] == 'exact':
+                self.exact.setdefault(rule['pattern'], rule['label'])
+            elif rule['type'] == 'code':
+                self.codes.setdefault(float(rule['pattern']), rule['label'])
+            elif rule['type'] == 'regex':
+                self.regexes.append((re.compile(rule['pattern']), rule['label']))
+            else:
+                raise ValueError(f"Unknown annotation rule type: {rule['type']}")
+        self._cache = {}
+
+    def lookup(self, description):
+        """Return the standard label of a description, or None if no rule matches."""
+        if description in self._cache:
+            return self._cache[description]
+        label = self.exact.get(description)
+        if label is None and self.codes:
+            code_match = TRIGGER_CODE_PATTERN.match(description)
+            if code_match:
+                label = self.codes.get(float(code_match.group(1)))
+        if label is None:
+            label = next((lbl for regex, lbl in self.regexes if regex.search(description)), None)
+        self._cache[description] = label
+        return label
+
+
+def compile_annotation_rules(rules=None):
+    """
+    Compile a rule table into a lookup.
+
+    Parameters
+    ----------
+    rules : list, optional
+        Rule dictionaries. If None, uses ANNOTATION_STANDARD['rules'].
+
+    Returns
+    -------
+    AnnotationRuleTable
+        Compiled rule table
+    """
+    return AnnotationRuleTable(ANNOTATION_STANDARD['rules'] if rules is None else rules)
+
+
+def _empty_annotations():
+    """Return the standardize_annotations result without any annotations."""
+    return {'onset': np.array([], dtype=float), 'duration': np.array([], dtype=float),
+            'description': np.array([], dtype=object), 'source': np.array([], dtype=object)}
+
+
+def standardize_annotations(onsets, durations, descriptions, table, sources=None, onset_shift=None,
+                            merge_window=None, keep_unmatched=None):
+    """
+    Relabel, shift and merge the annotations of one recording.
+
+    Parameters
+    ----------
+    onsets, durations : array-like
+        Onsets and durations in seconds
+    descriptions : array-like of str
+        Original descriptions
+    table : AnnotationRuleTable
+        Compiled rule table
+    sources : array-like of str, optional
+        Recording each annotation came from (e.g., 'eeg', 'fnirs')
+    onset_shift : dict, optional
+        Standard label -> onset shift in seconds. Defaults to ANNOTATION_STANDARD.
+    merge_window : float, optional
+        Annotations with the same label closer than this (seconds) are merged
+        into one spanning all of them. Defaults to ANNOTATION_STANDARD.
+    keep_unmatched : bool, optional
+        Keep unmatched annotations under their original description instead of
+        dropping them. Defaults to ANNOTATION_STANDARD.
+
+    Returns
+    -------
+    dict
+        {'onset': ndarray, 'duration': ndarray, 'description': ndarray, 'source': ndarray},
+        sorted by onset. Merged annotations from several sources get source 'merged'.
+    """
+    onset_shift = ANNOTATION_STANDARD['onset_shift'] if onset_shift is None else onset_shift
+    merge_window = ANNOTATION_STANDARD['merge_window'] if merge_window is None else merge_window
+    keep_unmatched = ANNOTATION_STANDARD['keep_unmatched'] if keep_unmatched is None else keep_unmatched
+
+    onsets = np.asarray(onsets, dtype=float)
+    durations = np.asarray(durations, dtype=float)
+    descriptions = np.asarray(descriptions, dtype=str)
+    sources = np.full(len(onsets), '', dtype=object) if sources is None else np.asarray(sources, dtype=object)
+    if len(onsets) == 0:
+        return _empty_annotations()
+
+    # Rules are evaluated once per distinct description
+    unique_descriptions, inverse = np.unique(descriptions, return_inverse=True)
+    unique_labels = np.array([table.lookup(d) for d in unique_descriptions], dtype=object)
+    unique_matched = np.array([label is not None for label in unique_labels])
+    labels = unique_labels[inverse]
+    matched = unique_matched[inverse]
+    if keep_unmatched:
+        labels = np.where(matched, labels, descriptions.astype(object))
+    else:
+        onsets, durations, labels, sources = onsets[matched], durations[matched], labels[matched], sources[matched]
+        if len(onsets) == 0:
+            return _empty_annotations()
+
+    # Onset shifts per standard label
+    unique_labels, label_ids = np.unique(labels.astype(str), return_inverse=True)
+    shifts = np.array([onset_shift.get(label, 0.0) for label in unique_labels])
+    onsets = onsets + shifts[label_ids]
+
+    # Merge runs of the same label whose onsets are within merge_window of the previous one
+    order = np.lexsort((onsets, label_ids))
+    onsets, durations, label_ids, sources = onsets[order], durations[order], label_ids[order], sources[order]
+    new_group = np.ones(len(onsets), dtype=bool)
+    new_group[1:] = (label_ids[1:] != label_ids[:-1]) | (np.diff(onsets) > merge_window)
+    group_starts = np.flatnonzero(new_group)
+    merged_onsets = onsets[group_starts]
+    merged_ends = np.maximum.reduceat(onsets + durations, group_starts)
+    source_ids = np.unique(sources.astype(str), return_inverse=True)[1]
+    mixed = np.minimum.reduceat(source_ids, group_starts) != np.maximum.reduceat(source_ids, group_starts)
+    merged_sources = np.where(mixed, 'merged', sources[group_starts]).astype(object)
+
+    order = np.argsort(merged_onsets, kind='stable')
+    return {
+        'onset': merged_onsets[order],
+        'duration': (merged_ends - merged_onsets)[order],
+        'description': unique_labels[label_ids[group_starts]][order].astype(object),
+        'source': merged_sources[order]
+    }
+
+
+@instrumented('standardize_sidecar')
+def standardize_sidecar(sidecar_path, table=None, **kwargs):
+    """
+    Standardize the annotations stored in the JSON sidecar of a combined recording.
+
+    The original annotations are moved to 'annotations_raw' on the first call
+    and are the input of every later call.
+
+    Parameters
+    ----------
+    sidecar_path : str
+        Path to the .json sidecar written by combine_fnirs_eeg
+    table : AnnotationRuleTable, optional
+        Compiled rule table. If None, compiles ANNOTATION_STANDARD['rules'].
+    **kwargs
+        Passed to standardize_annotations
+
+    Returns
+    -------
+    int
+        Number of annotations after standardization
+    """
+    table = table or compile_annotation_rules()
+    with open(sidecar_path, 'r') as f:
+        sidecar = json.load(f)
+    raw_annotations = sidecar.setdefault('annotations_raw', sidecar.get('annotations', []))
+
+    standardized = standardize_annotations(
+        [annot['onset'] for annot in raw_annotations],
+        [annot['duration'] for annot in raw_annotations],
+        [annot['description'] for annot in raw_annotations],
+        table,
+        sources=[annot.get('source', '') for annot in raw_annotations],
+        **kwargs
+    )
+    sidecar['annotations'] = [
+        {'onset': float(onset), 'duration': float(duration), 'description': str(description), 'source': str(source)}
+        for onset, duration, description, source in zip(standardized['onset'], standardized['duration'],
+                                                        standardized['description'], standardized['source'])
+    ]
+
+    tmp_file = f"{sidecar_path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(sidecar, f, indent=2)
+    os.replace(tmp_file, sidecar_path)
+    return len(sidecar['annotations'])
+
+
+@instrumented('standardize_pairs')
+def standardize_pairs(db_file=None, output_dir=None, rules=None, **kwargs):
+    """
+    Standardize the annotations of every combined recording in the pair database.
+
+    Parameters
+    ----------
+    db_file : str, optional
+        Pair database (SQLite or legacy .json). If None, uses the default database.
+    output_dir : str, optional
+        Root directory of combined recordings
+    rules : list, optional
+        Rule dictionaries. If None, uses ANNOTATION_STANDARD['rules'].
+    **kwargs
+        Passed to standardize_annotations
+
+    Returns
+    -------
+    dict
+        {'standardized': [sidecar paths], 'missing': [sidecar paths]}
+    """
+    from io_mgmt.pairs_db import load_pairs
+    from io_mgmt.combine_fnirs_eeg import combined_output_path
+
+    table = compile_annotation_rules(rules)
+    results = {'standardized': [], 'missing': []}
+    for pair in load_pairs(db_file):
+        sidecar_path = os.path.splitext(combined_output_path(pair, output_dir))[0] + '.json'
+        if not os.path.exists(sidecar_path):
+            results['missing'].append(sidecar_path)
+            continue
+        standardize_sidecar(sidecar_path, table, **kwargs)
+        results['standardized'].append(sidecar_path)
+
+    print(f"Standardized annotations of {len(results['standardized'])} recordings "
+          f"({len(results['missing'])} not combined yet)")
+    return results
@@ -0,0 +1,294 @@
+"""
+Combine paired EEG and fNIRS recordings into one dataset (step 2 in io_cli.py).
+
+Raw NIRx light intensities ('fnirs_cw_amplitude') are first converted to
+optical density and, with the modified Beer-Lambert law, to HbO/HbR
+concentration changes, the channel types every later stage analyses. This
+loads the fNIRS recording at its native rate, which is small next to the EEG.
+
+Both recordings are read in bounded time chunks, resampled to
+COMBINE_PARAMS['resample_to'], aligned on their measurement start times (NIRx
+local clock times converted to UTC with RECORDING_CLOCKS['nirx_timezone']) and
+written chunk by chunk, so peak memory depends on the chunk size and not on
+the recording length.
+
+Each combined recording is stored in the chunked format of
+io_mgmt.combined_format: <name>.nvc holding the EEG and the fNIRS channels as
+two groups of time-chunked blocks, and a <name>.json sidecar holding channel
+info, sampling rate, annotations, the pair metadata and the storage layout.
+"""
+
+import os
+import math
+from datetime import datetime, timezone
+
+import numpy as np
+
+from config.data_paths_and_config import INTERNAL_DATA_PATHS
+from config.parameters import COMBINE_PARAMS
+from io_mgmt.combined_format import DATA_EXTENSION, CombinedWriter, write_sidecar
+from preprocessing.resample import ChunkedResampler
+from utils.instrumentation import instrumented
+
+DEFAULT_CHUNK_SECONDS = 60.0
+EEG_EXTENSIONS = ('.fif.gz', '.fif')
+
+
+def _is_fif(path):
+    """Return True for .fif files (optionally gzipped); other recordings are NIRx folders."""
+    return path.endswith(EEG_EXTENSIONS)
+
+
+def open_raw(path):
+    """
+    Open an EEG .fif file or a NIRx folder without loading its data.
+
+    Parameters
+    ----------
+    path : str
+        Path to a .fif file, a NIRx folder or a file inside a NIRx folder
+
+    Returns
+    -------
+    mne.io.Raw
+        Raw object with preload=False
+    """
+    import mne
+
+    if _is_fif(path):
+        return mne.io.read_raw_fif(path, preload=False, verbose='error')
+    folder = path if os.path.isdir(path) else os.path.dirname(path)
+    return mne.io.read_raw_nirx(folder, preload=False, verbose='error')
+
+
+def hemoglobin_raw(raw, ppf=None):
+    """
+    Convert raw intensity or optical density fNIRS channels to HbO/HbR.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        fNIRS recording
+    ppf : float, optional
+        Partial pathlength factor. Defaults to COMBINE_PARAMS['beer_lambert']['ppf'].
+
+    Returns
+    -------
+    mne.io.Raw
+        raw itself if it already holds HbO/HbR, otherwise a converted copy
+    """
+    from mne.preprocessing.nirs import optical_density, beer_lambert_law
+
+    ch_types = set(raw.get_channel_types())
+    if 'fnirs_cw_amplitude' in ch_types:
+        raw = optical_density(raw, verbose='error')
+    elif 'fnirs_od' not in ch_types:
+        return raw
+    return beer_lambert_law(raw, ppf=ppf or COMBINE_PARAMS['beer_lambert']['ppf'])
+
+
+def raw_resampler(raw, sfreq_out):
+    """Return a ChunkedResampler reading a raw opened with preload=False."""
+    def read(start, stop):
+        return raw.get_data(start=start, stop=stop)
+    return ChunkedResampler(read, raw.n_times, raw.info['sfreq'], sfreq_out)
+
+
+def _start_time(raw, local_clock=False):
+    """
+    Return the POSIX time of the first sample of a raw, or None without a measurement date.
+
+    With local_clock, meas_date is a local wall-clock time that MNE stamped as
+    UTC (NIRx headers) and is converted with recording_metadata.nirx_local_to_utc.
+    """
+    from io_mgmt.recording_metadata import nirx_local_to_utc
+
+    meas_date = raw.info['meas_date']
+    if meas_date is None:
+        return None
+    if local_clock:
+        meas_date = nirx_local_to_utc(meas_date)
+    return meas_date.timestamp() + raw.first_time
+
+
+def _annotations_relative_to_start(raw):
+    """Return annotation onsets (seconds from the first sample), durations and descriptions."""
+    annotations = raw.annotations
+    onsets = np.asarray(annotations.onset, dtype=float)
+    if annotations.orig_time is not None:
+        # Onsets are relative to the measurement date, the data starts first_time later
+        onsets = onsets - raw.first_time
+    return onsets, np.asarray(annotations.duration, dtype=float), list(annotations.description)
+
+
+def combined_output_path(pair, output_dir=None):
+    """
+    Return the data file path a pair is combined into.
+
+    Parameters
+    ----------
+    pair : dict
+        Pair dictionary with 'eeg_path' and 'metadata'
+    output_dir : str, optional
+        Root directory. If None, uses INTERNAL_DATA_PATHS['motor_data_combined_sorted_annotations'].
+
+    Returns
+    -------
+    str
+        <output_dir>/<subject>/<subject>_<eeg name>.nvc
+    """
+    output_dir = output_dir or INTERNAL_DATA_PATHS['motor_data_combined_sorted_annotations']
+    subject = pair.get('metadata', {}).get('auto', {}).get('subject') or 'unknown'
+    eeg_name = os.path.basename(os.path.normpath(pair['eeg_path']))
+    # Strip only the recording extension; dots inside the name distinguish runs
+    eeg_stem = next((eeg_name[:-len(ext)] for ext in EEG_EXTENSIONS if eeg_name.endswith(ext)), eeg_name)
+    return os.path.join(output_dir, subject, f"{subject}_{eeg_stem}{DATA_EXTENSION}")
+
+
+@instrumented('combine_pair',
+              subject=lambda pair, *args, **kwargs: pair.get('metadata', {}).get('auto', {}).get('subject'))
+def combine_pair(pair, output_path=None, sfreq_out=None, chunk_seconds=DEFAULT_CHUNK_SECONDS, dtype=None):
+    """
+    Combine one EEG-fNIRS pair into a single resampled, aligned recording.
+
+    Parameters
+    ----------
+    pair : dict
+        Pair dictionary with 'eeg_path', 'fnirs_path' and 'metadata'
+    output_path : str, optional
+        Output .nvc path. If None, uses combined_output_path(pair).
+    sfreq_out : float, optional
+        Target sampling rate. If None, uses COMBINE_PARAMS['resample_to'].
+    chunk_seconds : float, optional
+        Length of the time chunks that are read and written at once
+    dtype : str, optional
+        'float32' or 'float64' storage. Defaults to COMBINE_PARAMS['storage']['dtype'].
+
+    Returns
+    -------
+    str
+        Path of the written .nvc file
+    """
+    sfreq_out = sfreq_out or COMBINE_PARAMS['resample_to']
+    output_path = output_path or combined_output_path(pair)
+
+    paths = {'eeg': pair['eeg_path'], 'fnirs': pair['fnirs_path']}
+    raws = {name: open_raw(path) for name, path in paths.items()}
+    raws['fnirs'] = hemoglobin_raw(raws['fnirs'])
+    eeg_raw, fnirs_raw = raws['eeg'], raws['fnirs']
+    streams = {name: raw_resampler(raw, sfreq_out) for name, raw in raws.items()}
+
+    # Align both recordings on their absolute start times
+    starts = {name: _start_time(raw, local_clock=not _is_fif(paths[name])) for name, raw in raws.items()}
+    has_dates = None not in starts.values()
+    if not has_dates:
+        print("Warning: Missing measurement date, assuming both recordings start simultaneously")
+        starts = {name: 0.0 for name in raws}
+    t_start = max(starts.values())
+    t_stop = min(starts[name] + raw.n_times / raw.info['sfreq'] for name, raw in raws.items())
+    if t_stop <= t_start:
+        raise ValueError(f"EEG and fNIRS recordings do not overlap in time: {pair['eeg_path']}, {pair['fnirs_path']}")
+
+    offsets = {name: int(round((t_start - starts[name]) * sfreq_out)) for name in raws}
+    n_times = int(math.floor((t_stop - t_start) * sfreq_out))
+    n_times = min([n_times] + [streams[name].n_times - offsets[name] for name in raws])
+
+    ch_names = eeg_raw.ch_names + fnirs_raw.ch_names
+    ch_types = eeg_raw.get_channel_types() + fnirs_raw.get_channel_types()
+    n_eeg = len(eeg_raw.ch_names)
+
+    groups = {'eeg': range(n_eeg), 'fnirs': range(n_eeg, len(ch_names))}
+    chunk_samples = max(1, int(chunk_seconds * sfreq_out))
+    with CombinedWriter(output_path, groups, n_times, sfreq_out, dtype=dtype) as combined:
+        for start in range(0, n_times, chunk_samples):
+            stop = min(start + chunk_samples, n_times)
+            for name in groups:
+                combined.write(name, start, streams[name].read(start + offsets[name], stop + offsets[name]))
+
+    # Annotations of both recordings on the combined time axis
+    annotations = []
+    for name, raw in raws.items():
+        onsets, durations, descriptions = _annotations_relative_to_start(raw)
+        onsets = onsets + (starts[name] - t_start)
+        for onset, duration, description in zip(onsets, durations, descriptions):
+            if 0 <= onset < n_times / sfreq_out:
+                annotations.append({'onset': float(onset), 'duration': float(duration),
+                                    'description': description, 'source': name})
+    annotations.sort(key=lambda annot: annot['onset'])
+
+    sidecar = {
+        'sfreq': sfreq_out,
+        'n_times': n_times,
+        'ch_names': ch_names,
+        'ch_types': ch_types,
+        'meas_date': datetime.fromtimestamp(t_start, tz=timezone.utc).isoformat() if has_dates else None,
+        'annotations': annotations,
+        'pair': pair,
+        'source_sfreq': {name: raw.info['sfreq'] for name, raw in raws.items()},
+        'storage': combined.layout
+    }
+    write_sidecar(output_path, sidecar)
+
+    return output_path
+
+
+@instrumented('combine_pairs')
+def combine_pairs(db_file=None, output_dir=None, sfreq_out=None, chunk_seconds=DEFAULT_CHUNK_SECONDS, overwrite=False,
+                  dtype=None):
+    """
+    Combine every pair in the pair database, continuing past failing pairs.
+
+    Parameters
+    ----------
+    db_file : str, optional
+        Pair database (SQLite or legacy .json). If None, uses the default database.
+    output_dir : str, optional
+        Root directory for combined recordings
+    sfreq_out : float, optional
+        Target sampling rate. If None, uses COMBINE_PARAMS['resample_to'].
+    chunk_seconds : float, optional
+        Length of the time chunks that are read and written at once
+    overwrite : bool, optional
+        Whether to recombine pairs whose output already exists
+    dtype : str, optional
+        'float32' or 'float64' storage. Defaults to COMBINE_PARAMS['storage']['dtype'].
+
+    Returns
+    -------
+    dict
+        {'combined': [paths], 'skipped': [paths], 'failed': [(pair, error message)]}
+    """
+    from io_mgmt.pairs_db import load_pairs
+
+    results = {'combined': [], 'skipped': [], 'failed': []}
+    for pair in load_pairs(db_file):
+        output_path = combined_output_path(pair, output_dir)
+        if os.path.exists(output_path) and not overwrite:
+            results['skipped'].append(output_path)
+            continue
+        try:
+            combine_pair(pair, output_path, sfreq_out=sfreq_out, chunk_seconds=chunk_seconds, dtype=dtype)
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f"Failed to combine {os.path.basename(pair['eeg_path'])}: {e}")
+            results['failed'].append((pair, str(e)))
+            continue
+        results['combined'].append(output_path)
+        print(f"Combined {os.path.basename(output_path)}")
+
+    print(f"\nCombined {len(results['combined'])} pairs, skipped {len(results['skipped'])}, failed {len(results['failed'])}")
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Combine all EEG-fNIRS pairs of the pair database.")
+    parser.add_argument('--db', default=None, help="Pair database file")
+    parser.add_argument('--output-dir', default=None, help="Root directory for combined recordings")
+    parser.add_argument('--chunk-seconds', type=float, default=DEFAULT_CHUNK_SECONDS, help="Chunk length in seconds")
+    parser.add_argument('--overwrite', action='store_true', help="Recombine existing outputs")
+    parser.add_argument('--dtype', choices=['float32', 'float64'], default=None, help="Storage sample type")
+    args = parser.parse_args()
+
+    combine_pairs(args.db, args.output_dir, chunk_seconds=args.chunk_seconds, overwrite=args.overwrite,
+                  dtype=args.dtype)
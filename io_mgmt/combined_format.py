@@ -0,0 +1,353 @@
+"""
+On-disk format of combined EEG-fNIRS recordings.
+
+A combined recording is two files with the same stem:
+
+    <name>.nvc   samples, raw little-endian float32 or float64, no header
+    <name>.json  sidecar: sampling rate, channel names and types,
+                 annotations, pair metadata and the 'storage' layout
+
+Channels are stored in groups (the EEG and the fNIRS channels of a pair).
+Each group occupies one contiguous region of the data file holding an array
+of shape (n_chunks, n_group_channels, chunk_samples) in C order: the
+recording is cut into time chunks of COMBINE_PARAMS['storage']['chunk_seconds']
+and within a chunk every channel is one contiguous run of samples. The last
+chunk is zero-padded. Each region opens directly with numpy.memmap from the
+offset and shape in the sidecar, so reading a time window of a few channels
+touches only those channels' runs in the chunks the window overlaps, e.g.
+10 s of 4 fNIRS channels of a 2-hour recording reads 4 runs of 10 s.
+
+CombinedRecording reads the format lazily and indexes like a
+(n_channels, n_times) array (data[picks, start:stop], data[rows, t],
+data[rows]). It is not an ndarray: anything that converts it with
+np.asarray (including numpy.lib.stride_tricks views) reads the whole
+recording into memory, so windowed code should read through
+data.read(start, stop), as preprocessing.epochs.EpochView does. open_combined
+also opens combined recordings written as .npy before this format existed.
+"""
+
+import os
+import json
+
+import numpy as np
+
+from config.parameters import COMBINE_PARAMS
+
+FORMAT_NAME = 'nvc-chunked'
+FORMAT_VERSION = 1
+DATA_EXTENSION = '.nvc'
+STORAGE_DTYPES = {'float32': '<f4', 'float64': '<f8'}
+
+
+def sidecar_path(data_path):
+    """Return the .json sidecar path of a combined recording."""
+    return os.path.splitext(data_path)[0] + '.json'
+
+
+def read_sidecar(data_path):
+    """Read the sidecar of a combined recording."""
+    with open(sidecar_path(data_path), 'r') as f:
+        return json.load(f)
+
+
+def write_sidecar(data_path, sidecar):
+    """Write the sidecar of a combined recording atomically."""
+    path = sidecar_path(data_path)
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(sidecar, f, indent=2)
+    os.replace(tmp_file, path)
+
+
+def storage_layout(groups, n_times, sfreq, dtype=None, chunk_seconds=None, data_file=None):
+    """
+    Byte layout of the channel groups of a combined recording.
+
+    Parameters
+    ----------
+    groups : dict
+        Group name -> channel indices (rows of the combined recording), in file order
+    n_times : int
+        Number of samples
+    sfreq : float
+        Sampling rate in Hz
+    dtype : str, optional
+        'float32' or 'float64'. Defaults to COMBINE_PARAMS['storage']['dtype'].
+    chunk_seconds : float, optional
+        Chunk length. Defaults to COMBINE_PARAMS['storage']['chunk_seconds'].
+    data_file : str, optional
+        Base name of the data file, recorded in the layout
+
+    Returns
+    -------
+    dict
+        The sidecar 'storage' entry: format, version, dtype, chunk_samples and
+        per group the channels, byte offset and memmap shape
+    """
+    params = COMBINE_PARAMS['storage']
+    dtype = dtype or params['dtype']
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError(f"Unknown storage dtype '{dtype}'. Available: {', '.join(STORAGE_DTYPES)}")
+    chunk_samples = max(1, int(round((chunk_seconds or params['chunk_seconds']) * sfreq)))
+    n_chunks = -(-n_times // chunk_samples)
+    itemsize = np.dtype(STORAGE_DTYPES[dtype]).itemsize
+
+    layout = {'format': FORMAT_NAME, 'version': FORMAT_VERSION, 'data_file': data_file, 'dtype': dtype,
+              'n_times': int(n_times), 'chunk_samples': chunk_samples, 'groups': []}
+    offset = 0
+    for name, channels in groups.items():
+        channels = [int(channel) for channel in channels]
+        shape = [n_chunks, len(channels), chunk_samples]
+        layout['groups'].append({'name': name, 'channels': channels, 'offset': offset, 'shape': shape})
+        offset += int(np.prod(shape)) * itemsize
+    layout['n_bytes'] = offset
+    return layout
+
+
+def _open_group(data_path, layout, group, mode):
+    return np.memmap(data_path, dtype=STORAGE_DTYPES[layout['dtype']], mode=mode,
+                     offset=group['offset'], shape=tuple(group['shape']))
+
+
+def _chunk_spans(start, stop, chunk_samples):
+    """Yield (chunk, first sample in chunk, last sample in chunk, position in window) covering [start, stop)."""
+    for chunk in range(start // chunk_samples, (stop - 1) // chunk_samples + 1):
+        chunk_start = chunk * chunk_samples
+        first = max(start, chunk_start) - chunk_start
+        last = min(stop, chunk_start + chunk_samples) - chunk_start
+        yield chunk, first, last, chunk_start + first - start
+
+
+class CombinedWriter:
+    """
+    Write a combined recording group by group and window by window.
+
+    Samples go to a temporary file next to data_path that replaces it on
+    close, so an existing recording stays intact while it is rewritten. Its
+    sidecar, which no longer describes the new data, is removed at the same
+    time; the caller writes the new one with write_sidecar. If the with-block
+    raises, the temporary file is deleted and the old recording kept.
+
+    Parameters
+    ----------
+    data_path : str
+        Output .nvc path
+    groups : dict
+        Group name -> channel indices, in file order
+    n_times : int
+        Number of samples
+    sfreq : float
+        Sampling rate in Hz
+    dtype, chunk_seconds : optional
+        As in storage_layout
+    """
+
+    def __init__(self, data_path, groups, n_times, sfreq, dtype=None, chunk_seconds=None):
+        self.data_path = data_path
+        self.layout = storage_layout(groups, n_times, sfreq, dtype, chunk_seconds,
+                                     data_file=os.path.basename(data_path))
+        os.makedirs(os.path.dirname(os.path.abspath(data_path)), exist_ok=True)
+        self.tmp_file = f"{data_path}.{os.getpid()}.tmp"
+        with open(self.tmp_file, 'wb') as f:
+            f.truncate(self.layout['n_bytes'])
+        self._groups = {group['name']: _open_group(self.tmp_file, self.layout, group, 'r+')
+                        for group in self.layout['groups'] if group['shape'][0] and group['shape'][1]}
+
+    def write(self, group, start, values):
+        """
+        Write samples of all channels of one group.
+
+        Parameters
+        ----------
+        group : str
+            Group name
+        start : int
+            First sample of the window
+        values : ndarray, shape (n_group_channels, n_samples)
+            Samples, converted to the storage dtype
+        """
+        if group not in self._groups:
+            return
+        values = np.asarray(values)
+        stop = start + values.shape[-1]
+        if start < 0 or stop > self.layout['n_times']:
+            raise ValueError(f"Window [{start}, {stop}) outside the recording of {self.layout['n_times']} samples")
+        blocks = self._groups[group]
+        for chunk, first, last, position in _chunk_spans(start, stop, self.layout['chunk_samples']):
+            blocks[chunk, :, first:last] = values[:, position:position + last - first]
+
+    def close(self):
+        """Flush the samples and move them into place, removing the outdated sidecar."""
+        if self.tmp_file is None:
+            return
+        for blocks in self._groups.values():
+            blocks.flush()
+        self._groups = {}
+        if os.path.exists(sidecar_path(self.data_path)):
+            os.remove(sidecar_path(self.data_path))
+        os.replace(self.tmp_file, self.data_path)
+        self.tmp_file = None
+
+    def abort(self):
+        """Discard the samples written so far and keep any existing recording."""
+        self._groups = {}
+        if self.tmp_file is not None and os.path.exists(self.tmp_file):
+            os.remove(self.tmp_file)
+        self.tmp_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CombinedRecording:
+    """
+    Lazy (n_channels, n_times) view of a combined recording.
+
+    Indexing with rows only (data[rows]) returns another lazy view; indexing
+    with rows and a time slice (data[rows, start:stop]) reads just those
+    samples and returns an ndarray in the storage dtype.
+
+    Parameters
+    ----------
+    data_path : str
+        Path of the .nvc data file
+    sidecar : dict, optional
+        Sidecar contents, if already read
+    """
+
+    def __init__(self, data_path, sidecar=None, _picks=None, _groups=None):
+        self.data_path = data_path
+        self.sidecar = sidecar or read_sidecar(data_path)
+        self.layout = self.sidecar.get('storage') or {}
+        if self.layout.get('format') != FORMAT_NAME:
+            raise ValueError(f"{sidecar_path(data_path)} does not describe a '{FORMAT_NAME}' recording")
+        if self.layout['version'] > FORMAT_VERSION:
+            raise ValueError(f"Unsupported {FORMAT_NAME} version {self.layout['version']} of {data_path}")
+        self.n_channels_total = sum(len(group['channels']) for group in self.layout['groups'])
+        self._picks = np.arange(self.n_channels_total) if _picks is None else _picks
+        self._groups = _groups if _groups is not None else {}
+
+    def __repr__(self):
+        return f"CombinedRecording({self.data_path!r}, shape={self.shape}, dtype={self.layout['dtype']})"
+
+    @property
+    def sfreq(self):
+        return self.sidecar['sfreq']
+
+    @property
+    def ch_names(self):
+        return [self.sidecar['ch_names'][channel] for channel in self._picks]
+
+    @property
+    def ch_types(self):
+        return [self.sidecar['ch_types'][channel] for channel in self._picks]
+
+    @property
+    def shape(self):
+        return (len(self._picks), self.layout['n_times'])
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def dtype(self):
+        return np.dtype(STORAGE_DTYPES[self.layout['dtype']])
+
+    def __len__(self):
+        return len(self._picks)
+
+    def _blocks(self, index):
+        """Memory-map one group on first use."""
+        if index not in self._groups:
+            self._groups[index] = _open_group(self.data_path, self.layout, self.layout['groups'][index], 'r')
+        return self._groups[index]
+
+    def select(self, rows):
+        """Return a lazy view of some rows of this view."""
+        return CombinedRecording(self.data_path, self.sidecar, self._picks[rows], self._groups)
+
+    def read(self, start=0, stop=None, rows=None):
+        """
+        Read a time window of some channels.
+
+        Parameters
+        ----------
+        start, stop : int, optional
+            Sample window. Defaults to the whole recording.
+        rows : array-like of int, optional
+            Rows of this view. Defaults to all.
+
+        Returns
+        -------
+        ndarray, shape (n_rows, stop - start)
+            Samples in the storage dtype
+        """
+        stop = self.layout['n_times'] if stop is None else stop
+        picks = self._picks if rows is None else self._picks[np.asarray(rows, dtype=int)]
+        out = np.empty((len(picks), max(stop - start, 0)), dtype=self.dtype)
+        if stop <= start or not len(picks):
+            return out
+        chunk_samples = self.layout['chunk_samples']
+        for index, group in enumerate(self.layout['groups']):
+            group_rows = {channel: row for row, channel in enumerate(group['channels'])}
+            wanted = [(position, group_rows[channel]) for position, channel in enumerate(picks)
+                      if channel in group_rows]
+            if not wanted:
+                continue
+            positions, rows_in_group = (np.array(values) for values in zip(*wanted))
+            contiguous = np.all(np.diff(rows_in_group) == 1)
+            row_index = slice(rows_in_group[0], rows_in_group[-1] + 1) if contiguous else rows_in_group
+            blocks = self._blocks(index)
+            for chunk, first, last, position in _chunk_spans(start, stop, chunk_samples):
+                out[positions, position:position + last - first] = blocks[chunk, row_index, first:last]
+        return out
+
+    def __getitem__(self, key):
+        rows, times = key if isinstance(key, tuple) else (key, None)
+        if isinstance(rows, (int, np.integer)):
+            return self[[rows], slice(None) if times is None else times][0]
+        if times is None:
+            return self.select(rows)
+        local = np.arange(len(self._picks))[rows]
+        if isinstance(times, (int, np.integer)):
+            n_times = self.layout['n_times']
+            if not -n_times <= times < n_times:
+                raise IndexError(f"index {times} is out of bounds for axis 1 with size {n_times}")
+            times = int(times) % n_times
+            return self.read(times, times + 1, local)[:, 0]
+        if not isinstance(times, slice):
+            return self.read(rows=local)[:, times]
+        start, stop, step = times.indices(self.layout['n_times'])
+        if step != 1:
+            return self.read(rows=local)[:, times]
+        return self.read(start, stop, local)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.read()
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+
+def open_combined(data_path):
+    """
+    Open a combined recording without reading its samples.
+
+    Parameters
+    ----------
+    data_path : str
+        .nvc data file, or a legacy .npy combined recording
+
+    Returns
+    -------
+    CombinedRecording or numpy.memmap
+        (n_channels, n_times) array-like
+    """
+    if data_path.endswith('.npy'):
+        return np.load(data_path, mmap_mode='r')
+    return CombinedRecording(data_path)
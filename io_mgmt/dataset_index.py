@@ -0,0 +1,223 @@
+"""
+Persistent, incremental index of the EEG and fNIRS data trees.
+
+The index stores one listing per directory (file names, sizes, mtimes and the
+subject ID extracted from each name) together with the directory's own mtime.
+On later scans a directory is only re-listed if its mtime changed, so a warm
+rescan costs one stat per directory instead of one per file.
+"""
+
+import os
+import re
+import json
+import time
+import threading
+
+from config.data_paths_and_config import PROJECT_ROOT
+
+DEFAULT_INDEX_FILE = os.path.join(PROJECT_ROOT, "config", "dataset_index.json")
+DEFAULT_ID_PATTERN = r'([a-zA-Z0-9]+)'
+
+# Directories modified less than this many seconds ago are re-listed on the next
+# scan, since coarse mtime resolution on network shares can hide fresh changes
+MTIME_SETTLE_SECONDS = 2.0
+
+INDEX_VERSION = 1
+
+
+def extract_subject_id(name, id_pattern=None):
+    """
+    Extract a subject ID from a file or folder name.
+
+    Parameters
+    ----------
+    name : str
+        File or folder name (not a full path)
+    id_pattern : str, optional
+        Regular expression with one group capturing the ID.
+        If None, uses any alphanumeric sequence as ID.
+
+    Returns
+    -------
+    str or None
+        The extracted subject ID, or None if the pattern does not match
+    """
+    match = re.search(id_pattern or DEFAULT_ID_PATTERN, name)
+    return match.group(1) if match else None
+
+
+class DatasetIndex:
+    """
+    On-disk index of directory listings used to avoid re-walking the data trees.
+
+    Parameters
+    ----------
+    index_file : str, optional
+        Path to the JSON index file. If None, uses config/dataset_index.json.
+    id_pattern : str, optional
+        Regular expression used to extract subject IDs from entry names.
+    """
+
+    def __init__(self, index_file=None, id_pattern=None):
+        self.index_file = index_file or DEFAULT_INDEX_FILE
+        self.id_pattern = id_pattern or DEFAULT_ID_PATTERN
+        self.dirs = {}
+        self._dirty = False
+        # Guards self.dirs so one index can be shared by a thread pool
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Load the index from disk, starting empty if it is missing or unreadable."""
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, 'r') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            print(f"Warning: Could not read dataset index {self.index_file}, starting with empty index")
+            return
+        if data.get('version') != INDEX_VERSION:
+            return
+        self.dirs = data.get('dirs', {})
+        # Subject IDs are derived from names only, so a new pattern needs no stat calls
+        if data.get('id_pattern') != self.id_pattern:
+            for listing in self.dirs.values():
+                for name, info in listing['entries'].items():
+                    info['subject_id'] = extract_subject_id(name, self.id_pattern)
+            self._dirty = True
+
+    def save(self):
+        """Write the index to disk atomically if anything changed since the last save."""
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            data = {
+                'version': INDEX_VERSION,
+                'id_pattern': self.id_pattern,
+                'dirs': self.dirs
+            }
+            tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_file, self.index_file)
+            self._dirty = False
+
+    def _forget_subtree(self, path):
+        """Drop cached listings of a removed directory and everything below it."""
+        prefix = path + os.sep
+        for cached_path in [p for p in self.dirs if p == path or p.startswith(prefix)]:
+            del self.dirs[cached_path]
+
+    def listing(self, path):
+        """
+        Return the listing of a single directory, re-reading it only if its mtime changed.
+
+        Parameters
+        ----------
+        path : str
+            Directory to list
+
+        Returns
+        -------
+        dict
+            {name: {'is_dir': bool, 'size': int, 'mtime': int, 'subject_id': str or None}}
+            'size' and 'mtime' (in ns) are only present for files.
+        """
+        path = os.path.normpath(path)
+        dir_mtime = os.stat(path).st_mtime_ns
+        cached = self.dirs.get(path)
+        if cached is not None and cached['mtime'] == dir_mtime:
+            return cached['entries']
+
+        entries = {}
+        with os.scandir(path) as it:
+            for entry in it:
+                # is_dir/is_file use the d_type from readdir and need no extra stat
+                if entry.is_dir():
+                    info = {'is_dir': True}
+                elif entry.is_file():
+                    entry_stat = entry.stat()
+                    info = {'is_dir': False, 'size': entry_stat.st_size, 'mtime': entry_stat.st_mtime_ns}
+                else:
+                    continue
+                info['subject_id'] = extract_subject_id(entry.name, self.id_pattern)
+                entries[entry.name] = info
+
+        settled = time.time() - dir_mtime / 1e9 > MTIME_SETTLE_SECONDS
+        with self._lock:
+            if cached is not None:
+                for name, info in cached['entries'].items():
+                    if info['is_dir'] and not entries.get(name, {}).get('is_dir'):
+                        self._forget_subtree(os.path.join(path, name))
+            self.dirs[path] = {'mtime': dir_mtime if settled else None, 'entries': entries}
+            self._dirty = True
+        return entries
+
+    def subfolders(self, path):
+        """Return the sorted names of the direct subfolders of path."""
+        return sorted(name for name, info in self.listing(path).items() if info['is_dir'])
+
+    def subject_folders(self, path, id_pattern=None):
+        """
+        Map subject IDs to the subfolders of path they were extracted from.
+
+        Parameters
+        ----------
+        path : str
+            Directory containing one folder per subject
+        id_pattern : str, optional
+            Regular expression overriding the index pattern for this call
+
+        Returns
+        -------
+        dict
+            {subject_id: folder_path}
+        """
+        ids_to_folders = {}
+        for name, info in sorted(self.listing(path).items()):
+            if not info['is_dir']:
+                continue
+            if id_pattern is None or id_pattern == self.id_pattern:
+                subject_id = info['subject_id']
+            else:
+                subject_id = extract_subject_id(name, id_pattern)
+            if subject_id:
+                ids_to_folders[subject_id] = os.path.join(path, name)
+        return ids_to_folders
+
+    def files(self, path, extension=None, recursive=False):
+        """
+        List the files below path, optionally filtered by extension.
+
+        Hidden files and folders are skipped, matching glob.glob semantics.
+
+        Parameters
+        ----------
+        path : str
+            Directory to search
+        extension : str, optional
+            File extension to keep (e.g., '.fif'). If None, keeps all files.
+        recursive : bool, optional
+            Whether to search subdirectories
+
+        Returns
+        -------
+        list
+            Tuples of (file_path, info) with info as returned by listing()
+        """
+        found = []
+        pending = [os.path.normpath(path)]
+        while pending:
+            current = pending.pop()
+            for name, info in self.listing(current).items():
+                if name.startswith('.'):
+                    continue
+                full_path = os.path.join(current, name)
+                if info['is_dir']:
+                    if recursive:
+                        pending.append(full_path)
+                elif extension is None or name.endswith(extension):
+                    found.append((full_path, info))
+        return sorted(found)
@@ -9,8 +9,10 @@
 # save pair to raw_eeg_fnirs_pairs.txt in config
 
 from config.data_paths_and_config import PROJECT_ROOT
+from utils.instrumentation import instrumented, stage
 
-def scan_for_matching_ids(path_eeg, path_fnirs, id_pattern=None):
+@instrumented('scan_for_matching_ids')
+def scan_for_matching_ids(path_eeg, path_fnirs, id_pattern=None, index=None):
     """
     Scan for matching IDs of subfolders in the EEG and fNIRS folders.
     
@@ -23,6 +25,9 @@ def scan_for_matching_ids(path_eeg, path_fnirs, id_pattern=None):
     id_pattern : str, optional
         Regular expression pattern to extract subject IDs.
         If None, uses any alphanumeric sequence as ID.
+    index : DatasetIndex, optional
+        Persistent directory index to scan through. If None, the default
+        on-disk index is loaded, updated and saved.
         
     Returns
     -------
@@ -31,7 +36,7 @@ def scan_for_matching_ids(path_eeg, path_fnirs, id_pattern=None):
         matching_ids_dict: {id: {'eeg': eeg_folder_path, 'fnirs': fnirs_folder_path}}
     """
     import os
-    import re
+    from io_mgmt.dataset_index import DatasetIndex
     
     # Check if the paths exist
     if not os.path.exists(path_eeg):
@@ -39,32 +44,17 @@ def scan_for_matching_ids(path_eeg, path_fnirs, id_pattern=None):
     if not os.path.exists(path_fnirs):
         raise FileNotFoundError(f"fNIRS path not found: {path_fnirs}")
     
-    # Get all subfolders in both directories
-    eeg_items = os.listdir(path_eeg)
-    fnirs_items = os.listdir(path_fnirs)
-    
-    # Filter to keep only directories
-    eeg_folders = [item for item in eeg_items if os.path.isdir(os.path.join(path_eeg, item))]
-    fnirs_folders = [item for item in fnirs_items if os.path.isdir(os.path.join(path_fnirs, item))]
-    
-    # Use default pattern if none provided (any sequence of digits or letters)
-    if id_pattern is None:
-        id_pattern = r'([a-zA-Z0-9]+)'
+    # Only directories whose mtime changed since the last scan are re-listed
+    own_index = index is None
+    if own_index:
+        index = DatasetIndex(id_pattern=id_pattern)
     
     # Extract subject IDs and store with their folder paths
-    eeg_ids_to_folders = {}
-    for folder in eeg_folders:
-        match = re.search(id_pattern, folder)
-        if match:
-            subject_id = match.group(1)
-            eeg_ids_to_folders[subject_id] = os.path.join(path_eeg, folder)
-    
-    fnirs_ids_to_folders = {}
-    for folder in fnirs_folders:
-        match = re.search(id_pattern, folder)
-        if match:
-            subject_id = match.group(1)
-            fnirs_ids_to_folders[subject_id] = os.path.join(path_fnirs, folder)
+    eeg_ids_to_folders = index.subject_folders(path_eeg, id_pattern=id_pattern)
+    fnirs_ids_to_folders = index.subject_folders(path_fnirs, id_pattern=id_pattern)
+    
+    if own_index:
+        index.save()
     
     # Find matching and missing IDs
     eeg_ids = set(eeg_ids_to_folders.keys())
@@ -90,7 +80,8 @@ def scan_for_matching_ids(path_eeg, path_fnirs, id_pattern=None):
     
     return matching_ids_dict, missing_eeg_ids, missing_fnirs_ids
 
-def list_datasets_per_id(id_paths, type_eeg=None, type_fnirs=None, recursive=False, return_folders_eeg=False, return_folders_fnirs=False):
+@instrumented('list_datasets_per_id')
+def list_datasets_per_id(id_paths, type_eeg=None, type_fnirs=None, recursive=False, return_folders_eeg=False, return_folders_fnirs=False, index=None, verbose=True):
     """
     List all EEG and fNIRS datasets for a specific subject ID.
     
@@ -109,6 +100,11 @@ def list_datasets_per_id(id_paths, type_eeg=None, type_fnirs=None, recursive=Fal
         If True, return the parent folder of the found files instead of the files for EEG
     return_folders_fnirs : bool, optional
         If True, return the parent folder of the found files instead of the files for fNIRS
+    index : DatasetIndex, optional
+        Persistent directory index to list through. If None, the default
+        on-disk index is loaded, updated and saved.
+    verbose : bool, optional
+        If False, skip printing the summary of found datasets
         
     Returns
     -------
@@ -118,29 +114,24 @@ def list_datasets_per_id(id_paths, type_eeg=None, type_fnirs=None, recursive=Fal
         - If return_folders_*=True:  {'folder': 'name', 'path': 'folder/path'}
     """
     import os
-    import glob
+    from io_mgmt.dataset_index import DatasetIndex
     
     datasets = {'eeg': [], 'fnirs': []}
     
-    # Process EEG data path
+    own_index = index is None
+    if own_index:
+        index = DatasetIndex()
+    
+    # Process EEG data path (if no type is specified, all files are listed)
     eeg_path = id_paths['eeg']
-    if type_eeg:
-        # Use ** for recursive search if needed
-        pattern = os.path.join(eeg_path, '**', f'*{type_eeg}') if recursive else os.path.join(eeg_path, f'*{type_eeg}')
-        eeg_files = glob.glob(pattern, recursive=recursive)
-    else:
-        # If no type specified, get all files
-        pattern = os.path.join(eeg_path, '**', '*') if recursive else os.path.join(eeg_path, '*')
-        eeg_files = [f for f in glob.glob(pattern, recursive=recursive) if os.path.isfile(f)]
+    eeg_files = [path for path, _ in index.files(eeg_path, extension=type_eeg, recursive=recursive)]
     
     # Process fNIRS data path
     fnirs_path = id_paths['fnirs']
-    if type_fnirs:
-        pattern = os.path.join(fnirs_path, '**', f'*{type_fnirs}') if recursive else os.path.join(fnirs_path, f'*{type_fnirs}')
-        fnirs_files = glob.glob(pattern, recursive=recursive)
-    else:
-        pattern = os.path.join(fnirs_path, '**', '*') if recursive else os.path.join(fnirs_path, '*')
-        fnirs_files = [f for f in glob.glob(pattern, recursive=recursive) if os.path.isfile(f)]
+    fnirs_files = [path for path, _ in index.files(fnirs_path, extension=type_fnirs, recursive=recursive)]
+    
+    if own_index:
+        index.save()
     
     # Handle the return format for EEG (files or their parent folders)
     if return_folders_eeg:
@@ -176,6 +167,9 @@ def list_datasets_per_id(id_paths, type_eeg=None, type_fnirs=None, recursive=Fal
             file_name = os.path.basename(file)
             datasets['fnirs'].append({'filename': file_name, 'path': file})
     
+    if not verbose:
+        return datasets
+    
     # Print summary
     print(f"\nFound datasets for subject:")
     print(f"  EEG: {len(datasets['eeg'])} {'folders' if return_folders_eeg else 'files'}")
@@ -370,50 +364,16 @@ def make_pairs(datasets, auto_match_single=False):
     # Return all created pairs
     return created_pairs
 
-def write_pair_loc_description(pairs, subject_id=None, output_file=None, manual_inputs=None):
+def load_metadata_templates():
     """
-    Add descriptions to EEG-fNIRS pairs and save them to the raw_pairs_db.json database.
+    Load the pair metadata templates defined in config/data_descriptions.py.
     
-    Parameters
-    ----------
-    pairs : list
-        List of dictionaries with paired EEG and fNIRS paths
-        Format: [{'eeg_path': '/path/to/eeg', 'fnirs_path': '/path/to/fnirs'}, ...]
-    subject_id : str, optional
-        Subject ID for these pairs. If None, attempts to extract from filenames.
-    output_file : str, optional
-        Path to the JSON database file. If None, uses default location.
-    manual_inputs : list, optional
-        List of previously used manual settings, each a complete settings dict
-        Format: [{'type': 'motor tapping', 'fields': {'hand': 'L', ...}}, ...]
-        
     Returns
     -------
-    list
-        The manual inputs used, as a flat list for reuse in future calls
+    dict
+        {type_name: template} for every *_METADATA dictionary with 'type',
+        'auto' and 'manual' keys, or a basic 'default' template if none are found
     """
-    import os
-    import json
-    import re
-    from datetime import datetime
-    
-    # Set up output file path
-    try:
-        from config.data_paths_and_config import PROJECT_ROOT
-        output_file = output_file or os.path.join(PROJECT_ROOT, "config", "raw_pairs_db.json")
-        print("found config file")
-    except ImportError:
-        if output_file is None:
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            output_file = os.path.join(script_dir, '..', 'config', 'raw_pairs_db.json')
-        print("could not find config file")
-
-    print(f"Output file for pairs: {output_file}")
-    
-    # Create directory if it doesn't exist
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    
-    # Load templates
     try:
         # Add workspace root to Python path so "config" can be found
         import sys
@@ -460,27 +420,136 @@ def write_pair_loc_description(pairs, subject_id=None, output_file=None, manual_
             }
         }
     
-    # Load existing database if it exists
-    existing_pairs = []
-    if os.path.exists(output_file):
-        try:
-            with open(output_file, 'r') as f:
-                data = json.load(f)
-                existing_pairs = data.get('pairs', [])
-                print(f"Loaded {len(existing_pairs)} existing pairs from database")
-        except (json.JSONDecodeError, FileNotFoundError):
-            print(f"Warning: Could not read existing file {output_file}, starting with empty database")
+    return templates
+
+def fill_auto_metadata(metadata_template, subject_id, eeg_name, fnirs_name):
+    """
+    Fill the automatic metadata fields of a template for one pair.
     
-    # Check for duplicates
-    used_eeg_paths = set()
-    used_fnirs_paths = set()
+    Parameters
+    ----------
+    metadata_template : dict
+        Template from load_metadata_templates()
+    subject_id : str or None
+        Subject ID of the batch. If None, it is inferred from the file names.
+    eeg_name : str
+        Base name of the EEG file or folder
+    fnirs_name : str
+        Base name of the fNIRS file or folder
+        
+    Returns
+    -------
+    dict
+        The 'auto' metadata, including 'subject' and 'date_added_to_db'
+    """
+    import re
+    from datetime import datetime
+    
+    auto = {}
+    # This includes 'subject' and 'date_added_to_db' as defined in data_descriptions.py
+    for field_key in metadata_template['auto']:
+        if field_key == 'subject':
+            # Determine the subject ID
+            current_subject_id = "unknown"
+            if subject_id:  # Use subject_id passed to the function (batch-level)
+                current_subject_id = subject_id
+            elif metadata_template['auto'][field_key] == 'synthetic': # Handle synthetic case
+                current_subject_id = 'synthetic'
+            else: # Try to infer from filename if not synthetic and no batch ID
+                subject_match_eeg = re.search(r'(?:subject|sub|s)[-_]?([a-zA-Z0-9]+)', eeg_name, re.IGNORECASE)
+                if subject_match_eeg:
+                    current_subject_id = subject_match_eeg.group(1)
+                else:
+                    subject_match_fnirs = re.search(r'(?:subject|sub|s)[-_]?([a-zA-Z0-9]+)', fnirs_name, re.IGNORECASE)
+                    if subject_match_fnirs:
+                        current_subject_id = subject_match_fnirs.group(1)
+            auto[field_key] = current_subject_id
+        elif field_key == 'date_added_to_db':
+            auto[field_key] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S') # Date and time
+        else:
+            # For any other 'auto' fields defined in the template
+            auto[field_key] = metadata_template['auto'][field_key]
+    
+    return auto
+
+@instrumented('write_pair_loc_description', subject=lambda pairs, subject_id=None, *args, **kwargs: subject_id)
+def write_pair_loc_description(pairs, subject_id=None, output_file=None, manual_inputs=None):
+    """
+    Add descriptions to EEG-fNIRS pairs and save them to the pair database.
+    
+    Parameters
+    ----------
+    pairs : list
+        List of dictionaries with paired EEG and fNIRS paths
+        Format: [{'eeg_path': '/path/to/eeg', 'fnirs_path': '/path/to/fnirs'}, ...]
+    subject_id : str, optional
+        Subject ID for these pairs. If None, attempts to extract from filenames.
+    output_file : str, optional
+        Path to the pair database. Paths ending in .json use the legacy JSON
+        file, anything else the SQLite backend. If None, uses the default
+        SQLite database (config/raw_pairs_db.sqlite).
+    manual_inputs : list, optional
+        List of previously used manual settings, each a complete settings dict
+        Format: [{'type': 'motor tapping', 'fields': {'hand': 'L', ...}}, ...]
+        
+    Returns
+    -------
+    list
+        The manual inputs used, as a flat list for reuse in future calls
+    """
+    import os
+    import json
+    from collections import Counter
+    from datetime import datetime
+    
+    # Set up output file path
+    try:
+        from config.data_paths_and_config import PROJECT_ROOT
+        output_file = output_file or os.path.join(PROJECT_ROOT, "config", "raw_pairs_db.sqlite")
+        print("found config file")
+    except ImportError:
+        if output_file is None:
+            script_dir = os.path.dirname(os.path.abspath(__file__))
+            output_file = os.path.join(script_dir, '..', 'config', 'raw_pairs_db.sqlite')
+        print("could not find config file")
+    
+    use_json = output_file.endswith('.json')
+
+    print(f"Output file for pairs: {output_file}")
+    
+    # Create directory if it doesn't exist
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    
+    # Load templates
+    templates = load_metadata_templates()
+    
+    # Look up the paths of the current batch in the existing database
+    existing_pairs = []
+    pair_db = None
+    if use_json:
+        if os.path.exists(output_file):
+            try:
+                with open(output_file, 'r') as f:
+                    data = json.load(f)
+                    existing_pairs = data.get('pairs', [])
+                    print(f"Loaded {len(existing_pairs)} existing pairs from database")
+            except (json.JSONDecodeError, FileNotFoundError):
+                print(f"Warning: Could not read existing file {output_file}, starting with empty database")
+        used_eeg_paths = {existing_pair.get('eeg_path') for existing_pair in existing_pairs}
+        used_fnirs_paths = {existing_pair.get('fnirs_path') for existing_pair in existing_pairs}
+    else:
+        from io_mgmt.pairs_db import open_pair_database
+        pair_db = open_pair_database(output_file)
+        print(f"Opened pair database with {len(pair_db)} existing pairs")
+        # Indexed lookups of only the paths in this batch
+        used_eeg_paths = pair_db.used_paths('eeg_path', [pair['eeg_path'] for pair in pairs])
+        used_fnirs_paths = pair_db.used_paths('fnirs_path', [pair['fnirs_path'] for pair in pairs])
     
-    # First, collect all previously used paths from the database
-    for existing_pair in existing_pairs:
-        used_eeg_paths.add(existing_pair.get('eeg_path'))
-        used_fnirs_paths.add(existing_pair.get('fnirs_path'))
+    # Count path usage within the current batch itself
+    batch_eeg_counts = Counter(pair['eeg_path'] for pair in pairs)
+    batch_fnirs_counts = Counter(pair['fnirs_path'] for pair in pairs)
     
-    # Now check for duplicates in the current batch itself
+    # Check for duplicates
     duplicate_check = {}
     for i, pair in enumerate(pairs):
         eeg_path = pair['eeg_path']
@@ -496,15 +565,13 @@ def write_pair_loc_description(pairs, subject_id=None, output_file=None, manual_
             duplicate_check[i] = True
         
         # Also check if used multiple times in current batch
-        for j, other_pair in enumerate(pairs):
-            if i != j:  # Don't compare with self
-                if eeg_path == other_pair['eeg_path']:
-                    print(f"\nWARNING: EEG file used multiple times in current batch: {os.path.basename(eeg_path)}")
-                    duplicate_check[i] = True
-                
-                if fnirs_path == other_pair['fnirs_path']:
-                    print(f"\nWARNING: fNIRS file used multiple times in current batch: {os.path.basename(fnirs_path)}")
-                    duplicate_check[i] = True
+        if batch_eeg_counts[eeg_path] > 1:
+            print(f"\nWARNING: EEG file used multiple times in current batch: {os.path.basename(eeg_path)}")
+            duplicate_check[i] = True
+        
+        if batch_fnirs_counts[fnirs_path] > 1:
+            print(f"\nWARNING: fNIRS file used multiple times in current batch: {os.path.basename(fnirs_path)}")
+            duplicate_check[i] = True
     
     # If any duplicates were found, ask user whether to continue
     if duplicate_check:
@@ -513,6 +580,8 @@ def write_pair_loc_description(pairs, subject_id=None, output_file=None, manual_
         response = input("> ").strip().lower()
         if response != 'y':
             print("Operation cancelled by user.")
+            if pair_db is not None:
+                pair_db.close()
             return manual_inputs or []
     
     # Initialize manual_inputs if not provided
@@ -609,29 +678,7 @@ def write_pair_loc_description(pairs, subject_id=None, output_file=None, manual_
         }
         
         # Auto-fill automatic fields based on the template
-        # This will now include 'subject' and 'date_added_to_db' as defined in data_descriptions.py
-        for field_key in metadata_template['auto']:
-            if field_key == 'subject':
-                # Determine the subject ID
-                current_subject_id = "unknown"
-                if subject_id:  # Use subject_id passed to the function (batch-level)
-                    current_subject_id = subject_id
-                elif metadata_template['auto'][field_key] == 'synthetic': # Handle synthetic case
-                    current_subject_id = 'synthetic'
-                else: # Try to infer from filename if not synthetic and no batch ID
-                    subject_match_eeg = re.search(r'(?:subject|sub|s)[-_]?([a-zA-Z0-9]+)', eeg_name, re.IGNORECASE)
-                    if subject_match_eeg:
-                        current_subject_id = subject_match_eeg.group(1)
-                    else:
-                        subject_match_fnirs = re.search(r'(?:subject|sub|s)[-_]?([a-zA-Z0-9]+)', fnirs_name, re.IGNORECASE)
-                        if subject_match_fnirs:
-                            current_subject_id = subject_match_fnirs.group(1)
-                metadata['auto'][field_key] = current_subject_id
-            elif field_key == 'date_added_to_db':
-                metadata['auto'][field_key] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S') # Date and time
-            else:
-                # For any other 'auto' fields defined in the template
-                metadata['auto'][field_key] = metadata_template['auto'][field_key]
+        metadata['auto'] = fill_auto_metadata(metadata_template, subject_id, eeg_name, fnirs_name)
         
         # Handle manual fields
         if use_previous and selected_setting['type'] == type_name:
@@ -698,7 +745,13 @@ def write_pair_loc_description(pairs, subject_id=None, output_file=None, manual_
             print (f"\nManual inputs for future use: {manual_inputs}")
     
     # Save database
-    if pairs_with_descriptions:
+    if pairs_with_descriptions and pair_db is not None:
+        # Single transaction; pairs added by a concurrent writer meanwhile are skipped
+        saved = pair_db.add_pairs(pairs_with_descriptions)
+        print(f"\nSaved {saved} new pairs to {output_file}")
+        if saved < len(pairs_with_descriptions):
+            print(f"Skipped {len(pairs_with_descriptions) - saved} pairs added by another writer in the meantime")
+    elif pairs_with_descriptions:
         # Add to existing pairs
         existing_pairs.extend(pairs_with_descriptions)
         
@@ -709,29 +762,355 @@ def write_pair_loc_description(pairs, subject_id=None, output_file=None, manual_
             'pairs': existing_pairs
         }
         
-        # Write to file
-        with open(output_file, 'w') as f:
+        # Write to a temporary file first so a crash never leaves a truncated database
+        tmp_file = f"{output_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
             json.dump(database, f, indent=2)
+        os.replace(tmp_file, output_file)
         
         print(f"\nSaved {len(pairs_with_descriptions)} new pairs to {output_file}")
     else:
         print("\nNo new pairs to save")
     
+    if pair_db is not None:
+        pair_db.close()
+    
     # Return all manual inputs for future use
     
     return manual_inputs
 
-matching_ids, missing_eeg_ids, missing_fnirs_ids = scan_for_matching_ids(path_eeg = '/home/lennart/Desktop/Motor Task Subjects/EEG', path_fnirs = '/home/lennart/Desktop/Motor Task Subjects/fNIRS/NIRX', id_pattern=None)
+def recording_start_time(path):
+    """
+    Return the recording start time of a dataset file or folder.
+    
+    Uses the measurement date from the cached header metadata and falls back
+    to the modification time if the header cannot be read or has no date.
+    
+    Parameters
+    ----------
+    path : str
+        Path to the EEG file or fNIRS folder
+        
+    Returns
+    -------
+    float or None
+        POSIX timestamp, or None if the path cannot be read
+    """
+    import os
+    from io_mgmt.recording_metadata import get_recording_metadata, meas_timestamp
+    
+    try:
+        start_time = meas_timestamp(get_recording_metadata(path, save=False))
+    except (OSError, ValueError, KeyError, RuntimeError):
+        start_time = None
+    if start_time is not None:
+        return start_time
+    
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def _normalized_stem(dataset):
+    """Lower-case alphanumeric stem of a dataset name, ignoring the extension."""
+    import os
+    import re
+    
+    name = dataset.get('folder', dataset.get('filename', ''))
+    stem = os.path.splitext(name)[0] if 'filename' in dataset else name
+    return re.sub(r'[^a-z0-9]', '', stem.lower())
+
+def auto_pair_datasets(datasets, start_time_getter=None, max_time_diff=600.0):
+    """
+    Pair EEG and fNIRS datasets of one subject from rules, without user input.
+    
+    Rules are applied in order, each only to the datasets still unpaired:
+    1. Exactly one EEG and one fNIRS dataset are paired (auto_match_single).
+    2. Datasets with identical normalized name stems are paired.
+    3. Remaining datasets are paired by closest recording start time,
+       if the difference is at most max_time_diff seconds.
+    
+    Parameters
+    ----------
+    datasets : dict
+        Dictionary with 'eeg' and 'fnirs' lists of datasets
+    start_time_getter : callable, optional
+        Function mapping a dataset path to a POSIX timestamp (or None).
+        If None, uses recording_start_time.
+    max_time_diff : float, optional
+        Maximum start time difference in seconds for rule 3
+        
+    Returns
+    -------
+    tuple
+        (pairs, unresolved)
+        pairs: [{'eeg_path': ..., 'fnirs_path': ..., 'rule': ...}, ...]
+        unresolved: {'eeg': [dataset, ...], 'fnirs': [dataset, ...]} left for review
+    """
+    from collections import Counter
+    
+    start_time_getter = start_time_getter or recording_start_time
+    eeg_left = list(datasets['eeg'])
+    fnirs_left = list(datasets['fnirs'])
+    pairs = []
+    
+    def add_pair(eeg_dataset, fnirs_dataset, rule):
+        pairs.append({'eeg_path': eeg_dataset['path'], 'fnirs_path': fnirs_dataset['path'], 'rule': rule})
+        eeg_left.remove(eeg_dataset)
+        fnirs_left.remove(fnirs_dataset)
+    
+    # Rule 1: a single dataset of each type
+    if len(eeg_left) == 1 and len(fnirs_left) == 1:
+        add_pair(eeg_left[0], fnirs_left[0], 'single')
+        return pairs, {'eeg': eeg_left, 'fnirs': fnirs_left}
+    
+    # Rule 2: identical stems, only where the stem is unique on both sides
+    eeg_stems = Counter(_normalized_stem(d) for d in eeg_left)
+    fnirs_by_stem = {}
+    for fnirs_dataset in fnirs_left:
+        fnirs_by_stem.setdefault(_normalized_stem(fnirs_dataset), []).append(fnirs_dataset)
+    for eeg_dataset in list(eeg_left):
+        stem = _normalized_stem(eeg_dataset)
+        candidates = fnirs_by_stem.get(stem, [])
+        if stem and eeg_stems[stem] == 1 and len(candidates) == 1:
+            add_pair(eeg_dataset, candidates[0], 'stem')
+    
+    # Rule 3: closest start times, greedily from the smallest difference
+    eeg_times = [(d, start_time_getter(d['path'])) for d in eeg_left]
+    fnirs_times = [(d, start_time_getter(d['path'])) for d in fnirs_left]
+    candidates = sorted(
+        (abs(eeg_time - fnirs_time), i, j)
+        for i, (_, eeg_time) in enumerate(eeg_times) if eeg_time is not None
+        for j, (_, fnirs_time) in enumerate(fnirs_times) if fnirs_time is not None
+    )
+    used_eeg, used_fnirs = set(), set()
+    for time_diff, i, j in candidates:
+        if time_diff > max_time_diff:
+            break
+        if i in used_eeg or j in used_fnirs:
+            continue
+        used_eeg.add(i)
+        used_fnirs.add(j)
+        add_pair(eeg_times[i][0], fnirs_times[j][0], 'start_time')
+    
+    return pairs, {'eeg': eeg_left, 'fnirs': fnirs_left}
+
+def describe_pairs_headless(pairs, subject_id, task_type, manual_fields=None, templates=None):
+    """
+    Add metadata to pairs from fixed settings instead of interactive prompts.
+    
+    Parameters
+    ----------
+    pairs : list
+        List of dictionaries with paired EEG and fNIRS paths
+    subject_id : str
+        Subject ID for these pairs
+    task_type : str
+        Template type name (e.g., 'motor tapping')
+    manual_fields : dict, optional
+        Values for the template's manual fields. Missing fields are left empty.
+    templates : dict, optional
+        Templates from load_metadata_templates(). Loaded if None.
+        
+    Returns
+    -------
+    list
+        Pair dictionaries with 'eeg_path', 'fnirs_path' and 'metadata'
+    """
+    import os
+    
+    templates = templates or load_metadata_templates()
+    if task_type not in templates:
+        raise ValueError(f"Unknown task type '{task_type}'. Available: {', '.join(templates)}")
+    metadata_template = templates[task_type]
+    manual_fields = manual_fields or {}
+    
+    described = []
+    for pair in pairs:
+        metadata = {
+            'type': metadata_template['type'],
+            'auto': fill_auto_metadata(metadata_template, subject_id,
+                                       os.path.basename(pair['eeg_path']),
+                                       os.path.basename(pair['fnirs_path'])),
+            'manual': {field: manual_fields.get(field, '') for field in metadata_template['manual']}
+        }
+        described.append({'eeg_path': pair['eeg_path'], 'fnirs_path': pair['fnirs_path'], 'metadata': metadata})
+    return described
+
+def write_review_queue(entries, review_file=None):
+    """
+    Store unresolved datasets in the review queue, replacing older entries of the same subjects.
+    
+    Parameters
+    ----------
+    entries : list
+        [{'subject': id, 'eeg': [paths], 'fnirs': [paths], 'reason': str}, ...]
+    review_file : str, optional
+        Path to the JSON review queue. If None, uses config/pair_review_queue.json.
+        
+    Returns
+    -------
+    str
+        Path of the written review queue
+    """
+    import os
+    import json
+    from datetime import datetime
+    
+    review_file = review_file or os.path.join(PROJECT_ROOT, "config", "pair_review_queue.json")
+    queue = []
+    if os.path.exists(review_file):
+        try:
+            with open(review_file, 'r') as f:
+                queue = json.load(f).get('entries', [])
+        except (json.JSONDecodeError, FileNotFoundError):
+            print(f"Warning: Could not read review queue {review_file}, starting with empty queue")
+    
+    subjects = {entry['subject'] for entry in entries}
+    queue = [entry for entry in queue if entry['subject'] not in subjects] + entries
+    
+    tmp_file = f"{review_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump({'last_updated': datetime.now().isoformat(), 'entries': queue}, f, indent=2)
+    os.replace(tmp_file, review_file)
+    return review_file
 
-if matching_ids: 
-    first_id = list(matching_ids.keys())[0]
-    datasets = list_datasets_per_id(matching_ids[first_id], type_eeg='.fif', type_fnirs='.wl1', recursive=True, return_folders_eeg=False, return_folders_fnirs=True)
-    pairs = make_pairs(datasets)
-    print(pairs)
+@instrumented('batch_make_pairs')
+def batch_make_pairs(matching_ids, task_type, manual_fields=None, type_eeg='.fif', type_fnirs='.wl1',
+                     recursive=True, return_folders_eeg=False, return_folders_fnirs=True,
+                     max_workers=8, max_time_diff=600.0, output_file=None, review_file=None, index=None):
+    """
+    Pair and describe the datasets of every matching subject without user input.
+    
+    Listing and rule-based matching run per subject in a thread pool. All
+    resolved pairs are written to the pair database in one transaction, and
+    datasets the rules cannot pair are written to the review queue.
+    
+    Parameters
+    ----------
+    matching_ids : dict
+        {id: {'eeg': eeg_folder_path, 'fnirs': fnirs_folder_path}} from scan_for_matching_ids
+    task_type : str
+        Template type name used to describe all pairs (e.g., 'motor tapping')
+    manual_fields : dict, optional
+        Values for the template's manual fields
+    type_eeg, type_fnirs, recursive, return_folders_eeg, return_folders_fnirs
+        Passed to list_datasets_per_id
+    max_workers : int, optional
+        Number of worker threads
+    max_time_diff : float, optional
+        Maximum start time difference in seconds for time-based matching
+    output_file : str, optional
+        Path to the SQLite pair database. If None, uses the default location.
+    review_file : str, optional
+        Path to the JSON review queue. If None, uses the default location.
+    index : DatasetIndex, optional
+        Shared directory index. If None, the default on-disk index is used.
+        
+    Returns
+    -------
+    dict
+        {'pairs': [described pairs], 'saved': int, 'review': [review entries]}
+    """
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from io_mgmt.dataset_index import DatasetIndex
+    from io_mgmt.pairs_db import open_pair_database
+    from io_mgmt.recording_metadata import default_metadata_cache
+    
+    own_index = index is None
+    if own_index:
+        index = DatasetIndex()
+    templates = load_metadata_templates()
+    
+    def pair_subject(subject_id):
+        with stage('pair_subject', subject=subject_id):
+            datasets = list_datasets_per_id(matching_ids[subject_id], type_eeg=type_eeg, type_fnirs=type_fnirs,
+                                            recursive=recursive, return_folders_eeg=return_folders_eeg,
+                                            return_folders_fnirs=return_folders_fnirs, index=index, verbose=False)
+            pairs, unresolved = auto_pair_datasets(datasets, max_time_diff=max_time_diff)
+        return subject_id, pairs, unresolved
+    
+    all_pairs = []
+    review_entries = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for subject_id, pairs, unresolved in pool.map(pair_subject, sorted(matching_ids)):
+            all_pairs.extend(describe_pairs_headless(pairs, subject_id, task_type, manual_fields, templates))
+            if unresolved['eeg'] or unresolved['fnirs']:
+                if unresolved['eeg'] and unresolved['fnirs']:
+                    reason = 'no rule matched'
+                else:
+                    reason = 'no counterpart in the other modality'
+                review_entries.append({
+                    'subject': subject_id,
+                    'eeg': [d['path'] for d in unresolved['eeg']],
+                    'fnirs': [d['path'] for d in unresolved['fnirs']],
+                    'paired': [{'eeg_path': p['eeg_path'], 'fnirs_path': p['fnirs_path']} for p in pairs],
+                    'reason': reason
+                })
+            print(f"  {subject_id}: {len(pairs)} pairs ({', '.join(p['rule'] for p in pairs) or '-'}), "
+                  f"{len(unresolved['eeg'])} EEG / {len(unresolved['fnirs'])} fNIRS left for review")
+    
+    if own_index:
+        index.save()
+    default_metadata_cache().save()
+    
+    with open_pair_database(output_file) as pair_db:
+        saved = pair_db.add_pairs(all_pairs)
+    print(f"\nSaved {saved} new pairs ({len(all_pairs) - saved} already in database)")
+    
+    if review_entries:
+        review_path = write_review_queue(review_entries, review_file)
+        print(f"{len(review_entries)} subjects need review, see {os.path.basename(review_path)}")
+    
+    return {'pairs': all_pairs, 'saved': saved, 'review': review_entries}
 
-    if pairs:
-        write_pair_loc_description(pairs, subject_id=first_id)
-else:
-    print("No matching subject IDs found. Cannot proceed with pairing.")
+def _parse_manual_fields(assignments, task_type):
+    """Parse 'field=value' strings, converting values to the type of the template options."""
+    templates = load_metadata_templates()
+    options = templates.get(task_type, {}).get('manual', {})
+    manual_fields = {}
+    for assignment in assignments or []:
+        field, _, value = assignment.partition('=')
+        field = field.strip()
+        value = value.strip()
+        field_options = options.get(field)
+        if isinstance(field_options, list):
+            value = next((option for option in field_options if str(option) == value), value)
+        manual_fields[field] = value
+    return manual_fields
 
 
+if __name__ == '__main__':
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Match EEG and fNIRS datasets of identical subject IDs and store the pairs.")
+    parser.add_argument('--eeg', default='/home/lennart/Desktop/Motor Task Subjects/EEG', help="EEG data directory")
+    parser.add_argument('--fnirs', default='/home/lennart/Desktop/Motor Task Subjects/fNIRS/NIRX', help="fNIRS data directory")
+    parser.add_argument('--id-pattern', default=None, help="Regular expression extracting subject IDs from folder names")
+    parser.add_argument('--type-eeg', default='.fif', help="EEG file extension")
+    parser.add_argument('--type-fnirs', default='.wl1', help="fNIRS file extension")
+    parser.add_argument('--batch', action='store_true', help="Pair all subjects from rules without prompts")
+    parser.add_argument('--task-type', default='motor tapping', help="Metadata template used in batch mode")
+    parser.add_argument('--manual', action='append', metavar='FIELD=VALUE', help="Manual metadata field for batch mode (repeatable)")
+    parser.add_argument('--workers', type=int, default=8, help="Worker threads in batch mode")
+    parser.add_argument('--max-time-diff', type=float, default=600.0, help="Max. start time difference (s) for time-based matching")
+    parser.add_argument('--db', default=None, help="Pair database file")
+    args = parser.parse_args()
+    
+    matching_ids, missing_eeg_ids, missing_fnirs_ids = scan_for_matching_ids(path_eeg=args.eeg, path_fnirs=args.fnirs, id_pattern=args.id_pattern)
+    
+    if not matching_ids:
+        print("No matching subject IDs found. Cannot proceed with pairing.")
+    elif args.batch:
+        batch_make_pairs(matching_ids, args.task_type, _parse_manual_fields(args.manual, args.task_type),
+                         type_eeg=args.type_eeg, type_fnirs=args.type_fnirs, max_workers=args.workers,
+                         max_time_diff=args.max_time_diff, output_file=args.db)
+    else:
+        first_id = list(matching_ids.keys())[0]
+        datasets = list_datasets_per_id(matching_ids[first_id], type_eeg=args.type_eeg, type_fnirs=args.type_fnirs, recursive=True, return_folders_eeg=False, return_folders_fnirs=True)
+        pairs = make_pairs(datasets)
+        print(pairs)
+        
+        if pairs:
+            write_pair_loc_description(pairs, subject_id=first_id, output_file=args.db)
@@ -0,0 +1,254 @@
+"""
+Cohort selection over the pair database.
+
+Queries combine criteria on the pair type, the subject and any manual
+metadata field (hand, device, isi, cue_type, tapping_rate, eyes, position,
+...). A criterion is a single value or a collection of accepted values:
+
+    query = PairQuery()
+    cohort = query.select(type='motor tapping', hand='R', isi={20, 25})
+
+Every criterion is answered from an SQLite index (pairs.type, pairs.subject
+and the (field, value) index of pair_fields, see io_mgmt.pairs_db) and the
+matching pair IDs are intersected, so the metadata of non-matching pairs is
+never decoded. Values are compared in their canonical index form
+(pairs_db.index_value), so isi=20 matches '20' entered by hand.
+
+Results are PairHandle objects holding only paths and IDs; metadata, raw
+recordings and combined data are read when first accessed.
+"""
+
+import os
+import json
+
+from io_mgmt.combined_format import open_combined, read_sidecar
+from io_mgmt.pairs_db import open_pair_database, index_value
+
+PAIR_COLUMNS = ('type', 'subject')
+
+
+class PairHandle:
+    """
+    Lazy handle of one stored pair.
+
+    Parameters
+    ----------
+    pair_id : int
+        Row ID in the pair database
+    eeg_path, fnirs_path : str
+        Recording paths
+    subject, type : str
+        Subject ID and pair type
+    metadata_json : str
+        Metadata as stored; decoded on first access
+    """
+
+    def __init__(self, pair_id, eeg_path, fnirs_path, subject, type, metadata_json):
+        self.pair_id = pair_id
+        self.eeg_path = eeg_path
+        self.fnirs_path = fnirs_path
+        self.subject = subject
+        self.type = type
+        self._metadata_json = metadata_json
+        self._metadata = None
+        self._raws = {}
+
+    def __repr__(self):
+        return f"PairHandle({self.pair_id}, subject={self.subject!r}, type={self.type!r})"
+
+    @property
+    def metadata(self):
+        """Pair metadata ('type', 'auto', 'manual')."""
+        if self._metadata is None:
+            self._metadata = json.loads(self._metadata_json)
+        return self._metadata
+
+    @property
+    def manual(self):
+        """Manual metadata fields."""
+        return self.metadata.get('manual', {})
+
+    def as_pair(self):
+        """Return the pair dictionary in the raw_pairs_db.json layout."""
+        return {'eeg_path': self.eeg_path, 'fnirs_path': self.fnirs_path, 'metadata': self.metadata}
+
+    def _raw(self, modality):
+        from io_mgmt.combine_fnirs_eeg import open_raw
+
+        if modality not in self._raws:
+            self._raws[modality] = open_raw(self.eeg_path if modality == 'eeg' else self.fnirs_path)
+        return self._raws[modality]
+
+    @property
+    def eeg_raw(self):
+        """EEG recording, opened on first access without loading its data."""
+        return self._raw('eeg')
+
+    @property
+    def fnirs_raw(self):
+        """fNIRS recording, opened on first access without loading its data."""
+        return self._raw('fnirs')
+
+    def combined_path(self, output_dir=None):
+        """Return the data file of the combined recording (see combine_fnirs_eeg.combined_output_path)."""
+        from io_mgmt.combine_fnirs_eeg import combined_output_path
+
+        return combined_output_path(self.as_pair(), output_dir)
+
+    def combined(self, output_dir=None):
+        """
+        Open the combined recording lazily and read its sidecar.
+
+        Parameters
+        ----------
+        output_dir : str, optional
+            Root directory of the combined recordings
+
+        Returns
+        -------
+        tuple
+            (data, sidecar): (n_channels, n_times) array-like (see
+            combined_format.open_combined) and the sidecar dict
+
+        Raises
+        ------
+        FileNotFoundError
+            If the pair has not been combined yet
+        """
+        path = self.combined_path(output_dir)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Pair {self.pair_id} has not been combined yet: {path}")
+        data = open_combined(path)
+        return data, read_sidecar(path)
+
+
+def _accepted(value):
+    """Return the accepted values of a criterion as a list."""
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return list(value)
+    return [value]
+
+
+class PairQuery:
+    """
+    Indexed queries over the pair database.
+
+    Parameters
+    ----------
+    db_file : str, optional
+        Path to the SQLite pair database. If None, uses the default location.
+    """
+
+    def __init__(self, db_file=None):
+        self.db = open_pair_database(db_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the database connection."""
+        self.db.close()
+
+    def _id_query(self, criteria):
+        """Build the SQL selecting the IDs of pairs matching every criterion."""
+        subqueries = []
+        params = []
+        for field, value in criteria.items():
+            values = _accepted(value)
+            if not values:
+                raise ValueError(f"No accepted values given for '{field}'")
+            placeholders = ', '.join('?' * len(values))
+            if field in PAIR_COLUMNS:
+                subqueries.append(f"SELECT id FROM pairs WHERE {field} IN ({placeholders})")
+                params.extend(values)
+            else:
+                subqueries.append(f"SELECT pair_id FROM pair_fields WHERE field = ? AND value IN ({placeholders})")
+                params.extend([field] + [index_value(v) for v in values])
+        if not subqueries:
+            return "SELECT id FROM pairs", params
+        return " INTERSECT ".join(subqueries), params
+
+    def ids(self, **criteria):
+        """Return the sorted IDs of the pairs matching all criteria."""
+        query, params = self._id_query(criteria)
+        return sorted(row[0] for row in self.db.conn.execute(query, params))
+
+    def count(self, **criteria):
+        """Return the number of pairs matching all criteria."""
+        query, params = self._id_query(criteria)
+        return self.db.conn.execute(f"SELECT COUNT(*) FROM ({query})", params).fetchone()[0]
+
+    def select(self, **criteria):
+        """
+        Return lazy handles of the pairs matching all criteria.
+
+        Parameters
+        ----------
+        **criteria
+            type, subject or a manual field name, each mapped to one value or a
+            collection of accepted values
+
+        Returns
+        -------
+        list of PairHandle
+            Matching pairs in insertion order
+        """
+        query, params = self._id_query(criteria)
+        rows = self.db.conn.execute(
+            "SELECT id, eeg_path, fnirs_path, subject, type, metadata FROM pairs "
+            f"WHERE id IN ({query}) ORDER BY id", params
+        )
+        return [PairHandle(*row) for row in rows]
+
+    def values(self, field, **criteria):
+        """
+        Distinct values of a field with their pair counts, optionally within a selection.
+
+        Parameters
+        ----------
+        field : str
+            'type', 'subject' or a manual field name
+        **criteria
+            Restrict the counts to pairs matching these criteria
+
+        Returns
+        -------
+        dict
+            {value: number of pairs}; manual field values in their index form
+        """
+        query, params = self._id_query(criteria)
+        if field in PAIR_COLUMNS:
+            sql = f"SELECT {field}, COUNT(*) FROM pairs WHERE id IN ({query}) GROUP BY {field}"
+            rows = self.db.conn.execute(sql, params)
+        else:
+            sql = (f"SELECT value, COUNT(*) FROM pair_fields WHERE field = ? AND pair_id IN ({query}) "
+                   "GROUP BY value")
+            rows = self.db.conn.execute(sql, [field] + params)
+        return {value: count for value, count in rows}
+
+    def fields(self):
+        """Return the sorted names of all indexed manual fields."""
+        return [row[0] for row in self.db.conn.execute("SELECT DISTINCT field FROM pair_fields ORDER BY field")]
+
+
+def select_pairs(db_file=None, **criteria):
+    """
+    Select pairs of the pair database as lazy handles.
+
+    Parameters
+    ----------
+    db_file : str, optional
+        Path to the SQLite pair database. If None, uses the default location.
+    **criteria
+        Passed to PairQuery.select
+
+    Returns
+    -------
+    list of PairHandle
+        Matching pairs in insertion order
+    """
+    with PairQuery(db_file) as query:
+        return query.select(**criteria)
@@ -0,0 +1,344 @@
+"""
+SQLite storage backend for the EEG-fNIRS pair database.
+
+Pairs are stored one row each with unique indexes on the EEG and fNIRS paths
+and indexes on the subject ID and type, so duplicate checks are single index
+lookups and inserts do not rewrite the whole database. The manual metadata
+fields are also stored as (pair, field, value) rows with an index on
+(field, value), an inverted index used by io_mgmt.pair_query to select
+cohorts without decoding every pair. Writes run in immediate
+transactions in WAL mode, so concurrent writers serialize instead of
+corrupting the file.
+
+The pair dictionaries have the same layout as the entries of the legacy
+raw_pairs_db.json: {'eeg_path': ..., 'fnirs_path': ..., 'metadata': {...}}.
+"""
+
+import os
+import json
+import sqlite3
+from datetime import datetime
+
+from config.data_paths_and_config import PROJECT_ROOT
+
+DEFAULT_DB_FILE = os.path.join(PROJECT_ROOT, "config", "raw_pairs_db.sqlite")
+LEGACY_JSON_FILE = os.path.join(PROJECT_ROOT, "config", "raw_pairs_db.json")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pairs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    eeg_path TEXT NOT NULL,
+    fnirs_path TEXT NOT NULL,
+    subject TEXT,
+    type TEXT,
+    date_added_to_db TEXT,
+    metadata TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_pairs_eeg_path ON pairs (eeg_path);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_pairs_fnirs_path ON pairs (fnirs_path);
+CREATE INDEX IF NOT EXISTS idx_pairs_subject ON pairs (subject);
+CREATE INDEX IF NOT EXISTS idx_pairs_type ON pairs (type);
+CREATE TABLE IF NOT EXISTS pair_fields (
+    pair_id INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (pair_id, field, value)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_pair_fields_value ON pair_fields (field, value, pair_id);
+CREATE TABLE IF NOT EXISTS db_info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+PATH_COLUMNS = ('eeg_path', 'fnirs_path')
+
+# Bumped whenever index_value or the indexed fields change, to rebuild pair_fields
+FIELD_INDEX_VERSION = 1
+
+
+def index_value(value):
+    """
+    Canonical text of a metadata value in the field index.
+
+    Numbers and numeric strings map to the same text (20, 20.0 and '20' all
+    give '20'), so values typed in by hand match values from the templates.
+    """
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, str):
+        value = value.strip()
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+    else:
+        number = value
+    if isinstance(number, (int, float)):
+        return str(int(number)) if float(number).is_integer() else repr(float(number))
+    return str(value)
+
+
+def field_rows(pair_id, metadata):
+    """Return the (pair_id, field, value) index rows of the manual fields of one pair; lists give one row per item."""
+    rows = []
+    for field, value in metadata.get('manual', {}).items():
+        for item in value if isinstance(value, (list, tuple)) else [value]:
+            if item is not None and item != '':
+                rows.append((pair_id, field, index_value(item)))
+    return rows
+
+
+class PairDatabase:
+    """
+    Indexed, transactional store of EEG-fNIRS pairs.
+
+    Parameters
+    ----------
+    db_file : str, optional
+        Path to the SQLite file. If None, uses config/raw_pairs_db.sqlite.
+    timeout : float, optional
+        Seconds to wait for a lock held by another writer
+    """
+
+    def __init__(self, db_file=None, timeout=30.0):
+        self.db_file = db_file or DEFAULT_DB_FILE
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_file)), exist_ok=True)
+        # isolation_level=None leaves transaction control to _transaction()
+        self.conn = sqlite3.connect(self.db_file, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        row = self.conn.execute("SELECT value FROM db_info WHERE key = 'field_index_version'").fetchone()
+        if row is None or int(row[0]) != FIELD_INDEX_VERSION:
+            self.rebuild_field_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM pairs").fetchone()[0]
+
+    def close(self):
+        """Close the database connection."""
+        self.conn.close()
+
+    def _transaction(self, rows):
+        """Insert (row, metadata) items in one immediate transaction and return how many were new."""
+        cursor = self.conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            inserted = 0
+            for row, metadata in rows:
+                # OR IGNORE skips pairs a concurrent writer inserted since our duplicate check
+                cursor.execute(
+                    "INSERT OR IGNORE INTO pairs (eeg_path, fnirs_path, subject, type, date_added_to_db, metadata) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    row
+                )
+                if cursor.rowcount == 1:
+                    inserted += 1
+                    cursor.executemany("INSERT OR IGNORE INTO pair_fields (pair_id, field, value) VALUES (?, ?, ?)",
+                                       field_rows(cursor.lastrowid, metadata))
+            cursor.execute(
+                "INSERT OR REPLACE INTO db_info (key, value) VALUES ('last_updated', ?)",
+                (datetime.now().isoformat(),)
+            )
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        return inserted
+
+    def add_pairs(self, pairs):
+        """
+        Add described pairs to the database in a single atomic transaction.
+
+        Pairs whose EEG or fNIRS path is already in the database are skipped.
+
+        Parameters
+        ----------
+        pairs : list
+            Pair dictionaries with 'eeg_path', 'fnirs_path' and 'metadata'
+
+        Returns
+        -------
+        int
+            Number of pairs actually inserted
+        """
+        rows = []
+        for pair in pairs:
+            metadata = pair.get('metadata', {})
+            auto = metadata.get('auto', {})
+            rows.append(((
+                pair['eeg_path'],
+                pair['fnirs_path'],
+                auto.get('subject'),
+                metadata.get('type'),
+                auto.get('date_added_to_db'),
+                json.dumps(metadata)
+            ), metadata))
+        return self._transaction(rows)
+
+    def rebuild_field_index(self):
+        """Rebuild the manual-field index from the stored metadata (done automatically for older databases)."""
+        cursor = self.conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute("DELETE FROM pair_fields")
+            for pair_id, metadata in self.conn.execute("SELECT id, metadata FROM pairs").fetchall():
+                cursor.executemany("INSERT OR IGNORE INTO pair_fields (pair_id, field, value) VALUES (?, ?, ?)",
+                                   field_rows(pair_id, json.loads(metadata)))
+            cursor.execute("INSERT OR REPLACE INTO db_info (key, value) VALUES ('field_index_version', ?)",
+                           (str(FIELD_INDEX_VERSION),))
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+
+    def contains(self, column, path):
+        """Return True if path is stored in column ('eeg_path' or 'fnirs_path')."""
+        if column not in PATH_COLUMNS:
+            raise ValueError(f"Unknown path column: {column}")
+        query = f"SELECT 1 FROM pairs WHERE {column} = ? LIMIT 1"
+        return self.conn.execute(query, (path,)).fetchone() is not None
+
+    def used_paths(self, column, paths):
+        """
+        Return the subset of paths already stored in column.
+
+        Parameters
+        ----------
+        column : str
+            'eeg_path' or 'fnirs_path'
+        paths : iterable of str
+            Candidate paths to look up
+
+        Returns
+        -------
+        set
+            Paths that are already in the database
+        """
+        return {path for path in set(paths) if self.contains(column, path)}
+
+    def pairs(self, subject=None):
+        """
+        Return stored pairs in insertion order, optionally for one subject only.
+
+        Returns
+        -------
+        list
+            Pair dictionaries in the raw_pairs_db.json layout
+        """
+        query = "SELECT eeg_path, fnirs_path, metadata FROM pairs"
+        params = ()
+        if subject is not None:
+            query += " WHERE subject = ?"
+            params = (subject,)
+        query += " ORDER BY id"
+        return [
+            {'eeg_path': eeg_path, 'fnirs_path': fnirs_path, 'metadata': json.loads(metadata)}
+            for eeg_path, fnirs_path, metadata in self.conn.execute(query, params)
+        ]
+
+    def subjects(self):
+        """Return the sorted list of distinct subject IDs."""
+        rows = self.conn.execute("SELECT DISTINCT subject FROM pairs WHERE subject IS NOT NULL ORDER BY subject")
+        return [row[0] for row in rows]
+
+    def last_updated(self):
+        """Return the ISO timestamp of the last write, or None for an empty database."""
+        row = self.conn.execute("SELECT value FROM db_info WHERE key = 'last_updated'").fetchone()
+        return row[0] if row else None
+
+    def export_json(self, json_file):
+        """
+        Write the database in the legacy raw_pairs_db.json layout.
+
+        Parameters
+        ----------
+        json_file : str
+            Output path; written atomically via a temporary file
+        """
+        pairs = self.pairs()
+        database = {
+            'last_updated': self.last_updated() or datetime.now().isoformat(),
+            'num_pairs': len(pairs),
+            'pairs': pairs
+        }
+        tmp_file = f"{json_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(database, f, indent=2)
+        os.replace(tmp_file, json_file)
+
+
+def import_json_database(json_file, db_file=None):
+    """
+    One-shot import of a legacy raw_pairs_db.json into the SQLite backend.
+
+    Parameters
+    ----------
+    json_file : str
+        Path to the JSON database
+    db_file : str, optional
+        Path to the SQLite file. If None, uses the default location.
+
+    Returns
+    -------
+    int
+        Number of pairs imported (pairs already present are skipped)
+    """
+    with open(json_file, 'r') as f:
+        existing_pairs = json.load(f).get('pairs', [])
+
+    with PairDatabase(db_file) as db:
+        imported = db.add_pairs(existing_pairs)
+
+    print(f"Imported {imported} of {len(existing_pairs)} pairs from {json_file}")
+    return imported
+
+
+def open_pair_database(db_file=None):
+    """
+    Open the pair database, importing the legacy JSON database on first use.
+
+    Parameters
+    ----------
+    db_file : str, optional
+        Path to the SQLite file. If None, uses the default location.
+
+    Returns
+    -------
+    PairDatabase
+        The opened database (caller is responsible for closing it)
+    """
+    db_file = db_file or DEFAULT_DB_FILE
+    is_new = not os.path.exists(db_file)
+    if is_new and db_file == DEFAULT_DB_FILE and os.path.exists(LEGACY_JSON_FILE):
+        import_json_database(LEGACY_JSON_FILE, db_file)
+    return PairDatabase(db_file)
+
+
+def load_pairs(db_file=None):
+    """
+    Load all pairs from either a SQLite database or a legacy JSON database.
+
+    Parameters
+    ----------
+    db_file : str, optional
+        Path ending in .json for the legacy format, otherwise a SQLite file.
+        If None, uses the default SQLite location.
+
+    Returns
+    -------
+    list
+        Pair dictionaries in the raw_pairs_db.json layout
+    """
+    if db_file is not None and db_file.endswith('.json'):
+        with open(db_file, 'r') as f:
+            return json.load(f).get('pairs', [])
+    with open_pair_database(db_file) as db:
+        return db.pairs()
@@ -0,0 +1,318 @@
+"""
+Header-only recording metadata for EEG (.fif) and NIRx fNIRS datasets.
+
+Only headers are read: the FIF tag directory (no sample data) and the NIRx
+.hdr file. The .hdr has no sample count, so the number of fNIRS samples is
+estimated from the size of the .wl1 file and the length of its first lines
+(exact for NIRx's fixed-width rows). Results are cached on disk keyed by
+(path, mtime, size), so a dataset is parsed once and later queries are a stat
+plus a dictionary lookup.
+
+NIRx headers hold the local wall-clock time of the acquisition computer. It is
+kept as a naive ISO time in the metadata and converted to UTC with
+RECORDING_CLOCKS['nirx_timezone'] by meas_timestamp, so changing the time zone
+does not invalidate cached headers.
+"""
+
+import os
+import re
+import json
+import threading
+from configparser import RawConfigParser
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+from config.data_paths_and_config import PROJECT_ROOT
+from config.parameters import RECORDING_CLOCKS
+
+DEFAULT_CACHE_FILE = os.path.join(PROJECT_ROOT, "config", "recording_metadata_cache.json")
+# Cached entries of older versions are parsed again (version 2: NIRx times stored as local wall-clock time)
+HEADER_VERSION = 2
+LINE_SAMPLE_BYTES = 1 << 16
+
+# NIRx writes the date with a (possibly localized) weekday prefix, e.g. "Mi, 16 Jan 2019"
+NIRX_DATE_FORMATS = ['%d %b %Y', '%b %d, %Y', '%Y-%m-%d']
+NIRX_TIME_FORMATS = ['%H:%M:%S.%f', '%H:%M:%S']
+
+
+def _is_fif(path):
+    """Return True for EEG .fif files (optionally gzipped)."""
+    return path.endswith('.fif') or path.endswith('.fif.gz')
+
+
+def _file_signature(path):
+    """Return (mtime_ns, size) of a file or the pair of lists for all files in a folder."""
+    if os.path.isdir(path):
+        entries = sorted((entry.name, entry.stat()) for entry in os.scandir(path) if entry.is_file())
+        return [st.st_mtime_ns for _, st in entries], [st.st_size for _, st in entries]
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def read_fif_header(path):
+    """
+    Read recording properties of an EEG .fif file without loading its data.
+
+    Parameters
+    ----------
+    path : str
+        Path to the .fif file
+
+    Returns
+    -------
+    dict
+        {'modality', 'meas_date', 'sfreq', 'n_times', 'duration', 'n_channels'}
+        meas_date is an ISO string in UTC, or None if not stored in the file.
+    """
+    import mne
+
+    raw = mne.io.read_raw_fif(path, preload=False, verbose='error')
+    meas_date = raw.info['meas_date']
+    return {
+        'modality': 'eeg',
+        'meas_date': meas_date.isoformat() if meas_date is not None else None,
+        'sfreq': float(raw.info['sfreq']),
+        'n_times': int(raw.n_times),
+        'duration': float(raw.n_times / raw.info['sfreq']),
+        'n_channels': int(raw.info['nchan'])
+    }
+
+
+def nirx_local_to_utc(local_time):
+    """
+    Convert a NIRx wall-clock time to UTC.
+
+    Parameters
+    ----------
+    local_time : datetime
+        Naive local time of the NIRx acquisition computer. mne.io.read_raw_nirx
+        stamps this time as UTC; pass meas_date.replace(tzinfo=None) for those.
+
+    Returns
+    -------
+    datetime
+        Aware UTC datetime, using RECORDING_CLOCKS['nirx_timezone'] (or the local
+        time zone of this machine if None)
+    """
+    zone = RECORDING_CLOCKS['nirx_timezone']
+    local_time = local_time.replace(tzinfo=None)
+    aware = local_time.replace(tzinfo=ZoneInfo(zone)) if zone else local_time.astimezone()
+    return aware.astimezone(timezone.utc)
+
+
+def _parse_nirx_datetime(date_str, time_str):
+    """Parse NIRx Date and Time header fields into a naive local datetime, or None."""
+    date_str = date_str.strip('"').strip()
+    time_str = time_str.strip('"').strip()
+    # Drop the weekday, which may be localized
+    parts = date_str.split(' ', 1)
+    if len(parts) == 2 and re.match(r'^[^\W\d]+,?$', parts[0]):
+        date_str = parts[1]
+    for date_format in NIRX_DATE_FORMATS:
+        for time_format in NIRX_TIME_FORMATS:
+            try:
+                parsed = datetime.strptime(f"{date_str} {time_str}", f"{date_format} {time_format}")
+            except ValueError:
+                continue
+            # Local wall-clock time of the acquisition computer, see nirx_local_to_utc
+            return parsed
+    return None
+
+
+def _estimate_lines(path, sample_bytes=LINE_SAMPLE_BYTES):
+    """Estimate the number of lines of a text file from its size and the length of its first lines."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(sample_bytes)
+    if len(head) == size:
+        # Small file read completely; count the last line even without trailing newline
+        return head.count(b'\n') + (size > 0 and head[-1:] != b'\n')
+    complete = head.rfind(b'\n') + 1
+    if not complete:
+        raise ValueError(f"No line break in the first {sample_bytes} bytes of {path}")
+    return int(round(size * head.count(b'\n') / complete))
+
+
+def read_nirx_header(path):
+    """
+    Read recording properties of a NIRx dataset from its .hdr file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the NIRx folder or to a file inside it (e.g., the .wl1 file)
+
+    Returns
+    -------
+    dict
+        {'modality', 'meas_date', 'sfreq', 'n_times', 'duration', 'n_channels',
+         'n_sources', 'n_detectors', 'wavelengths', 'n_events'}
+        meas_date is the naive ISO local time of the header (see meas_timestamp);
+        n_times is estimated from the size of the .wl1 file.
+    """
+    folder = path if os.path.isdir(path) else os.path.dirname(path)
+    hdr_files = sorted(f for f in os.listdir(folder) if f.endswith('.hdr'))
+    if not hdr_files:
+        raise FileNotFoundError(f"No NIRx .hdr file found in {folder}")
+    hdr_file = os.path.join(folder, hdr_files[0])
+
+    with open(hdr_file, 'r', errors='replace') as f:
+        hdr_str_all = f.read()
+    # Multi-line blocks between '#' are not configparser compliant; count markers before dropping them
+    markers = re.search(r'Events="#(.*?)#"', hdr_str_all, flags=re.DOTALL)
+    n_events = len([line for line in markers.group(1).splitlines() if line.strip()]) if markers else 0
+    hdr = RawConfigParser()
+    hdr.read_string(re.sub('#.*?#', '', hdr_str_all, flags=re.DOTALL))
+
+    general = hdr['GeneralInfo'] if hdr.has_section('GeneralInfo') else {}
+    imaging = hdr['ImagingParameters'] if hdr.has_section('ImagingParameters') else {}
+    sd_key = hdr['DataStructure'].get('S-D-Key', '') if hdr.has_section('DataStructure') else ''
+
+    sfreq = float(imaging.get('SamplingRate', 'nan'))
+    meas_date = _parse_nirx_datetime(general.get('Date', ''), general.get('Time', ''))
+
+    wl1_files = sorted(f for f in os.listdir(folder) if f.endswith('.wl1'))
+    n_times = _estimate_lines(os.path.join(folder, wl1_files[0])) if wl1_files else 0
+
+    return {
+        'modality': 'fnirs',
+        'meas_date': meas_date.isoformat() if meas_date is not None else None,
+        'sfreq': sfreq,
+        'n_times': n_times,
+        'duration': n_times / sfreq if sfreq > 0 else None,
+        'n_channels': len(re.findall(r'\d+-\d+:\d+', sd_key)),
+        'n_sources': int(imaging.get('Sources', 0)),
+        'n_detectors': int(imaging.get('Detectors', 0)),
+        'wavelengths': [int(w) for w in re.findall(r'\d+', imaging.get('Wavelengths', ''))],
+        'n_events': n_events
+    }
+
+
+def read_recording_header(path):
+    """
+    Read header metadata of an EEG .fif file or a NIRx folder/file.
+
+    Parameters
+    ----------
+    path : str
+        Path to a .fif file, a NIRx folder or a file inside a NIRx folder
+
+    Returns
+    -------
+    dict
+        Metadata as returned by read_fif_header or read_nirx_header
+    """
+    if _is_fif(path):
+        return read_fif_header(path)
+    return read_nirx_header(path)
+
+
+class RecordingMetadataCache:
+    """
+    Persistent cache of header metadata keyed by path and validated by (mtime, size).
+
+    Parameters
+    ----------
+    cache_file : str, optional
+        Path to the JSON cache file. If None, uses config/recording_metadata_cache.json.
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file or DEFAULT_CACHE_FILE
+        self.entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r') as f:
+                    self.entries = json.load(f)
+            except (json.JSONDecodeError, OSError):
+                print(f"Warning: Could not read metadata cache {self.cache_file}, starting with empty cache")
+
+    def get(self, path):
+        """
+        Return the header metadata of a dataset, parsing it only if it changed.
+
+        Parameters
+        ----------
+        path : str
+            Path to a .fif file or a NIRx folder/file
+
+        Returns
+        -------
+        dict
+            Recording metadata (see read_recording_header)
+        """
+        path = os.path.normpath(path)
+        # NIRx datasets are validated on the whole folder, since the header lives next to the data
+        signature_path = path if _is_fif(path) or os.path.isdir(path) else os.path.dirname(path)
+        mtime, size = _file_signature(signature_path)
+        cached = self.entries.get(path)
+        if cached is not None and cached['mtime'] == mtime and cached['size'] == size \
+                and cached.get('version') == HEADER_VERSION:
+            return cached['metadata']
+
+        metadata = read_recording_header(path)
+        with self._lock:
+            self.entries[path] = {'mtime': mtime, 'size': size, 'version': HEADER_VERSION, 'metadata': metadata}
+            self._dirty = True
+        return metadata
+
+    def save(self):
+        """Write the cache to disk atomically if anything changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_file, self.cache_file)
+            self._dirty = False
+
+
+_default_cache = None
+
+
+def default_metadata_cache():
+    """Return the process-wide cache backed by the default cache file."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = RecordingMetadataCache()
+    return _default_cache
+
+
+def get_recording_metadata(path, save=True):
+    """
+    Return header metadata of a dataset from the default on-disk cache.
+
+    Parameters
+    ----------
+    path : str
+        Path to a .fif file or a NIRx folder/file
+    save : bool, optional
+        Whether to persist the cache immediately after a new entry was parsed
+
+    Returns
+    -------
+    dict
+        Recording metadata (see read_recording_header)
+    """
+    cache = default_metadata_cache()
+    metadata = cache.get(path)
+    if save:
+        cache.save()
+    return metadata
+
+
+def meas_timestamp(metadata):
+    """
+    Return the measurement start of a metadata dict as a POSIX timestamp, or None.
+
+    Naive times (NIRx headers) are local wall-clock times converted with nirx_local_to_utc.
+    """
+    if not metadata.get('meas_date'):
+        return None
+    meas_date = datetime.fromisoformat(metadata['meas_date'])
+    if meas_date.tzinfo is None:
+        meas_date = nirx_local_to_utc(meas_date)
+    return meas_date.timestamp()
@@ -0,0 +1,299 @@
+"""
+EEG-informed general linear model of fNIRS signals.
+
+EEG band envelopes are convolved with the hemodynamic response function
+(NVC_ANALYSIS['glm']['hrf_model']) by FFT convolution and combined with a
+cosine drift basis (NVC_ANALYSIS['glm']['high_pass']) into one design
+matrix. All fNIRS channels and chromophores are columns of one data matrix
+and are solved with a single QR factorization of the design.
+
+With AR(1) prewhitening, the autocorrelation of each channel is estimated
+from the OLS residuals and rounded; channels sharing a rounded coefficient
+share one whitened design and factorization.
+
+The HRF and drift bases are memoized per (sfreq) and (n_times, sfreq,
+high_pass).
+"""
+
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import fftconvolve
+from scipy.stats import gamma
+
+from config.parameters import NVC_ANALYSIS
+from preprocessing.filter_bank import get_filter_bank
+from preprocessing.resample import resample
+
+HRF_DURATION = 32.0  # seconds
+AR1_DECIMALS = 2     # Rounding of AR(1) coefficients for grouping channels
+
+
+@lru_cache(maxsize=None)
+def spm_hrf(sfreq, duration=HRF_DURATION):
+    """
+    SPM canonical hemodynamic response function (difference of two gammas).
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling rate in Hz
+    duration : float, optional
+        Length of the kernel in seconds
+
+    Returns
+    -------
+    ndarray
+        Read-only kernel normalized to unit sum
+    """
+    times = np.arange(0, duration, 1.0 / sfreq)
+    hrf = gamma.pdf(times, 6.0) - gamma.pdf(times, 16.0) / 6.0
+    hrf = hrf / hrf.sum()
+    hrf.setflags(write=False)
+    return hrf
+
+
+def get_hrf(sfreq, hrf_model=None):
+    """Return the memoized HRF kernel of a model name ('spm')."""
+    hrf_model = hrf_model or NVC_ANALYSIS['glm']['hrf_model']
+    if hrf_model != 'spm':
+        raise ValueError(f"Unknown HRF model: {hrf_model}")
+    return spm_hrf(float(sfreq))
+
+
+@lru_cache(maxsize=32)
+def cosine_drift(n_times, sfreq, high_pass):
+    """
+    Discrete cosine drift basis removing frequencies below high_pass (as nilearn's 'cosine' drift model).
+
+    Parameters
+    ----------
+    n_times : int
+        Number of samples
+    sfreq : float
+        Sampling rate in Hz
+    high_pass : float
+        Cut-off frequency in Hz
+
+    Returns
+    -------
+    ndarray, shape (n_times, n_drifts)
+        Read-only cosines of orders 1..order followed by a constant column, with
+        order = floor(2 * n_times * high_pass / sfreq) (at most n_times - 1)
+    """
+    order = min(int(np.floor(2 * n_times * high_pass / sfreq)), n_times - 1)
+    samples = np.arange(n_times)
+    drift = np.ones((n_times, order + 1))
+    for k in range(1, order + 1):
+        drift[:, k - 1] = np.sqrt(2.0 / n_times) * np.cos(np.pi / n_times * (samples + 0.5) * k)
+    drift.setflags(write=False)
+    return drift
+
+
+def hrf_regressors(envelopes, sfreq, hrf_model=None):
+    """
+    Convolve signals with the HRF, keeping their length.
+
+    Parameters
+    ----------
+    envelopes : ndarray, shape (n_regressors, n_times)
+        EEG band envelopes (or any predictor time courses)
+    sfreq : float
+        Sampling rate in Hz
+    hrf_model : str, optional
+        HRF model. Defaults to NVC_ANALYSIS['glm']['hrf_model'].
+
+    Returns
+    -------
+    ndarray, shape (n_regressors, n_times)
+        Convolved, mean-centred and unit-variance regressors
+    """
+    envelopes = np.atleast_2d(np.asarray(envelopes, dtype=float))
+    n_times = envelopes.shape[-1]
+    convolved = fftconvolve(envelopes, get_hrf(sfreq, hrf_model)[None, :], axes=-1)[:, :n_times]
+    convolved = convolved - convolved.mean(axis=-1, keepdims=True)
+    std = convolved.std(axis=-1, keepdims=True)
+    return convolved / np.where(std > 0, std, 1.0)
+
+
+def design_matrix(envelopes, sfreq, high_pass=None, drift_model=None, hrf_model=None):
+    """
+    Build the design matrix of HRF-convolved regressors and drifts.
+
+    Parameters
+    ----------
+    envelopes : ndarray, shape (n_regressors, n_times)
+        EEG band envelopes
+    sfreq : float
+        Sampling rate in Hz
+    high_pass, drift_model, hrf_model : optional
+        Default to NVC_ANALYSIS['glm']
+
+    Returns
+    -------
+    ndarray, shape (n_times, n_regressors + n_drifts)
+        Design matrix; the regressors come first
+    """
+    params = NVC_ANALYSIS['glm']
+    high_pass = params['high_pass'] if high_pass is None else high_pass
+    drift_model = drift_model or params['drift_model']
+    regressors = hrf_regressors(envelopes, sfreq, hrf_model).T
+    n_times = regressors.shape[0]
+    if drift_model == 'cosine':
+        drift = cosine_drift(n_times, float(sfreq), float(high_pass))
+    elif drift_model is None or drift_model == 'none':
+        drift = np.ones((n_times, 1))
+    else:
+        raise ValueError(f"Unknown drift model: {drift_model}")
+    return np.hstack([regressors, drift])
+
+
+def _ols(design, data):
+    """Solve data = design @ beta for all columns of data with one QR factorization."""
+    q, r = np.linalg.qr(design)
+    beta = np.linalg.solve(r, q.T @ data)
+    residuals = data - design @ beta
+    r_inv = np.linalg.inv(r)
+    # Diagonal of (X^T X)^-1 = R^-1 R^-T
+    unscaled_var = np.sum(r_inv ** 2, axis=1)
+    return beta, residuals, unscaled_var
+
+
+def _ar1_coefficients(residuals):
+    """Lag-1 autocorrelation of every residual column."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rho = np.sum(residuals[1:] * residuals[:-1], axis=0) / np.sum(residuals ** 2, axis=0)
+    return np.clip(np.nan_to_num(rho), -0.99, 0.99)
+
+
+def _ar1_whiten(signals, rho):
+    """Prewhiten the columns of signals with an AR(1) coefficient (Prais-Winsten)."""
+    whitened = np.empty_like(signals)
+    whitened[0] = signals[0] * np.sqrt(1 - rho ** 2)
+    whitened[1:] = signals[1:] - rho * signals[:-1]
+    return whitened
+
+
+def fit_glm(design, data, noise_model='ols'):
+    """
+    Fit the GLM of all channels.
+
+    Parameters
+    ----------
+    design : ndarray, shape (n_times, n_columns)
+        Design matrix
+    data : ndarray, shape (n_channels, n_times)
+        fNIRS signals, all channels and chromophores
+    noise_model : str, optional
+        'ols' or 'ar1' (prewhitening with per-channel AR(1) coefficients)
+
+    Returns
+    -------
+    dict
+        {'beta': (n_columns, n_channels), 't': (n_columns, n_channels),
+         'sigma2': (n_channels,), 'rho': (n_channels,) or None, 'dof': int}
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=float)).T
+    n_times, n_columns = design.shape
+    dof = n_times - n_columns
+    beta, residuals, unscaled_var = _ols(design, data)
+    unscaled_var = np.repeat(unscaled_var[:, None], data.shape[1], axis=1)
+    rho = None
+
+    if noise_model == 'ar1':
+        rho = np.round(_ar1_coefficients(residuals), AR1_DECIMALS)
+        # One whitened design and factorization per distinct coefficient
+        for value in np.unique(rho):
+            channels = np.flatnonzero(rho == value)
+            beta[:, channels], residuals[:, channels], group_var = _ols(
+                _ar1_whiten(design, value), _ar1_whiten(data[:, channels], value))
+            unscaled_var[:, channels] = group_var[:, None]
+    elif noise_model != 'ols':
+        raise ValueError(f"Unknown noise model: {noise_model}")
+
+    sigma2 = np.sum(residuals ** 2, axis=0) / dof
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_values = beta / np.sqrt(unscaled_var * sigma2[None, :])
+    return {'beta': beta, 't': t_values, 'sigma2': sigma2, 'rho': rho, 'dof': dof}
+
+
+def eeg_informed_glm(envelopes, fnirs, sfreq, regressor_names=None, noise_model='ols', **design_kwargs):
+    """
+    Fit fNIRS signals with HRF-convolved EEG band envelopes.
+
+    Parameters
+    ----------
+    envelopes : ndarray, shape (n_regressors, n_times)
+        EEG band envelopes (e.g., averaged over EEG channels per band)
+    fnirs : ndarray, shape (n_fnirs, n_times)
+        fNIRS signals at the same rate
+    sfreq : float
+        Sampling rate in Hz
+    regressor_names : list of str, optional
+        Names of the envelope regressors
+    noise_model : str, optional
+        'ols' or 'ar1'
+    **design_kwargs
+        Passed to design_matrix (high_pass, drift_model, hrf_model)
+
+    Returns
+    -------
+    dict
+        fit_glm output restricted to the envelope regressors ('beta' and 't'
+        of shape (n_regressors, n_fnirs)), plus 'regressors' (names) and
+        'design' (the full design matrix)
+    """
+    envelopes = np.atleast_2d(envelopes)
+    n_regressors = envelopes.shape[0]
+    design = design_matrix(envelopes, sfreq, **design_kwargs)
+    result = fit_glm(design, fnirs, noise_model)
+    result['beta'] = result['beta'][:n_regressors]
+    result['t'] = result['t'][:n_regressors]
+    result['regressors'] = regressor_names or [f"regressor_{i}" for i in range(n_regressors)]
+    result['design'] = design
+    return result
+
+
+def eeg_band_glm(eeg, fnirs, sfreq, key=None, sfreq_out=None, eeg_picks=None, bands=None, noise_model='ols',
+                 **design_kwargs):
+    """
+    EEG-informed GLM of one recording with one regressor per EEG band.
+
+    Band envelopes come from the shared filter bank (and its cache) and are
+    averaged over the picked EEG channels.
+
+    Parameters
+    ----------
+    eeg : ndarray, shape (n_eeg, n_times)
+        EEG signals
+    fnirs : ndarray, shape (n_fnirs, n_times)
+        fNIRS signals at the same rate
+    sfreq : float
+        Sampling rate of eeg and fnirs in Hz
+    key : hashable, optional
+        Recording key of the envelope cache
+    sfreq_out : float, optional
+        Rate the model is fitted at (e.g., the fNIRS rate)
+    eeg_picks : array-like of int, optional
+        EEG channels averaged into the regressors. Defaults to all.
+    bands : dict, optional
+        Band name -> (l_freq, h_freq). Defaults to EEG_PREPROCESSING['bands'].
+    noise_model : str, optional
+        'ols' or 'ar1'
+    **design_kwargs
+        Passed to design_matrix
+
+    Returns
+    -------
+    dict
+        eeg_informed_glm output with one regressor per band
+    """
+    filter_bank = get_filter_bank(sfreq, bands)
+    sfreq_out = sfreq_out or sfreq
+    envelopes = filter_bank.envelopes(eeg, key=key, sfreq_out=sfreq_out)
+    if eeg_picks is not None:
+        envelopes = envelopes[np.asarray(eeg_picks)]
+    fnirs = resample(fnirs, sfreq, sfreq_out) if sfreq_out != sfreq else np.asarray(fnirs)
+    n_times = min(envelopes.shape[-1], fnirs.shape[-1])
+    return eeg_informed_glm(envelopes.mean(axis=0)[:, :n_times], fnirs[:, :n_times], sfreq_out,
+                            regressor_names=filter_bank.band_names, noise_model=noise_model, **design_kwargs)
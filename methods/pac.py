@@ -0,0 +1,384 @@
+"""
+Phase-amplitude coupling between slow fNIRS phase and EEG amplitude.
+
+The comodulogram grid comes from NVC_ANALYSIS['pac']: low (phase) frequencies
+from low_fq_range in steps of low_fq_width taken from fNIRS channels, high
+(amplitude) frequencies from high_fq_range in steps of high_fq_width taken
+from EEG channels.
+
+Band filters are Gaussian frequency responses (full width at half maximum
+equal to the band width) designed once per (n_times, sfreq, band). Each
+channel is transformed with one FFT, and all band-limited analytic signals
+are read directly from its spectrum (FFT-based Hilbert transform) at a
+decimated rate. Amplitude bands are demodulated first, so their magnitude is
+the exact envelope. Phases and amplitudes are cached per channel set and
+band. The coupling values of all channel pairs and bands are then computed
+as sparse/dense matrix products over the cached signals.
+
+'tort', 'penny' and 'ozkurt' are computed natively. 'duprelatour' (driven
+autoregressive models) is delegated to pactools per channel pair.
+"""
+
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.fft import rfft, ifft
+from scipy import sparse
+
+from config.parameters import NVC_ANALYSIS
+
+NATIVE_METHODS = ('tort', 'penny', 'ozkurt')
+DEFAULT_N_BINS = 18
+FWHM_TO_STD = 1.0 / (2.0 * np.sqrt(2.0 * np.log(2.0)))
+
+
+def frequency_grid(fq_range, fq_width):
+    """Return the band centers from fq_range[0] to fq_range[1] in steps of fq_width."""
+    return np.arange(fq_range[0], fq_range[1] + fq_width * 1e-6, fq_width)
+
+
+def default_decim_sfreq(params=None):
+    """
+    Return the sampling rate of the decimated analytic signals for a PAC grid.
+
+    It covers the amplitude band widths (baseband after demodulation) and the
+    highest phase frequency with margin for the Gaussian filter tails.
+    """
+    params = params or NVC_ANALYSIS['pac']
+    return 4.0 * max(params['high_fq_width'], params['low_fq_range'][1] + params['low_fq_width'])
+
+
+@lru_cache(maxsize=32)
+def design_band_filters(n_times, sfreq, centers, width, n_decim, demodulate):
+    """
+    Design the frequency-domain band filters of one set of bands.
+
+    Parameters
+    ----------
+    n_times : int
+        Number of samples of the signals
+    sfreq : float
+        Sampling rate of the signals in Hz
+    centers : tuple of float
+        Band center frequencies in Hz
+    width : float
+        Band width (full width at half maximum) in Hz
+    n_decim : int
+        Number of samples of the decimated analytic signals
+    demodulate : bool
+        Whether each band is shifted to baseband (amplitude) or kept in place (phase)
+
+    Returns
+    -------
+    tuple
+        (bins, response): rfft bin indices of shape (n_bands, n_decim) and the
+        filter responses at those bins (zero outside the positive spectrum),
+        both read-only
+    """
+    n_rfft = n_times // 2 + 1
+    offsets = np.fft.fftfreq(n_decim, d=1.0 / n_decim).astype(int)  # 0, 1, ..., -1 in FFT order
+    shifts = np.array([int(round(c * n_times / sfreq)) if demodulate else 0 for c in centers])
+    bins = shifts[:, None] + offsets[None, :]
+    valid = (bins >= 0) & (bins < n_rfft)
+    freqs = bins * sfreq / n_times
+    sigma = width * FWHM_TO_STD
+    response = np.exp(-0.5 * ((freqs - np.asarray(centers)[:, None]) / sigma) ** 2)
+    # Analytic signal: positive frequencies doubled, DC kept, negative frequencies removed
+    response = np.where(bins > 0, 2.0 * response, response) * valid
+    bins = np.clip(bins, 0, n_rfft - 1)
+    bins.setflags(write=False)
+    response.setflags(write=False)
+    return bins, response
+
+
+def band_analytic_signals(signals, sfreq, centers, width, n_decim, demodulate):
+    """
+    Decimated analytic signals of every channel in every band.
+
+    Parameters
+    ----------
+    signals : ndarray, shape (n_channels, n_times)
+        Input signals
+    sfreq : float
+        Sampling rate in Hz
+    centers : array-like of float
+        Band center frequencies in Hz
+    width : float
+        Band width in Hz
+    n_decim : int
+        Number of output samples
+    demodulate : bool
+        If True, each band is shifted to baseband, which keeps the magnitude
+        (envelope) but not the phase
+
+    Returns
+    -------
+    ndarray, shape (n_channels, n_bands, n_decim)
+        Complex analytic signals
+    """
+    signals = np.asarray(signals, dtype=float)
+    n_times = signals.shape[-1]
+    bins, response = design_band_filters(n_times, float(sfreq), tuple(float(c) for c in centers),
+                                         float(width), int(n_decim), bool(demodulate))
+    spectrum = rfft(signals - signals.mean(axis=-1, keepdims=True), axis=-1)
+    # (n_channels, n_bands, n_decim) spectra of all bands, one inverse FFT per band
+    band_spectra = spectrum[:, bins] * response[None]
+    return ifft(band_spectra, axis=-1) * (n_decim / n_times)
+
+
+class PACEngine:
+    """
+    Comodulogram computation with shared filter designs and cached analytic signals.
+
+    Every band must end below the Nyquist frequency sfreq / 2, otherwise
+    ValueError is raised.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling rate of the input signals in Hz
+    params : dict, optional
+        PAC parameters. Defaults to NVC_ANALYSIS['pac'].
+    decim_sfreq : float, optional
+        Sampling rate of the cached phases and amplitudes. Defaults to default_decim_sfreq(params).
+    n_bins : int, optional
+        Number of phase bins for the 'tort' method
+    n_jobs : int, optional
+        Number of threads used across fNIRS channel batches
+    """
+
+    def __init__(self, sfreq, params=None, decim_sfreq=None, n_bins=DEFAULT_N_BINS, n_jobs=1):
+        self.sfreq = float(sfreq)
+        self.params = params or NVC_ANALYSIS['pac']
+        self.low_fq = frequency_grid(self.params['low_fq_range'], self.params['low_fq_width'])
+        self.high_fq = frequency_grid(self.params['high_fq_range'], self.params['high_fq_width'])
+        # Bands reaching Nyquist wrap around the spectrum or come out empty
+        nyquist = self.sfreq / 2.0
+        for name, centers, width in [('low', self.low_fq, self.params['low_fq_width']),
+                                     ('high', self.high_fq, self.params['high_fq_width'])]:
+            if len(centers) and centers[-1] + width / 2.0 >= nyquist:
+                raise ValueError(f"PAC {name}-frequency band at {centers[-1]:g} Hz (width {width:g} Hz) reaches "
+                                 f"the Nyquist frequency {nyquist:g} Hz of the {self.sfreq:g} Hz signals")
+        self.decim_sfreq = decim_sfreq or default_decim_sfreq(self.params)
+        self.n_bins = n_bins
+        self.n_jobs = n_jobs
+        self._phase_cache = {}
+        self._amplitude_cache = {}
+
+    def _n_decim(self, n_times):
+        return int(np.ceil(n_times * self.decim_sfreq / self.sfreq))
+
+    def phases(self, low_signals, key=None):
+        """
+        Phases of the low-frequency bands, shape (n_channels, n_low, n_decim).
+
+        Parameters
+        ----------
+        low_signals : ndarray, shape (n_channels, n_times)
+            Slow signals (fNIRS)
+        key : hashable, optional
+            Cache key identifying the signals; results are reused for the same key
+        """
+        if key is not None and key in self._phase_cache:
+            return self._phase_cache[key]
+        analytic = band_analytic_signals(low_signals, self.sfreq, self.low_fq, self.params['low_fq_width'],
+                                         self._n_decim(low_signals.shape[-1]), demodulate=False)
+        phase = np.angle(analytic).astype(np.float32)
+        if key is not None:
+            self._phase_cache[key] = phase
+        return phase
+
+    def amplitudes(self, high_signals, key=None):
+        """
+        Envelopes of the high-frequency bands, shape (n_channels, n_high, n_decim).
+
+        Parameters
+        ----------
+        high_signals : ndarray, shape (n_channels, n_times)
+            Fast signals (EEG)
+        key : hashable, optional
+            Cache key identifying the signals; results are reused for the same key
+        """
+        if key is not None and key in self._amplitude_cache:
+            return self._amplitude_cache[key]
+        analytic = band_analytic_signals(high_signals, self.sfreq, self.high_fq, self.params['high_fq_width'],
+                                         self._n_decim(high_signals.shape[-1]), demodulate=True)
+        amplitude = np.abs(analytic).astype(np.float32)
+        if key is not None:
+            self._amplitude_cache[key] = amplitude
+        return amplitude
+
+    def clear_cache(self):
+        """Drop all cached phases and amplitudes."""
+        self._phase_cache.clear()
+        self._amplitude_cache.clear()
+
+    def comodulogram(self, low_signals, high_signals, method=None, low_key=None, high_key=None, batch_size=4):
+        """
+        Compute the comodulogram of every (low channel, high channel) pair.
+
+        Parameters
+        ----------
+        low_signals : ndarray, shape (n_low_channels, n_times)
+            Slow signals providing the phase (fNIRS)
+        high_signals : ndarray, shape (n_high_channels, n_times)
+            Fast signals providing the amplitude (EEG)
+        method : str, optional
+            'tort', 'penny', 'ozkurt' or 'duprelatour'. Defaults to params['method'].
+        low_key, high_key : hashable, optional
+            Cache keys of the low and high signals
+        batch_size : int, optional
+            Number of low channels per batch (and per thread)
+
+        Returns
+        -------
+        ndarray, shape (n_low_channels, n_high_channels, n_low, n_high)
+            Coupling values
+        """
+        method = method or self.params['method']
+        if method not in NATIVE_METHODS:
+            return self._pactools_comodulogram(low_signals, high_signals, method)
+        phase = self.phases(np.atleast_2d(low_signals), key=low_key)
+        amplitude = self.amplitudes(np.atleast_2d(high_signals), key=high_key)
+        return self.comodulogram_from_cache(phase, amplitude, method, batch_size)
+
+    def comodulogram_from_cache(self, phase, amplitude, method=None, batch_size=4):
+        """
+        Compute the comodulogram from precomputed phases and amplitudes.
+
+        Parameters
+        ----------
+        phase : ndarray, shape (n_low_channels, n_low, n_decim)
+            Output of phases()
+        amplitude : ndarray, shape (n_high_channels, n_high, n_decim)
+            Output of amplitudes() (may be a surrogate, e.g. time-shifted)
+        method : str, optional
+            'tort', 'penny' or 'ozkurt'. Defaults to params['method'].
+        batch_size : int, optional
+            Number of low channels per batch (and per thread)
+
+        Returns
+        -------
+        ndarray, shape (n_low_channels, n_high_channels, n_low, n_high)
+            Coupling values
+        """
+        method = method or self.params['method']
+        compute = {'tort': self._tort, 'penny': self._penny, 'ozkurt': self._ozkurt}[method]
+        n_low_ch, n_low, n_decim = phase.shape
+        n_high_ch, n_high, _ = amplitude.shape
+        amp_matrix = amplitude.reshape(n_high_ch * n_high, n_decim).astype(np.float64)
+
+        batches = [slice(c, min(c + batch_size, n_low_ch)) for c in range(0, n_low_ch, batch_size)]
+        result = np.empty((n_low_ch, n_high_ch, n_low, n_high))
+
+        def run(batch):
+            # values: (n_high_ch * n_high, n_batch * n_low)
+            values = compute(phase[batch].reshape(-1, n_decim), amp_matrix)
+            n_batch = batch.stop - batch.start
+            result[batch] = values.reshape(n_high_ch, n_high, n_batch, n_low).transpose(2, 0, 3, 1)
+
+        if self.n_jobs > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+                list(pool.map(run, batches))
+        else:
+            for batch in batches:
+                run(batch)
+        return result
+
+    def _tort(self, phase, amp_matrix):
+        """Tort modulation index for all (phase row, amplitude row) combinations."""
+        n_phase, n_decim = phase.shape
+        n_bins = self.n_bins
+        bin_idx = np.clip(((phase + np.pi) / (2 * np.pi) * n_bins).astype(int), 0, n_bins - 1)
+        # Sparse one-hot (time x phase row * bin): amplitude sums per bin for all rows by one product
+        cols = (np.arange(n_phase)[:, None] * n_bins + bin_idx).ravel()
+        rows = np.tile(np.arange(n_decim), n_phase)
+        one_hot = sparse.csc_matrix((np.ones(len(cols)), (rows, cols)), shape=(n_decim, n_phase * n_bins))
+        sums = np.asarray(amp_matrix @ one_hot).reshape(-1, n_phase, n_bins)
+        counts = np.asarray(one_hot.sum(axis=0)).reshape(n_phase, n_bins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_amp = np.where(counts > 0, sums / counts, 0.0)
+            dist = mean_amp / mean_amp.sum(axis=-1, keepdims=True)
+            entropy = -np.sum(np.where(dist > 0, dist * np.log(dist), 0.0), axis=-1)
+        return (np.log(n_bins) - entropy) / np.log(n_bins)
+
+    def _penny(self, phase, amp_matrix):
+        """Explained variance of the GLM amplitude ~ 1 + cos(phase) + sin(phase) (Penny et al., 2008)."""
+        n_decim = phase.shape[-1]
+        cos, sin = np.cos(phase).astype(np.float64), np.sin(phase).astype(np.float64)
+        # Normal equations of all regressions share the Gram matrices of the phase regressors
+        gram = np.empty((phase.shape[0], 3, 3))
+        gram[:, 0, 0] = n_decim
+        gram[:, 0, 1] = gram[:, 1, 0] = cos.sum(axis=-1)
+        gram[:, 0, 2] = gram[:, 2, 0] = sin.sum(axis=-1)
+        gram[:, 1, 1] = (cos * cos).sum(axis=-1)
+        gram[:, 1, 2] = gram[:, 2, 1] = (cos * sin).sum(axis=-1)
+        gram[:, 2, 2] = (sin * sin).sum(axis=-1)
+        amp_sum = amp_matrix.sum(axis=-1)
+        xty = np.stack([
+            np.broadcast_to(amp_sum[:, None], (amp_matrix.shape[0], phase.shape[0])),
+            amp_matrix @ cos.T,
+            amp_matrix @ sin.T
+        ], axis=-1)                                                       # (n_amp, n_phase, 3)
+        beta = np.einsum('pij,apj->api', np.linalg.pinv(gram), xty)
+        explained = np.einsum('api,api->ap', beta, xty) - (amp_sum ** 2 / n_decim)[:, None]
+        total = (amp_matrix ** 2).sum(axis=-1) - amp_sum ** 2 / n_decim
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return explained / total[:, None]
+
+    def _ozkurt(self, phase, amp_matrix):
+        """Normalized direct PAC estimate (Ozkurt & Schnitzler, 2011)."""
+        n_decim = phase.shape[-1]
+        cos, sin = np.cos(phase).astype(np.float64), np.sin(phase).astype(np.float64)
+        real = amp_matrix @ cos.T
+        imag = amp_matrix @ sin.T
+        norm = np.sqrt(n_decim * (amp_matrix ** 2).sum(axis=-1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(real ** 2 + imag ** 2) / norm[:, None]
+
+    def _pactools_comodulogram(self, low_signals, high_signals, method):
+        """Fallback to pactools for methods without a native implementation."""
+        from pactools import Comodulogram
+
+        low_signals = np.atleast_2d(low_signals)
+        high_signals = np.atleast_2d(high_signals)
+        estimator = Comodulogram(fs=self.sfreq, low_fq_range=self.low_fq, low_fq_width=self.params['low_fq_width'],
+                                 high_fq_range=self.high_fq, high_fq_width=self.params['high_fq_width'],
+                                 method=method, n_jobs=self.n_jobs)
+        result = np.empty((len(low_signals), len(high_signals), len(self.low_fq), len(self.high_fq)))
+        for i, low in enumerate(low_signals):
+            for j, high in enumerate(high_signals):
+                result[i, j] = estimator.fit(low, high).comod_
+        return result
+
+
+def compute_comodulogram(low_signals, high_signals, sfreq, params=None, n_jobs=1):
+    """
+    Comodulogram of all fNIRS (phase) x EEG (amplitude) channel pairs.
+
+    Parameters
+    ----------
+    low_signals : ndarray, shape (n_fnirs, n_times)
+        fNIRS signals providing the phase
+    high_signals : ndarray, shape (n_eeg, n_times)
+        EEG signals providing the amplitude
+    sfreq : float
+        Common sampling rate in Hz
+    params : dict, optional
+        PAC parameters. Defaults to NVC_ANALYSIS['pac'].
+    n_jobs : int, optional
+        Number of threads
+
+    Returns
+    -------
+    dict
+        {'low_fq': ndarray, 'high_fq': ndarray,
+         'comod': ndarray of shape (n_fnirs, n_eeg, n_low, n_high)}
+    """
+    engine = PACEngine(sfreq, params=params, n_jobs=n_jobs)
+    return {
+        'low_fq': engine.low_fq,
+        'high_fq': engine.high_fq,
+        'comod': engine.comodulogram(low_signals, high_signals)
+    }
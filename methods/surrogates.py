@@ -0,0 +1,420 @@
+"""
+Surrogate (permutation) statistics for PAC and time-lagged correlation.
+
+The fNIRS side of each coupling measure is replaced by surrogates that break
+its temporal relation to the EEG: circular time shifts or shuffled blocks,
+configured in NVC_ANALYSIS['surrogates'].
+
+Surrogates are generated lazily per chunk and reduced into running
+statistics (exceedance counts, mean, variance, and for family-wise
+correction the count of surrogates whose maximum reaches each observed
+value), so memory does not depend on the number of surrogates. Chunks are spread over a process pool; every chunk draws from
+its own seed derived from the base seed and the chunk index, so results do
+not depend on the number of workers.
+
+Filtering is done once. PAC surrogates reuse the cached decimated phases and
+envelopes of methods.pac. For time shifts of the lagged correlation, one
+circular cross-correlation per EEG batch holds the correlation at every
+shift, so each surrogate is a lookup.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.fft import rfft, irfft
+
+from config.parameters import NVC_ANALYSIS
+from methods.pac import PACEngine
+from methods.time_delay import lagged_correlation, DEFAULT_MAX_MEMORY_MB
+
+SURROGATE_METHODS = ('time_shift', 'block_shuffle')
+
+# Cached signals of the current worker process, set by _init_worker
+_WORKER_STATE = {}
+
+
+def chunk_rng(seed, chunk_index):
+    """Return the random generator of one chunk, independent of the worker it runs on."""
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(chunk_index,)))
+
+
+def surrogate_chunks(n_surrogates, chunk_size):
+    """Return (chunk_index, n_in_chunk) for every chunk of surrogates."""
+    return [(i, min(chunk_size, n_surrogates - start))
+            for i, start in enumerate(range(0, n_surrogates, chunk_size))]
+
+
+def random_shifts(rng, n, n_times, min_shift):
+    """
+    Draw circular shifts in [min_shift, n_times - min_shift].
+
+    Parameters
+    ----------
+    rng : numpy.random.Generator
+        Random generator
+    n : int
+        Number of shifts
+    n_times : int
+        Signal length in samples
+    min_shift : int
+        Smallest shift in samples in both directions
+
+    Returns
+    -------
+    ndarray
+        Shifts in samples
+    """
+    if 2 * min_shift >= n_times:
+        raise ValueError(f"min_shift of {min_shift} samples is too long for {n_times} samples")
+    return rng.integers(min_shift, n_times - min_shift + 1, size=n)
+
+
+def block_shuffle(signals, rng, block_size):
+    """
+    Shuffle blocks of samples along the last axis; a trailing partial block stays in place.
+
+    Parameters
+    ----------
+    signals : ndarray, shape (..., n_times)
+        Signals
+    rng : numpy.random.Generator
+        Random generator
+    block_size : int
+        Block length in samples
+
+    Returns
+    -------
+    ndarray
+        Shuffled copy of signals
+    """
+    n_times = signals.shape[-1]
+    n_blocks = n_times // block_size
+    if n_blocks < 2:
+        raise ValueError(f"Block size of {block_size} samples leaves fewer than 2 blocks in {n_times} samples")
+    order = rng.permutation(n_blocks)
+    head = signals[..., :n_blocks * block_size].reshape(signals.shape[:-1] + (n_blocks, block_size))
+    shuffled = np.empty_like(signals)
+    shuffled[..., :n_blocks * block_size] = head[..., order, :].reshape(signals.shape[:-1] + (-1,))
+    shuffled[..., n_blocks * block_size:] = signals[..., n_blocks * block_size:]
+    return shuffled
+
+
+def make_surrogate(signals, rng, method, min_shift, block_size):
+    """Return one surrogate of signals (shape (..., n_times)) for the given method."""
+    if method == 'time_shift':
+        return np.roll(signals, random_shifts(rng, 1, signals.shape[-1], min_shift)[0], axis=-1)
+    if method == 'block_shuffle':
+        return block_shuffle(signals, rng, block_size)
+    raise ValueError(f"Unknown surrogate method: {method}. Use one of {SURROGATE_METHODS}")
+
+
+class NullDistribution:
+    """
+    Running summary of surrogate statistics.
+
+    Only element-wise sums and counts are kept: how often a surrogate value,
+    and the surrogate's maximum over max_axes (family-wise correction),
+    reaches each observed value.
+
+    Parameters
+    ----------
+    observed : ndarray
+        Observed statistics
+    max_axes : tuple of int, optional
+        Axes the family-wise maximum is taken over. If None, all axes.
+    """
+
+    def __init__(self, observed, max_axes=None):
+        self.observed = np.asarray(observed, dtype=float)
+        self.max_axes = max_axes
+        self.n = 0
+        self.n_exceed = np.zeros(self.observed.shape, dtype=np.int64)
+        self.sum = np.zeros(self.observed.shape)
+        self.sum_sq = np.zeros(self.observed.shape)
+        self.n_max_exceed = np.zeros(self.observed.shape, dtype=np.int64)
+        self._observed_finite = np.nan_to_num(self.observed)
+
+    def update(self, values):
+        """
+        Add the statistics of one surrogate (same shape as observed).
+
+        Returns
+        -------
+        ndarray
+            Maximum of the surrogate over max_axes (keepdims)
+        """
+        values = np.nan_to_num(np.asarray(values, dtype=float))
+        self.n += 1
+        self.n_exceed += values >= self.observed
+        self.sum += values
+        self.sum_sq += values ** 2
+        max_values = values.max(axis=self.max_axes, keepdims=True)
+        self.n_max_exceed += max_values >= self._observed_finite
+        return max_values
+
+    def merge(self, other):
+        """Add the surrogates summarized by another NullDistribution of the same elements."""
+        self.n += other.n
+        self.n_exceed += other.n_exceed
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.n_max_exceed += other.n_max_exceed
+        return self
+
+    def summary(self):
+        """
+        Return p-values and z-scores of the observed statistics.
+
+        Returns
+        -------
+        dict
+            {'observed', 'p_value', 'p_value_fwer', 'z', 'null_mean', 'null_std', 'n_surrogates'}
+        """
+        mean = self.sum / max(self.n, 1)
+        std = np.sqrt(np.maximum(self.sum_sq / max(self.n, 1) - mean ** 2, 0))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z = (self.observed - mean) / std
+        return {
+            'observed': self.observed,
+            'p_value': (self.n_exceed + 1) / (self.n + 1),
+            'p_value_fwer': (self.n_max_exceed + 1) / (self.n + 1),
+            'z': z,
+            'null_mean': mean,
+            'null_std': std,
+            'n_surrogates': self.n
+        }
+
+
+def _init_worker(state):
+    """Store the cached signals of a surrogate run in the worker process."""
+    _WORKER_STATE.clear()
+    _WORKER_STATE.update(state)
+
+
+def _run_chunks(task, chunks, state, n_jobs):
+    """Run task(chunk) for every chunk, in a process pool if n_jobs > 1, and return the results in order."""
+    if n_jobs > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(state,)) as pool:
+            return list(pool.map(task, chunks))
+    _init_worker(state)
+    try:
+        return [task(chunk) for chunk in chunks]
+    finally:
+        _WORKER_STATE.clear()
+
+
+def _surrogate_params(n_surrogates, method, min_shift_seconds, block_seconds, chunk_size, seed):
+    """Fill unset surrogate parameters from NVC_ANALYSIS['surrogates']."""
+    params = dict(NVC_ANALYSIS['surrogates'])
+    given = {'n_surrogates': n_surrogates, 'method': method, 'min_shift_seconds': min_shift_seconds,
+             'block_seconds': block_seconds, 'chunk_size': chunk_size, 'seed': seed}
+    params.update({key: value for key, value in given.items() if value is not None})
+    if params['method'] not in SURROGATE_METHODS:
+        raise ValueError(f"Unknown surrogate method: {params['method']}. Use one of {SURROGATE_METHODS}")
+    return params
+
+
+def _pac_chunk(chunk):
+    """Null distribution of the PAC surrogates of one chunk (worker task)."""
+    chunk_index, n_in_chunk = chunk
+    state = _WORKER_STATE
+    engine, phase, amplitude = state['engine'], state['phase'], state['amplitude']
+    rng = chunk_rng(state['seed'], chunk_index)
+    null = NullDistribution(state['observed'], max_axes=(0, 1))
+    for _ in range(n_in_chunk):
+        surrogate_phase = make_surrogate(phase, rng, state['method'], state['min_shift'], state['block_size'])
+        null.update(engine.comodulogram_from_cache(surrogate_phase, amplitude, state['pac_method']))
+    return null
+
+
+def pac_surrogate_test(low_signals, high_signals, sfreq, n_surrogates=None, method=None, min_shift_seconds=None,
+                       block_seconds=None, chunk_size=None, seed=None, pac_params=None, n_jobs=1):
+    """
+    Surrogate test of the comodulogram of all fNIRS (phase) x EEG (amplitude) channel pairs.
+
+    The fNIRS phases are filtered once and the surrogates shift or shuffle the
+    cached decimated phases.
+
+    Parameters
+    ----------
+    low_signals : ndarray, shape (n_fnirs, n_times)
+        fNIRS signals providing the phase
+    high_signals : ndarray, shape (n_eeg, n_times)
+        EEG signals providing the amplitude
+    sfreq : float
+        Common sampling rate in Hz
+    n_surrogates, method, min_shift_seconds, block_seconds, chunk_size, seed : optional
+        Surrogate parameters. Default to NVC_ANALYSIS['surrogates'].
+    pac_params : dict, optional
+        PAC parameters. Defaults to NVC_ANALYSIS['pac'].
+    n_jobs : int, optional
+        Number of worker processes
+
+    Returns
+    -------
+    dict
+        NullDistribution.summary() with arrays of shape (n_fnirs, n_eeg, n_low, n_high),
+        plus 'low_fq' and 'high_fq'. 'p_value_fwer' is corrected over channel
+        pairs within each frequency cell.
+    """
+    params = _surrogate_params(n_surrogates, method, min_shift_seconds, block_seconds, chunk_size, seed)
+    engine = PACEngine(sfreq, params=pac_params)
+    phase = engine.phases(np.atleast_2d(low_signals))
+    amplitude = engine.amplitudes(np.atleast_2d(high_signals))
+    decim_sfreq = phase.shape[-1] * sfreq / np.shape(low_signals)[-1]
+    observed = engine.comodulogram_from_cache(phase, amplitude)
+
+    state = {
+        'engine': engine, 'phase': phase, 'amplitude': amplitude, 'observed': observed,
+        'pac_method': engine.params['method'], 'method': params['method'], 'seed': params['seed'],
+        'min_shift': int(round(params['min_shift_seconds'] * decim_sfreq)),
+        'block_size': max(1, int(round(params['block_seconds'] * decim_sfreq)))
+    }
+    chunks = surrogate_chunks(params['n_surrogates'], params['chunk_size'])
+    null = NullDistribution(observed, max_axes=(0, 1))
+    for partial in _run_chunks(_pac_chunk, chunks, state, n_jobs):
+        null.merge(partial)
+
+    result = null.summary()
+    result.update({'low_fq': engine.low_fq, 'high_fq': engine.high_fq})
+    return result
+
+
+def _peak_abs_corr(x, y, sfreq, min_lag_seconds, max_lag_seconds):
+    """Largest |corr| over the lag range for every (x, y) pair, shape x.shape[:-1] + (n_y,)."""
+    corr = lagged_correlation(x, y, sfreq, min_lag_seconds, max_lag_seconds)['corr']
+    return np.nanmax(np.abs(corr), axis=0)
+
+
+def _circular_correlation(x_spec, y_spec, x_norm, y_norm, n_times):
+    """Circular Pearson correlation at every lag, shape (n_x, n_y, n_times)."""
+    cross = irfft(np.conj(x_spec)[:, None, :] * y_spec[None, :, :], n=n_times, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return cross / (x_norm[:, None, None] * y_norm[None, :, None])
+
+
+def _lag_shift_batch(batch):
+    """
+    Observed and null statistics of one batch of x signals for all circular shifts (worker task).
+
+    Returns the NullDistribution of the batch and the maximum of every shift
+    over the batch, from which _concatenate_batches takes the maximum over all
+    batches. The maxima have the size of the shift list the task receives.
+    """
+    state = _WORKER_STATE
+    x = state['x'][batch]
+    n_times = x.shape[-1]
+    x_spec = rfft(x, axis=-1)
+    x_norm = np.sqrt((x ** 2).sum(axis=-1))
+    corr = _circular_correlation(x_spec, state['y_spec'], x_norm, state['y_norm'], n_times)
+    lags = state['lags']
+
+    observed = np.nanmax(np.abs(corr[..., lags % n_times]), axis=-1)
+    null = NullDistribution(observed)
+    shift_max = np.empty(len(state['shifts']))
+    for i, shift in enumerate(state['shifts']):
+        # np.roll(y, shift) correlates with x at lag tau as the original y at lag tau - shift
+        shift_max[i] = null.update(np.nanmax(np.abs(corr[..., (lags - shift) % n_times]), axis=-1)).item()
+    return null, shift_max
+
+
+def _lag_shuffle_chunk(chunk):
+    """Null distribution of the block-shuffle surrogates of one chunk (worker task)."""
+    chunk_index, n_in_chunk = chunk
+    state = _WORKER_STATE
+    rng = chunk_rng(state['seed'], chunk_index)
+    null = NullDistribution(state['observed'])
+    for _ in range(n_in_chunk):
+        y_surrogate = block_shuffle(state['y'], rng, state['block_size'])
+        null.update(_peak_abs_corr(state['x'], y_surrogate, state['sfreq'], *state['lag_range']))
+    return null
+
+
+def _concatenate_batches(partials):
+    """Summary over all elements from (NullDistribution, shift maxima) of disjoint batches with the same shifts."""
+    nulls = [null for null, _ in partials]
+    combined = NullDistribution(np.concatenate([null.observed for null in nulls]))
+    combined.n = nulls[0].n
+    combined.n_exceed = np.concatenate([null.n_exceed for null in nulls])
+    combined.sum = np.concatenate([null.sum for null in nulls])
+    combined.sum_sq = np.concatenate([null.sum_sq for null in nulls])
+    # Family-wise maximum of every shift over all elements, counted against each observed value
+    shift_max = np.sort(np.max([maxima for _, maxima in partials], axis=0))
+    combined.n_max_exceed = len(shift_max) - np.searchsorted(shift_max, combined._observed_finite, side='left')
+    return combined.summary()
+
+
+def lag_correlation_surrogate_test(x, y, sfreq, min_lag_seconds=None, max_lag_seconds=None, n_surrogates=None,
+                                   method=None, min_shift_seconds=None, block_seconds=None, chunk_size=None,
+                                   seed=None, n_jobs=1, max_memory_mb=DEFAULT_MAX_MEMORY_MB):
+    """
+    Surrogate test of the peak |lagged correlation| of all x (EEG) and y (fNIRS) pairs.
+
+    For 'time_shift', the observed and surrogate peaks are taken from the
+    circular correlation, which differs from lagged_correlation only by the
+    wrapped samples at the edges (at most the largest lag). For
+    'block_shuffle', the exact lagged_correlation is computed per surrogate.
+
+    Parameters
+    ----------
+    x : ndarray, shape (..., n_times)
+        EEG band envelopes (e.g., (n_eeg, n_bands, n_times))
+    y : ndarray, shape (n_y, n_times)
+        fNIRS signals
+    sfreq : float
+        Common sampling rate in Hz
+    min_lag_seconds, max_lag_seconds : float, optional
+        Lag range. Defaults to NVC_ANALYSIS['time_delay'].
+    n_surrogates, method, min_shift_seconds, block_seconds, chunk_size, seed : optional
+        Surrogate parameters. Default to NVC_ANALYSIS['surrogates'].
+    n_jobs : int, optional
+        Number of worker processes
+    max_memory_mb : float, optional
+        Approximate memory budget per worker for the circular correlations
+
+    Returns
+    -------
+    dict
+        NullDistribution.summary() with arrays of shape x.shape[:-1] + (n_y,)
+    """
+    params = _surrogate_params(n_surrogates, method, min_shift_seconds, block_seconds, chunk_size, seed)
+    lag_params = NVC_ANALYSIS['time_delay']
+    min_lag_seconds = lag_params['min_lag_seconds'] if min_lag_seconds is None else min_lag_seconds
+    max_lag_seconds = lag_params['max_lag_seconds'] if max_lag_seconds is None else max_lag_seconds
+
+    x = np.asarray(x, dtype=float)
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    lead_shape = x.shape[:-1]
+    n_times = x.shape[-1]
+    x = x.reshape(-1, n_times)
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+    out_shape = lead_shape + (y.shape[0],)
+
+    if params['method'] == 'block_shuffle':
+        observed = _peak_abs_corr(x, y, sfreq, min_lag_seconds, max_lag_seconds)
+        state = {'x': x, 'y': y, 'sfreq': sfreq, 'observed': observed, 'seed': params['seed'],
+                 'lag_range': (min_lag_seconds, max_lag_seconds),
+                 'block_size': max(1, int(round(params['block_seconds'] * sfreq)))}
+        chunks = surrogate_chunks(params['n_surrogates'], params['chunk_size'])
+        null = NullDistribution(observed)
+        for partial in _run_chunks(_lag_shuffle_chunk, chunks, state, n_jobs):
+            null.merge(partial)
+        result = null.summary()
+    else:
+        # The same shifts for every batch, so the family-wise maximum spans all pairs
+        min_shift = int(round(params['min_shift_seconds'] * sfreq))
+        shifts = np.concatenate([random_shifts(chunk_rng(params['seed'], i), n, n_times, min_shift)
+                                 for i, n in surrogate_chunks(params['n_surrogates'], params['chunk_size'])])
+        lags = np.arange(int(round(min_lag_seconds * sfreq)), int(round(max_lag_seconds * sfreq)) + 1)
+        state = {'x': x, 'y_spec': rfft(y, axis=-1), 'y_norm': np.sqrt((y ** 2).sum(axis=-1)),
+                 'lags': lags, 'shifts': shifts}
+        x_batch = int(max(1, max_memory_mb * 1e6 / (8 * 3 * y.shape[0] * n_times)))
+        batches = [slice(a, min(a + x_batch, x.shape[0])) for a in range(0, x.shape[0], x_batch)]
+        partials = _run_chunks(_lag_shift_batch, batches, state, n_jobs)
+        result = _concatenate_batches(partials)
+
+    for key in ('observed', 'p_value', 'p_value_fwer', 'z', 'null_mean', 'null_std'):
+        result[key] = result[key].reshape(out_shape)
+    return result
+
@@ -0,0 +1,257 @@
+"""
+Time-lagged correlation between EEG band envelopes and fNIRS signals.
+
+Computes the Pearson correlation for every lag in
+[NVC_ANALYSIS['time_delay']['min_lag_seconds'], ['max_lag_seconds']] between
+every EEG channel/band envelope and every fNIRS channel. A positive lag means
+the fNIRS signal follows the EEG envelope.
+
+The lagged cross products of all signal pairs are computed with block-wise
+FFT cross-correlation: per frequency, the cross spectra of all time blocks
+are summed as one batched matrix product, so all lags cost about as much as
+a single time-domain correlation. The per-lag means and variances over the
+overlapping samples come from prefix sums, which gives the exact Pearson
+correlation at every lag.
+"""
+
+import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
+
+from config.parameters import NVC_ANALYSIS
+from preprocessing.filter_bank import get_filter_bank
+from preprocessing.resample import resample
+
+DEFAULT_MAX_MEMORY_MB = 1024
+
+
+def _prefix_sums(signals):
+    """Prefix sums of the signals and of their squares along the last axis, starting at 0."""
+    n_times = signals.shape[-1]
+    cumsum = np.zeros(signals.shape[:-1] + (n_times + 1,))
+    cumsum_sq = np.zeros_like(cumsum)
+    np.cumsum(signals, axis=-1, out=cumsum[..., 1:])
+    np.cumsum(signals ** 2, axis=-1, out=cumsum_sq[..., 1:])
+    return cumsum, cumsum_sq
+
+
+def _window_sums(cumsum, starts, stops):
+    """Sum over [start, stop) for each lag from a prefix-sum array."""
+    return cumsum[..., stops] - cumsum[..., starts]
+
+
+def lagged_cross_products(x, y, min_lag, max_lag, max_memory_mb=DEFAULT_MAX_MEMORY_MB):
+    """
+    Compute sum_t x[a, t] * y[b, t + lag] for all signal pairs and lags via block FFTs.
+
+    Parameters
+    ----------
+    x : ndarray, shape (n_x, n_times)
+        First set of signals
+    y : ndarray, shape (n_y, n_times)
+        Second set of signals
+    min_lag, max_lag : int
+        Lag range in samples (inclusive)
+    max_memory_mb : float, optional
+        Approximate memory budget for the spectra held at once
+
+    Returns
+    -------
+    ndarray, shape (n_lags, n_x, n_y)
+        Cross products for lags min_lag..max_lag
+    """
+    n_x, n_times = x.shape
+    n_y = y.shape[0]
+    n_lags = max_lag - min_lag + 1
+
+    # Block length: the FFT must hold one block plus the lag span without wrap-around
+    n_fft = next_fast_len(max(2 * n_lags, 64))
+    block = n_fft - n_lags + 1
+    n_blocks = -(-n_times // block)
+    n_freqs = n_fft // 2 + 1
+
+    # y is padded so every block can read its lag span; out-of-range samples are zero
+    pad_before = max(0, -min_lag)
+    y_padded = np.zeros((n_y, pad_before + n_blocks * block + max(0, max_lag) + 1))
+    y_padded[:, pad_before:pad_before + n_times] = y
+    x_padded = np.zeros((n_x, n_blocks * block))
+    x_padded[:, :n_times] = x
+
+    # Batch sizes within the memory budget (complex128 spectra)
+    bytes_per_spectrum = n_freqs * 16
+    budget = max_memory_mb * 1e6 / bytes_per_spectrum
+    x_batch = int(max(1, min(n_x, budget / (2 * max(n_y, 1)))))
+    blocks_per_step = int(max(1, min(n_blocks, budget / (2 * (x_batch + n_y)))))
+
+    result = np.empty((n_lags, n_x, n_y))
+    for a0 in range(0, n_x, x_batch):
+        a1 = min(a0 + x_batch, n_x)
+        cross_spectrum = np.zeros((n_freqs, a1 - a0, n_y), dtype=complex)
+        for k0 in range(0, n_blocks, blocks_per_step):
+            k1 = min(k0 + blocks_per_step, n_blocks)
+            starts = np.arange(k0, k1) * block
+            # x blocks: (n_blocks, n_x, block); y segments: (n_blocks, n_y, block + n_lags - 1)
+            x_blocks = np.stack([x_padded[a0:a1, s:s + block] for s in starts])
+            y_offset = pad_before + min_lag
+            y_blocks = np.stack([y_padded[:, s + y_offset:s + y_offset + block + n_lags - 1] for s in starts])
+            x_spec = rfft(x_blocks, n=n_fft, axis=-1)
+            y_spec = rfft(y_blocks, n=n_fft, axis=-1)
+            # Sum over blocks as a batched matrix product per frequency: (f, a, k) @ (f, k, b)
+            cross_spectrum += np.matmul(np.conj(x_spec).transpose(2, 1, 0), y_spec.transpose(2, 0, 1))
+        correlation = irfft(cross_spectrum, n=n_fft, axis=0)[:n_lags]
+        result[:, a0:a1, :] = correlation
+    return result
+
+
+def lagged_correlation(x, y, sfreq, min_lag_seconds=None, max_lag_seconds=None,
+                       max_memory_mb=DEFAULT_MAX_MEMORY_MB):
+    """
+    Pearson correlation between all pairs of x and y signals at every lag.
+
+    Parameters
+    ----------
+    x : ndarray, shape (..., n_times)
+        Leading signals (e.g., EEG band envelopes of shape (n_eeg, n_bands, n_times))
+    y : ndarray, shape (n_y, n_times)
+        Following signals (e.g., fNIRS HbO channels)
+    sfreq : float
+        Common sampling rate of x and y in Hz
+    min_lag_seconds, max_lag_seconds : float, optional
+        Lag range. Defaults to NVC_ANALYSIS['time_delay'].
+    max_memory_mb : float, optional
+        Approximate memory budget for intermediate spectra
+
+    Returns
+    -------
+    dict
+        {'lags': ndarray of lags in seconds,
+         'corr': ndarray of shape (n_lags,) + x.shape[:-1] + (n_y,)}
+    """
+    params = NVC_ANALYSIS['time_delay']
+    min_lag_seconds = params['min_lag_seconds'] if min_lag_seconds is None else min_lag_seconds
+    max_lag_seconds = params['max_lag_seconds'] if max_lag_seconds is None else max_lag_seconds
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    lead_shape = x.shape[:-1]
+    n_times = x.shape[-1]
+    if y.shape[-1] != n_times:
+        raise ValueError(f"x and y must have the same number of samples, got {n_times} and {y.shape[-1]}")
+    x = x.reshape(-1, n_times)
+
+    min_lag = int(round(min_lag_seconds * sfreq))
+    max_lag = int(round(max_lag_seconds * sfreq))
+    if max_lag < min_lag or max(abs(min_lag), abs(max_lag)) >= n_times:
+        raise ValueError(f"Invalid lag range [{min_lag}, {max_lag}] samples for {n_times} samples")
+    lags = np.arange(min_lag, max_lag + 1)
+
+    # Removing the global mean keeps the per-lag moment formulas numerically stable
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+
+    cross = lagged_cross_products(x, y, min_lag, max_lag, max_memory_mb)
+
+    # Overlapping sample ranges per lag and the corresponding first and second moments
+    x_starts, x_stops = np.maximum(0, -lags), np.minimum(n_times, n_times - lags)
+    y_starts, y_stops = np.maximum(0, lags), np.minimum(n_times, n_times + lags)
+    n_overlap = (x_stops - x_starts).astype(float)
+    x_cumsum, x_cumsum_sq = _prefix_sums(x)
+    y_cumsum, y_cumsum_sq = _prefix_sums(y)
+    x_sum = _window_sums(x_cumsum, x_starts, x_stops).T            # (n_lags, n_x)
+    x_var = _window_sums(x_cumsum_sq, x_starts, x_stops).T - x_sum ** 2 / n_overlap[:, None]
+    y_sum = _window_sums(y_cumsum, y_starts, y_stops).T            # (n_lags, n_y)
+    y_var = _window_sums(y_cumsum_sq, y_starts, y_stops).T - y_sum ** 2 / n_overlap[:, None]
+
+    covariance = cross - x_sum[:, :, None] * y_sum[:, None, :] / n_overlap[:, None, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = covariance / np.sqrt(np.maximum(x_var, 0)[:, :, None] * np.maximum(y_var, 0)[:, None, :])
+
+    return {
+        'lags': lags / sfreq,
+        'corr': corr.reshape((len(lags),) + lead_shape + (y.shape[0],))
+    }
+
+
+def band_envelope_correlation(eeg, fnirs, sfreq, key=None, sfreq_out=None, bands=None, **kwargs):
+    """
+    Lagged correlation between EEG band envelopes and fNIRS signals of one recording.
+
+    The envelopes come from the shared filter bank of sfreq, so repeated calls
+    with the same key reuse them instead of re-filtering the EEG.
+
+    Parameters
+    ----------
+    eeg : ndarray, shape (n_eeg, n_times)
+        EEG signals
+    fnirs : ndarray, shape (n_fnirs, n_times)
+        fNIRS signals at the same rate
+    sfreq : float
+        Sampling rate of eeg and fnirs in Hz
+    key : hashable, optional
+        Recording key of the envelope cache
+    sfreq_out : float, optional
+        Rate the envelopes and fNIRS signals are decimated to before correlating
+    bands : dict, optional
+        Band name -> (l_freq, h_freq). Defaults to EEG_PREPROCESSING['bands'].
+    **kwargs
+        Passed to lagged_correlation
+
+    Returns
+    -------
+    dict
+        lagged_correlation output with 'corr' of shape (n_lags, n_eeg, n_bands, n_fnirs),
+        plus 'bands' (band names)
+    """
+    filter_bank = get_filter_bank(sfreq, bands)
+    sfreq_out = sfreq_out or sfreq
+    envelopes = filter_bank.envelopes(eeg, key=key, sfreq_out=sfreq_out)
+    fnirs = resample(fnirs, sfreq, sfreq_out) if sfreq_out != sfreq else np.asarray(fnirs)
+    n_times = min(envelopes.shape[-1], fnirs.shape[-1])
+    result = lagged_correlation(envelopes[..., :n_times], fnirs[..., :n_times], sfreq_out, **kwargs)
+    result['bands'] = filter_bank.band_names
+    return result
+
+
+def select_fnirs_channels(ch_types, correlate_with=None):
+    """
+    Return indices of the fNIRS channels selected by NVC_ANALYSIS['time_delay']['correlate_with'].
+
+    Parameters
+    ----------
+    ch_types : list of str
+        Channel types of the fNIRS data (e.g., 'hbo', 'hbr')
+    correlate_with : str, optional
+        'hbo', 'hbr' or 'both'. Defaults to NVC_ANALYSIS['time_delay'].
+
+    Returns
+    -------
+    ndarray
+        Indices into ch_types
+    """
+    correlate_with = correlate_with or NVC_ANALYSIS['time_delay']['correlate_with']
+    wanted = ('hbo', 'hbr') if correlate_with == 'both' else (correlate_with,)
+    return np.array([i for i, ch_type in enumerate(ch_types) if ch_type in wanted], dtype=int)
+
+
+def peak_lags(result, absolute=True):
+    """
+    Lag and value of the strongest correlation for every signal pair.
+
+    Parameters
+    ----------
+    result : dict
+        Output of lagged_correlation
+    absolute : bool, optional
+        Whether to take the peak of |corr| (True) or of corr (False)
+
+    Returns
+    -------
+    dict
+        {'lag': ndarray of peak lags in seconds, 'corr': ndarray of peak correlations},
+        each with the shape of result['corr'] without the lag axis
+    """
+    corr = np.nan_to_num(result['corr'])
+    peak = np.argmax(np.abs(corr) if absolute else corr, axis=0)
+    return {
+        'lag': result['lags'][peak],
+        'corr': np.take_along_axis(corr, peak[None], axis=0)[0]
+    }
@@ -0,0 +1,165 @@
+"""
+EEG filtering of memory-mapped recordings in blocks.
+
+EEG_PREPROCESSING['filter'] is applied as one cascade of second-order
+sections: a Butterworth band-pass l_freq-h_freq followed by IIR notches at
+notch_freq (harmonics at or above Nyquist are skipped). The cascade is
+designed once per sampling rate.
+
+Blocks are read from the input array (typically np.load(..., mmap_mode='r'))
+and written to the output array (typically np.lib.format.open_memmap) while
+the filter state is carried from block to block, so the result equals
+filtering the whole signal and memory depends only on the block size. The
+state starts from the steady-state response to the first sample rather than
+from zero, so a DC offset does not ring through the band-pass: the forward
+pass equals scipy.signal.sosfilt(sos, x, zi=sosfilt_zi(sos)[:, None] * x[:, :1]),
+not plain sosfilt(sos, x).
+
+With zero_phase=True, a second pass runs the same cascade backwards over the
+blocks of the output, in place, again carrying the state. This equals
+scipy.signal.sosfiltfilt(sos, x, padlen=0).
+"""
+
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import butter, iirnotch, tf2sos
+
+from config.parameters import EEG_PREPROCESSING
+from preprocessing.streaming import StatefulSOSFilter
+
+DEFAULT_BLOCK_SECONDS = 10.0
+DEFAULT_FILTER_ORDER = 4
+NOTCH_QUALITY = 30.0
+
+
+@lru_cache(maxsize=None)
+def design_eeg_filter(sfreq, l_freq, h_freq, notch_freqs=(), order=DEFAULT_FILTER_ORDER, notch_quality=NOTCH_QUALITY):
+    """
+    Design the band-pass and notch cascade as second-order sections.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling rate in Hz
+    l_freq, h_freq : float or None
+        Band edges in Hz. None (or h_freq at or above Nyquist) drops that edge.
+    notch_freqs : tuple of float, optional
+        Line-noise frequencies to remove
+    order : int, optional
+        Butterworth order
+    notch_quality : float, optional
+        Quality factor of the notches
+
+    Returns
+    -------
+    ndarray
+        Read-only second-order sections of the whole cascade
+    """
+    nyquist = sfreq / 2.0
+    sections = []
+    has_high = h_freq is not None and h_freq < nyquist
+    if l_freq and has_high:
+        sections.append(butter(order, [l_freq, h_freq], btype='bandpass', fs=sfreq, output='sos'))
+    elif l_freq:
+        sections.append(butter(order, l_freq, btype='highpass', fs=sfreq, output='sos'))
+    elif has_high:
+        sections.append(butter(order, h_freq, btype='lowpass', fs=sfreq, output='sos'))
+    for freq in notch_freqs:
+        if freq < nyquist:
+            sections.append(tf2sos(*iirnotch(freq, notch_quality, fs=sfreq)))
+    if not sections:
+        raise ValueError("The EEG filter configuration does not define any filter")
+    sos = np.vstack(sections)
+    sos.setflags(write=False)
+    return sos
+
+
+def eeg_filter_sos(sfreq, params=None):
+    """Return the memoized cascade of EEG_PREPROCESSING['filter'] (or params) for a sampling rate."""
+    params = params or EEG_PREPROCESSING['filter']
+    return design_eeg_filter(float(sfreq), params.get('l_freq'), params.get('h_freq'),
+                             tuple(params.get('notch_freq') or ()))
+
+
+def filter_eeg(data, sfreq, out=None, picks=None, params=None, zero_phase=False,
+               block_seconds=DEFAULT_BLOCK_SECONDS):
+    """
+    Filter EEG channels block by block with carried filter state.
+
+    The filter starts from its steady state for the first sample of each
+    channel (see the module docstring).
+
+    Parameters
+    ----------
+    data : ndarray or memmap, shape (n_channels, n_times)
+        Input signals
+    sfreq : float
+        Sampling rate in Hz
+    out : ndarray or memmap, shape (n_picks, n_times), optional
+        Output array. If None, a new array is allocated.
+    picks : array-like of int, optional
+        Rows of data to filter. Defaults to all.
+    params : dict, optional
+        Filter configuration. Defaults to EEG_PREPROCESSING['filter'].
+    zero_phase : bool, optional
+        Run a second, backward pass over the output (forward-backward filtering)
+    block_seconds : float, optional
+        Length of the blocks read and written at once
+
+    Returns
+    -------
+    ndarray or memmap
+        out
+    """
+    picks = np.arange(data.shape[0]) if picks is None else np.asarray(picks)
+    n_times = data.shape[-1]
+    out = np.empty((len(picks), n_times)) if out is None else out
+    sos = eeg_filter_sos(sfreq, params)
+    block_samples = max(1, int(block_seconds * sfreq))
+    blocks = [(start, min(start + block_samples, n_times)) for start in range(0, n_times, block_samples)]
+
+    forward = StatefulSOSFilter(sos)
+    for start, stop in blocks:
+        out[:, start:stop] = forward(np.asarray(data[picks, start:stop], dtype=float))
+
+    if zero_phase:
+        backward = StatefulSOSFilter(sos)
+        for start, stop in reversed(blocks):
+            out[:, start:stop] = backward(np.asarray(out[:, start:stop][:, ::-1], dtype=float))[:, ::-1]
+
+    if hasattr(out, 'flush'):
+        out.flush()
+    return out
+
+
+def filter_eeg_file(input_path, output_path, sfreq, picks=None, dtype=np.float64, **kwargs):
+    """
+    Filter EEG channels of a .npy recording into a new .npy file without loading either.
+
+    Parameters
+    ----------
+    input_path : str
+        Input .npy file of shape (n_channels, n_times)
+    output_path : str
+        Output .npy file of shape (n_picks, n_times)
+    sfreq : float
+        Sampling rate in Hz
+    picks : array-like of int, optional
+        Rows to filter. Defaults to all.
+    dtype : numpy dtype, optional
+        Output data type
+    **kwargs
+        Passed to filter_eeg (params, zero_phase, block_seconds)
+
+    Returns
+    -------
+    str
+        output_path
+    """
+    data = np.load(input_path, mmap_mode='r')
+    n_picks = data.shape[0] if picks is None else len(picks)
+    out = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=(n_picks, data.shape[-1]))
+    filter_eeg(data, sfreq, out=out, picks=picks, **kwargs)
+    del out
+    return output_path
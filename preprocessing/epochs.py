@@ -0,0 +1,257 @@
+"""
+Epochs as strided views over continuous (combined) recordings.
+
+Epochs are never copied out of the continuous array: a sliding-window view
+(numpy.lib.stride_tricks) exposes every possible window of the data, and an
+epoch is the window at its start sample. Overlapping resting-state windows
+(RESTING_STATE) and event-locked motor-task epochs (MOTOR_TASK['epoch'])
+therefore cost no memory beyond their start indices, also for memory-mapped
+data.
+
+Baseline correction is applied lazily when epochs are accessed; only the
+accessed epochs are materialized.
+
+Combined recordings in the chunked format (io_mgmt.combined_format) are not
+ndarrays, and a window view of one would first read the whole recording.
+Their epochs are read one by one through CombinedRecording.read instead, and
+strided_view() is not available for them.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from config.parameters import MOTOR_TASK, RESTING_STATE
+
+
+class EpochView:
+    """
+    Lazily baseline-corrected epochs over a continuous array.
+
+    Parameters
+    ----------
+    data : ndarray, memmap or CombinedRecording, shape (n_channels, n_times)
+        Continuous signals
+    sfreq : float
+        Sampling rate in Hz
+    starts : array-like of int
+        First sample of every epoch
+    n_samples : int
+        Samples per epoch
+    tmin : float, optional
+        Time of the first epoch sample relative to its event, in seconds
+    baseline : tuple, optional
+        (bmin, bmax) in seconds relative to the event; None edges mean the epoch
+        start/end. If None, no baseline correction.
+    """
+
+    def __init__(self, data, sfreq, starts, n_samples, tmin=0.0, baseline=None):
+        self.sfreq = float(sfreq)
+        self.starts = np.asarray(starts, dtype=int)
+        self.n_samples = int(n_samples)
+        self.tmin = tmin
+        self.baseline = baseline
+        self._data = data
+        if isinstance(data, np.ndarray):
+            # (n_channels, n_times - n_samples + 1, n_samples) view, no data copied
+            self._windows = sliding_window_view(data, self.n_samples, axis=-1)
+        elif hasattr(data, 'read'):
+            self._windows = None
+        else:
+            raise TypeError(f"Expected an ndarray, memmap or CombinedRecording, got {type(data).__name__}")
+        self._baseline_slice = self._get_baseline_slice()
+
+    @property
+    def times(self):
+        """Epoch sample times in seconds relative to the event."""
+        return self.tmin + np.arange(self.n_samples) / self.sfreq
+
+    def _get_baseline_slice(self):
+        if self.baseline is None:
+            return None
+        bmin, bmax = self.baseline
+        times = self.times
+        first = 0 if bmin is None else int(np.searchsorted(times, bmin - 0.5 / self.sfreq))
+        last = self.n_samples if bmax is None else int(np.searchsorted(times, bmax + 0.5 / self.sfreq))
+        if last <= first:
+            raise ValueError(f"Baseline {self.baseline} is outside the epoch times")
+        return slice(first, last)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def raw(self, index):
+        """
+        Uncorrected view of one epoch.
+
+        Parameters
+        ----------
+        index : int
+            Epoch index
+
+        Returns
+        -------
+        ndarray, shape (n_channels, n_samples)
+            Read-only view into the continuous data (a copy read from a CombinedRecording)
+        """
+        if self._windows is None:
+            start = int(self.starts[index])
+            return self._data.read(start, start + self.n_samples)
+        return self._windows[:, self.starts[index]]
+
+    def __getitem__(self, index):
+        """
+        Baseline-corrected epoch(s).
+
+        An integer index returns one epoch (n_channels, n_samples), which is a
+        view when no baseline is set. Slices and index arrays return
+        (n_selected, n_channels, n_samples) arrays of the selected epochs only.
+        """
+        if np.isscalar(index):
+            epoch = self.raw(index)
+            if self._baseline_slice is None:
+                return epoch
+            return epoch - epoch[:, self._baseline_slice].mean(axis=-1, keepdims=True)
+        starts = self.starts[index]
+        if self._windows is None:
+            epochs = np.array([self._data.read(start, start + self.n_samples) for start in np.atleast_1d(starts)])
+            epochs = epochs.reshape(-1, self._data.shape[0], self.n_samples)
+        else:
+            epochs = self._windows[:, starts].transpose(1, 0, 2)
+        if self._baseline_slice is None:
+            return np.array(epochs)
+        return epochs - epochs[..., self._baseline_slice].mean(axis=-1, keepdims=True)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def strided_view(self):
+        """
+        All epochs as one zero-copy view, if their starts are equally spaced.
+
+        Returns
+        -------
+        ndarray, shape (n_channels, n_epochs, n_samples)
+            Uncorrected read-only view
+
+        Raises
+        ------
+        ValueError
+            If the epoch starts are not equally spaced
+        TypeError
+            If the data is a CombinedRecording, which has no zero-copy view
+        """
+        if self._windows is None:
+            raise TypeError("strided_view() needs ndarray or memmap data; iterate over the epochs instead")
+        steps = np.diff(self.starts)
+        if len(steps) and (steps[0] <= 0 or np.any(steps != steps[0])):
+            raise ValueError("Epoch starts are not equally spaced")
+        step = int(steps[0]) if len(steps) else 1
+        first = int(self.starts[0]) if len(self.starts) else 0
+        return self._windows[:, first::step][:, :len(self)]
+
+    def mean(self, picks=None):
+        """
+        Baseline-corrected average over epochs, accumulated one epoch at a time.
+
+        Parameters
+        ----------
+        picks : array-like of int, optional
+            Channels to average. Defaults to all.
+
+        Returns
+        -------
+        ndarray, shape (n_picks, n_samples)
+            Evoked response
+        """
+        picks = slice(None) if picks is None else np.asarray(picks)
+        total = None
+        for epoch in self:
+            epoch = epoch[picks]
+            total = np.array(epoch, dtype=float) if total is None else total + epoch
+        return total / len(self)
+
+
+def events_from_annotations(annotations, sfreq, descriptions=None):
+    """
+    Event sample indices from sidecar annotations.
+
+    Parameters
+    ----------
+    annotations : list of dict
+        Annotations with 'onset' (seconds) and 'description'
+    sfreq : float
+        Sampling rate in Hz
+    descriptions : list of str, optional
+        Descriptions to keep. Defaults to all.
+
+    Returns
+    -------
+    ndarray
+        Event samples in onset order
+    """
+    onsets = [annot['onset'] for annot in annotations
+              if descriptions is None or annot['description'] in descriptions]
+    return np.sort(np.round(np.asarray(onsets, dtype=float) * sfreq).astype(int))
+
+
+def motor_epochs(data, sfreq, event_samples, tmin=None, tmax=None, baseline='default'):
+    """
+    Event-locked epochs with MOTOR_TASK['epoch'] defaults.
+
+    Events whose epoch does not fit inside the data are dropped.
+
+    Parameters
+    ----------
+    data : ndarray, memmap or CombinedRecording, shape (n_channels, n_times)
+        Continuous signals
+    sfreq : float
+        Sampling rate in Hz
+    event_samples : array-like of int
+        Event samples
+    tmin, tmax : float, optional
+        Epoch limits in seconds. Default to MOTOR_TASK['epoch'].
+    baseline : tuple or None, optional
+        Baseline in seconds. Defaults to MOTOR_TASK['epoch']['baseline'].
+
+    Returns
+    -------
+    EpochView
+        Epochs
+    """
+    params = MOTOR_TASK['epoch']
+    tmin = params['tmin'] if tmin is None else tmin
+    tmax = params['tmax'] if tmax is None else tmax
+    baseline = params['baseline'] if baseline == 'default' else baseline
+    n_samples = int(round((tmax - tmin) * sfreq)) + 1
+    starts = np.asarray(event_samples, dtype=int) + int(round(tmin * sfreq))
+    starts = starts[(starts >= 0) & (starts + n_samples <= data.shape[-1])]
+    return EpochView(data, sfreq, starts, n_samples, tmin=tmin, baseline=baseline)
+
+
+def resting_state_epochs(data, sfreq, duration=None, overlap=None):
+    """
+    Fixed-length, overlapping windows with RESTING_STATE defaults.
+
+    Parameters
+    ----------
+    data : ndarray, memmap or CombinedRecording, shape (n_channels, n_times)
+        Continuous signals
+    sfreq : float
+        Sampling rate in Hz
+    duration, overlap : float, optional
+        Window length and overlap in seconds. Default to RESTING_STATE.
+
+    Returns
+    -------
+    EpochView
+        Epochs without baseline correction; strided_view() returns them all as one view
+    """
+    duration = RESTING_STATE['epoch_duration'] if duration is None else duration
+    overlap = RESTING_STATE['epoch_overlap'] if overlap is None else overlap
+    n_samples = int(round(duration * sfreq))
+    step = int(round((duration - overlap) * sfreq))
+    if step <= 0:
+        raise ValueError(f"Overlap ({overlap} s) must be shorter than the epoch duration ({duration} s)")
+    starts = np.arange(0, data.shape[-1] - n_samples + 1, step)
+    return EpochView(data, sfreq, starts, n_samples)
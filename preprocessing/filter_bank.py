@@ -0,0 +1,184 @@
+"""
+EEG band filter bank with cached band envelopes.
+
+The bands come from EEG_PREPROCESSING['bands']. Each band-pass filter is
+designed once per (sampling rate, band) as second-order sections and applied
+to all channels at once as a zero-phase (forward-backward) 2-D operation.
+Envelopes are the magnitude of the FFT-based analytic signal and can be
+decimated to an fNIRS rate with the polyphase resampler.
+
+Envelopes are kept in a cache keyed by the caller's recording key, the bands
+and the output rate, so lagged correlation, GLM regressors and reports
+filter the raw EEG only once.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+from scipy.fft import next_fast_len
+from scipy.signal import butter, sosfiltfilt, hilbert
+
+from config.parameters import EEG_PREPROCESSING
+from preprocessing.resample import resample
+
+DEFAULT_FILTER_ORDER = 4
+
+
+@lru_cache(maxsize=None)
+def design_band_filter(sfreq, l_freq, h_freq, order=DEFAULT_FILTER_ORDER):
+    """
+    Design a Butterworth band-pass filter as second-order sections.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling rate in Hz
+    l_freq, h_freq : float
+        Band edges in Hz; h_freq at or above Nyquist gives a high-pass
+    order : int, optional
+        Filter order (doubled by zero-phase filtering)
+
+    Returns
+    -------
+    ndarray
+        Read-only second-order sections
+    """
+    nyquist = sfreq / 2.0
+    if h_freq >= nyquist:
+        sos = butter(order, l_freq, btype='highpass', fs=sfreq, output='sos')
+    else:
+        sos = butter(order, [l_freq, h_freq], btype='bandpass', fs=sfreq, output='sos')
+    sos.setflags(write=False)
+    return sos
+
+
+def analytic_envelope(signals, axis=-1):
+    """Magnitude of the analytic signal along axis, with the FFT padded to a fast length."""
+    n_times = signals.shape[axis]
+    analytic = hilbert(signals, N=next_fast_len(n_times), axis=axis)
+    return np.abs(np.take(analytic, np.arange(n_times), axis=axis))
+
+
+class FilterBank:
+    """
+    Band-pass filter bank for one sampling rate.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling rate of the input signals in Hz
+    bands : dict, optional
+        Band name -> (l_freq, h_freq). Defaults to EEG_PREPROCESSING['bands'].
+    order : int, optional
+        Butterworth filter order
+    """
+
+    def __init__(self, sfreq, bands=None, order=DEFAULT_FILTER_ORDER):
+        self.sfreq = float(sfreq)
+        self.bands = dict(bands or EEG_PREPROCESSING['bands'])
+        self.order = order
+        self._cache = {}
+
+    @property
+    def band_names(self):
+        """Band names in output order."""
+        return list(self.bands)
+
+    def sos(self, band):
+        """Return the (memoized) second-order sections of a band."""
+        l_freq, h_freq = self.bands[band]
+        return design_band_filter(self.sfreq, float(l_freq), float(h_freq), self.order)
+
+    def filter(self, data, band):
+        """
+        Zero-phase band-pass filter all channels.
+
+        Parameters
+        ----------
+        data : ndarray, shape (n_channels, n_times)
+            Signals
+        band : str
+            Band name
+
+        Returns
+        -------
+        ndarray, shape (n_channels, n_times)
+            Filtered signals
+        """
+        # sosfilt needs writable coefficients, the cached design stays untouched
+        return sosfiltfilt(np.array(self.sos(band)), data, axis=-1)
+
+    def envelopes(self, data, key=None, sfreq_out=None, bands=None):
+        """
+        Band envelopes of all channels, optionally decimated.
+
+        Bands are processed one at a time, so only one full-rate band of all
+        channels is held in memory at once.
+
+        Parameters
+        ----------
+        data : ndarray, shape (n_channels, n_times)
+            EEG signals
+        key : hashable, optional
+            Identifies the recording; envelopes are cached per (key, band, sfreq_out)
+        sfreq_out : float, optional
+            Output rate (e.g., the fNIRS rate). If None, the input rate is kept.
+        bands : list of str, optional
+            Bands to compute. Defaults to all bands.
+
+        Returns
+        -------
+        ndarray, shape (n_channels, n_bands, n_times_out)
+            Envelopes
+        """
+        bands = bands or self.band_names
+        sfreq_out = float(sfreq_out or self.sfreq)
+        envelopes = []
+        for band in bands:
+            cache_key = (key, band, self.bands[band], sfreq_out)
+            if key is not None and cache_key in self._cache:
+                envelopes.append(self._cache[cache_key])
+                continue
+            envelope = analytic_envelope(self.filter(np.asarray(data, dtype=float), band))
+            if sfreq_out != self.sfreq:
+                envelope = resample(envelope, self.sfreq, sfreq_out)
+            if key is not None:
+                envelope.setflags(write=False)
+                self._cache[cache_key] = envelope
+            envelopes.append(envelope)
+        return np.stack(envelopes, axis=1)
+
+    def clear_cache(self, key=None):
+        """Drop the cached envelopes of one recording key, or all of them."""
+        if key is None:
+            self._cache.clear()
+            return
+        for cache_key in [cache_key for cache_key in self._cache if cache_key[0] == key]:
+            del self._cache[cache_key]
+
+
+@lru_cache(maxsize=None)
+def _shared_filter_bank(sfreq, bands, order):
+    return FilterBank(sfreq, dict(bands), order)
+
+
+def get_filter_bank(sfreq, bands=None, order=DEFAULT_FILTER_ORDER):
+    """
+    Return the shared FilterBank (and its envelope cache) for a sampling rate and band set.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling rate in Hz
+    bands : dict, optional
+        Band name -> (l_freq, h_freq). Defaults to EEG_PREPROCESSING['bands'].
+    order : int, optional
+        Butterworth filter order
+
+    Returns
+    -------
+    FilterBank
+        Filter bank shared by all callers with the same arguments
+    """
+    bands = bands or EEG_PREPROCESSING['bands']
+    return _shared_filter_bank(float(sfreq), tuple((name, tuple(edges)) for name, edges in bands.items()), order)
@@ -0,0 +1,386 @@
+"""
+fNIRS preprocessing of arbitrarily long recordings in blocks.
+
+The stages follow FNIRS_PREPROCESSING:
+- apply_tddr: Temporal Derivative Distribution Repair (Fishburn et al., 2019).
+  The robust weights are fitted on the derivative of the whole recording,
+  which is built block by block in a scratch file and fitted one channel at
+  a time; the corrected signal is then produced block by block.
+- remove_mayer: zero-phase band-stop around the Mayer-wave frequency.
+- filter: band-pass l_freq-h_freq as a causal SOS filter whose state is
+  carried from block to block.
+
+The band-pass around 0.01 Hz is ill-conditioned at EEG rates (at 250 Hz its
+poles lie within 1e-4 of the unit circle and it settles over ~10^6 samples),
+so fNIRS channels of combined recordings are preprocessed at their native
+rate with preprocess_fnirs_resampled and resampled back.
+
+Zero-phase filters run on overlapping blocks whose margins cover the settling
+time of the filter, so block-wise results equal whole-signal processing to
+numerical precision. Data are read through read(start, stop) callables (as
+in preprocessing.resample.ChunkedResampler), so arrays, memmaps and raw
+files can be processed with bounded memory.
+"""
+
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import butter, buttord, sosfilt, sosfiltfilt
+
+from config.parameters import FNIRS_PREPROCESSING
+from preprocessing.resample import ChunkedResampler
+from preprocessing.streaming import StatefulSOSFilter
+
+DEFAULT_BLOCK_SECONDS = 600.0
+SETTLING_TOLERANCE = 1e-12
+
+# TDDR constants of the reference implementation
+TDDR_CUTOFF = 0.5
+TDDR_FILTER_ORDER = 3
+TDDR_TUNE = 4.685
+TDDR_MAX_ITER = 50
+
+MAYER_BAND = (0.08, 0.12)  # Hz
+MAYER_FILTER_ORDER = 2
+
+
+def settling_samples(sos, tolerance=SETTLING_TOLERANCE, max_samples=10 ** 7):
+    """
+    Number of samples after which the impulse response of a filter stays below tolerance.
+
+    Parameters
+    ----------
+    sos : ndarray
+        Second-order sections
+    tolerance : float, optional
+        Threshold relative to the impulse response peak
+    max_samples : int, optional
+        Upper bound of the search
+
+    Returns
+    -------
+    int
+        Settling length in samples
+    """
+    sos = np.array(sos, dtype=float)
+    length = 1024
+    while True:
+        impulse = np.zeros(length)
+        impulse[0] = 1.0
+        response = np.abs(sosfilt(sos, impulse))
+        above = np.flatnonzero(response > tolerance * response.max())
+        if above[-1] < length // 2 or length >= max_samples:
+            return int(above[-1]) + 1
+        length *= 2
+
+
+class ZeroPhaseReader:
+    """
+    Random access to a zero-phase (forward-backward) filtered signal.
+
+    Each requested range is filtered with margins of the filter's settling
+    length on both sides, so results equal filtering the whole signal with
+    scipy.signal.sosfiltfilt(sos, x, padlen=0).
+
+    Parameters
+    ----------
+    read : callable
+        read(start, stop) returning input samples [start, stop) as (n_channels, n) array
+    n_times : int
+        Number of input samples
+    sos : ndarray
+        Second-order sections
+    """
+
+    def __init__(self, read, n_times, sos):
+        self._read = read
+        self.n_times = n_times
+        self.sos = np.array(sos, dtype=float)
+        self.margin = settling_samples(self.sos)
+
+    def read(self, start, stop):
+        """Return filtered samples [start, stop) of all channels."""
+        in_start = max(0, start - self.margin)
+        in_stop = min(self.n_times, stop + self.margin)
+        filtered = sosfiltfilt(self.sos, self._read(in_start, in_stop), axis=-1, padlen=0)
+        return filtered[:, start - in_start:stop - in_start]
+
+
+def array_reader(data):
+    """Return read(start, stop) over the last axis of an array or memmap, as float64."""
+    def read(start, stop):
+        return np.asarray(data[:, start:stop], dtype=float)
+    return read
+
+
+class TDDR:
+    """
+    Temporal Derivative Distribution Repair of all channels, computed in blocks.
+
+    Construction reads the recording twice in blocks (channel means, then the
+    derivative of the low-frequency component, which goes to a scratch file).
+    The robust weights are fitted one channel at a time from the scratch file,
+    so memory holds a few arrays of one channel's length, not of all channels.
+    Only the fitted location and spread of every channel are kept, plus the
+    running sum of the corrected derivative at every block boundary; read()
+    integrates the corrected low-frequency component from the nearest
+    boundary.
+
+    Parameters
+    ----------
+    read : callable
+        read(start, stop) returning samples [start, stop) as (n_channels, n) array
+    n_times : int
+        Number of samples
+    sfreq : float
+        Sampling rate in Hz
+    block_samples : int, optional
+        Samples read at once
+    scratch_dir : str, optional
+        Directory of the temporary derivative file. Defaults to the system temporary directory.
+    """
+
+    def __init__(self, read, n_times, sfreq, block_samples=None, scratch_dir=None):
+        self._read = read
+        self.n_times = n_times
+        self.sfreq = float(sfreq)
+        self.block_samples = block_samples or int(DEFAULT_BLOCK_SECONDS * self.sfreq)
+        blocks = [(start, min(start + self.block_samples, n_times))
+                  for start in range(0, n_times, self.block_samples)]
+
+        # Pass 1: channel means
+        self.mean = sum(read(start, stop).sum(axis=-1) for start, stop in blocks) / n_times
+        n_channels = len(self.mean)
+
+        # Pass 2: derivative of the low-frequency component of the centred signal, to the scratch file
+        cutoff = TDDR_CUTOFF * 2 / self.sfreq
+        if cutoff < 1:
+            sos = butter(TDDR_FILTER_ORDER, cutoff, output='sos')
+            self._low = ZeroPhaseReader(self._centred, n_times, sos).read
+        else:
+            self._low = self._centred
+        if n_times > 1 and n_channels:
+            self._deriv = np.memmap(tempfile.TemporaryFile(dir=scratch_dir), dtype=float, mode='w+',
+                                    shape=(n_channels, n_times - 1))
+        else:
+            self._deriv = np.empty((n_channels, max(n_times - 1, 0)))
+        for start, stop in blocks:
+            self._deriv[:, start:stop - 1 if stop == n_times else stop] = \
+                np.diff(self._low(start, min(stop + 1, n_times)))
+
+        # Robust fit per channel: location mu, and the center and scale defining the weights
+        fits = [self._robust_fit(np.asarray(self._deriv[channel])) for channel in range(n_channels)]
+        self.mu = np.array([fit[0] for fit in fits])
+        self._weight_center = np.array([fit[1] for fit in fits])
+        self._weight_scale = np.array([fit[2] for fit in fits])
+
+        # Pass 3 (scratch file only): corrected low-frequency component at every block start, and its mean
+        self._block_starts = np.zeros((len(blocks), n_channels))
+        total = np.zeros(n_channels)
+        carry = np.zeros(n_channels)
+        for index, (start, stop) in enumerate(blocks):
+            self._block_starts[index] = carry
+            low = self._integrate(index, stop)
+            total += low.sum(axis=-1)
+            carry = low[:, -1] + self._corrected_deriv(stop - 1, stop).sum(axis=-1)
+        self.low_mean = total / n_times
+
+    def _centred(self, start, stop):
+        return self._read(start, stop) - self.mean[:, None]
+
+    def _corrected_deriv(self, start, stop):
+        """Weighted, centred derivative samples [start, stop) of all channels."""
+        deriv = np.asarray(self._deriv[:, start:stop], dtype=float)
+        weights = np.ones_like(deriv)
+        fitted = np.isfinite(self._weight_scale)
+        if fitted.any():
+            r = np.abs(deriv[fitted] - self._weight_center[fitted, None]) / self._weight_scale[fitted, None]
+            weights[fitted] = ((1 - r ** 2) * (r < 1)) ** 2
+        return (deriv - self.mu[:, None]) * weights
+
+    @staticmethod
+    def _robust_fit(deriv):
+        """
+        Tukey biweight location of one channel's derivative, iterated until it converges.
+
+        Returns
+        -------
+        tuple
+            (mu, center, scale): the location, and the location and scale of the
+            final weights ((1 - r ** 2) * (r < 1)) ** 2 with r = |deriv - center| / scale.
+            Channels with a zero spread keep unit weights (center nan, scale inf), as in the reference.
+        """
+        tolerance = np.sqrt(np.finfo(float).eps)
+        if not len(deriv):
+            return 0.0, np.nan, np.inf
+        weights = None
+        mu = np.inf
+        center, scale = np.nan, np.inf
+        for _ in range(TDDR_MAX_ITER):
+            mu0 = mu
+            mu = deriv.mean() if weights is None else np.sum(weights * deriv) / np.sum(weights)
+            dev = np.abs(deriv - mu)
+            sigma = 1.4826 * np.median(dev)
+            if sigma == 0:
+                break
+            center, scale = mu, sigma * TDDR_TUNE
+            r = dev / scale
+            weights = ((1 - r ** 2) * (r < 1)) ** 2
+            if np.abs(mu - mu0) < tolerance * max(np.abs(mu), np.abs(mu0)):
+                break
+        return mu, center, scale
+
+    def _integrate(self, block, stop):
+        """Corrected low-frequency component (before removing its mean) from the start of a block to stop."""
+        block_start = block * self.block_samples
+        low = np.empty((len(self.mean), stop - block_start))
+        low[:, 0] = self._block_starts[block]
+        np.cumsum(self._corrected_deriv(block_start, stop - 1), axis=-1, out=low[:, 1:])
+        low[:, 1:] += self._block_starts[block][:, None]
+        return low
+
+    def read(self, start, stop):
+        """Return corrected samples [start, stop) of all channels."""
+        block = start // self.block_samples
+        low_corrected = self._integrate(block, stop)[:, start - block * self.block_samples:]
+        signal = self._read(start, stop)
+        high = signal - self.mean[:, None] - self._low(start, stop)
+        return low_corrected - self.low_mean[:, None] + high + self.mean[:, None]
+
+
+@lru_cache(maxsize=None)
+def design_mayer_filter(sfreq, band=MAYER_BAND, order=MAYER_FILTER_ORDER):
+    """Return the read-only band-stop SOS removing the Mayer-wave band."""
+    sos = butter(order, band, btype='bandstop', fs=sfreq, output='sos')
+    sos.setflags(write=False)
+    return sos
+
+
+@lru_cache(maxsize=None)
+def design_fnirs_bandpass(sfreq, l_freq, h_freq, l_trans_bandwidth, h_trans_bandwidth, gpass=3.0, gstop=40.0):
+    """
+    Design the Butterworth band-pass of FNIRS_PREPROCESSING['filter'] as SOS.
+
+    The order is the smallest meeting gstop (dB) attenuation at
+    l_freq - l_trans_bandwidth and h_freq + h_trans_bandwidth.
+
+    Returns
+    -------
+    ndarray
+        Read-only second-order sections
+    """
+    nyquist = sfreq / 2.0
+    h_stop = min(h_freq + h_trans_bandwidth, nyquist * 0.999)
+    if h_freq >= h_stop:
+        order, wn = buttord(l_freq, max(l_freq - l_trans_bandwidth, 1e-6), gpass, gstop, fs=sfreq)
+        sos = butter(order, wn, btype='highpass', fs=sfreq, output='sos')
+    else:
+        order, wn = buttord([l_freq, h_freq], [max(l_freq - l_trans_bandwidth, 1e-6), h_stop],
+                            gpass, gstop, fs=sfreq)
+        sos = butter(order, wn, btype='bandpass', fs=sfreq, output='sos')
+    sos.setflags(write=False)
+    return sos
+
+
+def fnirs_bandpass_filter(sfreq, params=None):
+    """Return a StatefulSOSFilter with the band-pass of FNIRS_PREPROCESSING['filter']."""
+    params = params or FNIRS_PREPROCESSING['filter']
+    return StatefulSOSFilter(design_fnirs_bandpass(float(sfreq), params['l_freq'], params['h_freq'],
+                                                   params['l_trans_bandwidth'], params['h_trans_bandwidth']))
+
+
+def preprocess_fnirs(data, sfreq, out=None, params=None, block_seconds=DEFAULT_BLOCK_SECONDS):
+    """
+    Run the fNIRS preprocessing stages block by block.
+
+    Parameters
+    ----------
+    data : ndarray or memmap, shape (n_channels, n_times)
+        Optical density or hemoglobin concentrations
+    sfreq : float
+        Sampling rate in Hz
+    out : ndarray or memmap, optional
+        Output array of the same shape (may be a np.lib.format.open_memmap).
+        If None, a new array is allocated.
+    params : dict, optional
+        Stage configuration. Defaults to FNIRS_PREPROCESSING.
+    block_seconds : float, optional
+        Length of the blocks written at once
+
+    Returns
+    -------
+    ndarray or memmap
+        out
+    """
+    params = params or FNIRS_PREPROCESSING
+    n_channels, n_times = data.shape
+    block_samples = max(1, int(block_seconds * sfreq))
+    out = np.empty((n_channels, n_times)) if out is None else out
+
+    read = array_reader(data)
+    if params.get('apply_tddr'):
+        read = TDDR(read, n_times, sfreq, block_samples).read
+    if params.get('remove_mayer'):
+        read = ZeroPhaseReader(read, n_times, design_mayer_filter(float(sfreq))).read
+    bandpass = fnirs_bandpass_filter(sfreq, params['filter']) if params.get('filter') else None
+
+    for start in range(0, n_times, block_samples):
+        stop = min(start + block_samples, n_times)
+        block = read(start, stop)
+        out[:, start:stop] = bandpass(block) if bandpass is not None else block
+    if hasattr(out, 'flush'):
+        out.flush()
+    return out
+
+
+def preprocess_fnirs_resampled(data, sfreq, sfreq_work=None, out=None, params=None,
+                               block_seconds=DEFAULT_BLOCK_SECONDS):
+    """
+    Run preprocess_fnirs at a lower rate and resample the result back.
+
+    Parameters
+    ----------
+    data : ndarray or memmap, shape (n_channels, n_times)
+        fNIRS signals at sfreq (e.g., rows of a combined recording)
+    sfreq : float
+        Sampling rate of data and out in Hz
+    sfreq_work : float, optional
+        Rate the preprocessing runs at (e.g., the native fNIRS rate). If None
+        or equal to sfreq, preprocess_fnirs runs on data directly.
+    out : ndarray or memmap, optional
+        Output array of the same shape. If None, a new array is allocated.
+    params : dict, optional
+        Stage configuration. Defaults to FNIRS_PREPROCESSING.
+    block_seconds : float, optional
+        Length of the blocks read and written at once
+
+    Returns
+    -------
+    ndarray or memmap
+        out
+    """
+    if sfreq_work is None or float(sfreq_work) == float(sfreq):
+        return preprocess_fnirs(data, sfreq, out=out, params=params, block_seconds=block_seconds)
+    n_channels, n_times = data.shape
+    out = np.empty((n_channels, n_times)) if out is None else out
+
+    # Only the signals at the work rate are held in memory
+    down = ChunkedResampler(array_reader(data), n_times, sfreq, sfreq_work)
+    work = np.empty((n_channels, down.n_times))
+    work_block = max(1, int(block_seconds * sfreq_work))
+    for start in range(0, down.n_times, work_block):
+        stop = min(start + work_block, down.n_times)
+        work[:, start:stop] = down.read(start, stop)
+    processed = preprocess_fnirs(work, sfreq_work, params=params, block_seconds=block_seconds)
+    del work
+
+    # Resampling back yields at least n_times samples
+    up = ChunkedResampler(array_reader(processed), down.n_times, sfreq_work, sfreq)
+    block_samples = max(1, int(block_seconds * sfreq))
+    for start in range(0, n_times, block_samples):
+        stop = min(start + block_samples, n_times)
+        out[:, start:stop] = up.read(start, stop)
+    if hasattr(out, 'flush'):
+        out.flush()
+    return out
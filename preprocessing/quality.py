@@ -0,0 +1,314 @@
+"""
+Per-window quality control of fNIRS and EEG channels.
+
+- Scalp coupling index (SCI): correlation between the two wavelengths of
+  each fNIRS source-detector pair in the cardiac band, per window of
+  FNIRS_PREPROCESSING['sci']['time_window'] seconds, compared with
+  FNIRS_PREPROCESSING['sci']['threshold'].
+- EEG bad channels: robust z-score across channels of the robust amplitude
+  (scaled interquartile range) of each channel, per window, as the
+  "deviation" criterion of PREP (Bigdely-Shamlo et al., 2015), compared with
+  EEG_PREPROCESSING['bad_channels_criteria']['threshold'].
+
+Both stages take chunks of any length: filter state and incomplete windows
+are carried over, and every call returns the masks of the windows completed
+by that chunk. All channels and windows of a chunk are computed together on
+strided window views.
+
+SCI needs the two wavelengths of each pair, which only the raw recordings
+hold (combined recordings store HbO/HbR), so recording_quality reads the raw
+EEG and fNIRS recordings of a pair in chunks. Wavelength pairs are taken
+from the MNE channel names ('S1_D1 760'), not from the channel order.
+"""
+
+import re
+
+import numpy as np
+
+from config.parameters import EEG_PREPROCESSING, FNIRS_PREPROCESSING
+from preprocessing.filter_bank import design_band_filter
+from preprocessing.streaming import StatefulSOSFilter, WindowBuffer
+
+# Cardiac band used for the scalp coupling index (Pollonini et al., 2016)
+SCI_L_FREQ = 0.5
+SCI_H_FREQ = 2.5
+SCI_FILTER_ORDER = 4
+EEG_QC_WINDOW_SECONDS = 10.0
+QC_CHUNK_SECONDS = 600.0
+RAW_FNIRS_TYPES = ('fnirs_cw_amplitude', 'fnirs_od')
+FNIRS_CHANNEL_PATTERN = re.compile(r'^(S\d+_D\d+) (\d+(?:\.\d+)?)$')
+MAD_TO_STD = 1.4826
+IQR_TO_STD = 0.7413
+
+
+def wavelength_pairs(ch_names):
+    """
+    Channel indices of the two wavelengths of every source-detector pair.
+
+    Parameters
+    ----------
+    ch_names : list of str
+        Raw fNIRS channel names 'S<source>_D<detector> <wavelength>', in any order
+
+    Returns
+    -------
+    tuple
+        (first, second, names): indices of the shorter and the longer
+        wavelength of each pair, and the pair names, in order of first appearance
+    """
+    channels = {}
+    for index, name in enumerate(ch_names):
+        match = FNIRS_CHANNEL_PATTERN.match(name)
+        if match is None:
+            raise ValueError(f"'{name}' is not a raw fNIRS channel name ('S<source>_D<detector> <wavelength>')")
+        channels.setdefault(match.group(1), []).append((float(match.group(2)), index))
+    incomplete = [pair for pair, wavelengths in channels.items() if len(wavelengths) != 2]
+    if incomplete:
+        raise ValueError(f"Expected two wavelengths per source-detector pair, got: {', '.join(incomplete)}")
+    ordered = [sorted(wavelengths) for wavelengths in channels.values()]
+    return (np.array([wavelengths[0][1] for wavelengths in ordered], dtype=int),
+            np.array([wavelengths[1][1] for wavelengths in ordered], dtype=int), list(channels))
+
+
+def window_correlation(windows_a, windows_b):
+    """
+    Pearson correlation of matching windows.
+
+    Parameters
+    ----------
+    windows_a, windows_b : ndarray, shape (n_pairs, n_windows, window)
+        Windowed signals
+
+    Returns
+    -------
+    ndarray, shape (n_pairs, n_windows)
+        Correlation per pair and window (0 for flat windows)
+    """
+    a = windows_a - windows_a.mean(axis=-1, keepdims=True)
+    b = windows_b - windows_b.mean(axis=-1, keepdims=True)
+    denominator = np.sqrt((a ** 2).sum(axis=-1) * (b ** 2).sum(axis=-1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = (a * b).sum(axis=-1) / denominator
+    return np.nan_to_num(corr)
+
+
+class ScalpCouplingIndex:
+    """
+    Streaming sliding-window scalp coupling index of fNIRS channel pairs.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling rate of the fNIRS data in Hz
+    ch_names : list of str
+        Raw fNIRS channel names, from which the wavelength pairs are taken
+    time_window : float, optional
+        Window length in seconds. Defaults to FNIRS_PREPROCESSING['sci'].
+    step : float, optional
+        Seconds between window starts. Defaults to time_window.
+    threshold : float, optional
+        Minimum SCI of a good window. Defaults to FNIRS_PREPROCESSING['sci'].
+    """
+
+    def __init__(self, sfreq, ch_names, time_window=None, step=None, threshold=None):
+        params = FNIRS_PREPROCESSING['sci']
+        self.sfreq = float(sfreq)
+        first, second, self.pair_names = wavelength_pairs(ch_names)
+        self.pairs = (first, second)
+        self.time_window = time_window or params['time_window']
+        self.threshold = params['threshold'] if threshold is None else threshold
+        window = int(round(self.time_window * self.sfreq))
+        self.step = int(round((step or self.time_window) * self.sfreq))
+        self._filter = StatefulSOSFilter(design_band_filter(self.sfreq, SCI_L_FREQ, SCI_H_FREQ, SCI_FILTER_ORDER))
+        self._windows = WindowBuffer(window, self.step)
+
+    def update(self, chunk):
+        """
+        Add the next chunk of raw fNIRS data.
+
+        Parameters
+        ----------
+        chunk : ndarray, shape (n_channels, n_times)
+            Raw intensity or optical density of all channels
+
+        Returns
+        -------
+        dict
+            {'sci': (n_pairs, n_new_windows), 'good': bool mask of the same shape,
+             'window_start': (n_new_windows,) start times in seconds}
+        """
+        first, second = self.pairs
+        filtered = self._filter(chunk)
+        windows, first_index = self._windows.push(filtered)
+        sci = window_correlation(windows[first], windows[second])
+        return {
+            'sci': sci,
+            'good': sci >= self.threshold,
+            'window_start': (first_index + np.arange(sci.shape[-1])) * self.step / self.sfreq
+        }
+
+
+class EEGBadChannelDetector:
+    """
+    Streaming per-window z-score detection of bad EEG channels.
+
+    Parameters
+    ----------
+    sfreq : float
+        Sampling rate of the EEG data in Hz
+    window_seconds : float, optional
+        Window length in seconds
+    step : float, optional
+        Seconds between window starts. Defaults to window_seconds.
+    threshold : float, optional
+        Absolute z-score above which a channel is bad in a window.
+        Defaults to EEG_PREPROCESSING['bad_channels_criteria']['threshold'].
+    """
+
+    def __init__(self, sfreq, window_seconds=EEG_QC_WINDOW_SECONDS, step=None, threshold=None):
+        self.sfreq = float(sfreq)
+        self.threshold = EEG_PREPROCESSING['bad_channels_criteria']['threshold'] if threshold is None else threshold
+        window = int(round(window_seconds * self.sfreq))
+        self.step = int(round((step or window_seconds) * self.sfreq))
+        self._windows = WindowBuffer(window, self.step)
+
+    def update(self, chunk):
+        """
+        Add the next chunk of EEG data.
+
+        Parameters
+        ----------
+        chunk : ndarray, shape (n_channels, n_times)
+            EEG signals
+
+        Returns
+        -------
+        dict
+            {'z': (n_channels, n_new_windows), 'bad': bool mask of the same shape,
+             'window_start': (n_new_windows,) start times in seconds}
+        """
+        windows, first_index = self._windows.push(np.asarray(chunk, dtype=float))
+        quartiles = np.percentile(windows, [25, 75], axis=-1)
+        amplitude = IQR_TO_STD * (quartiles[1] - quartiles[0])
+        # Flat channels get a strongly negative z, so they are caught like noisy ones
+        median = np.median(amplitude, axis=0, keepdims=True)
+        spread = MAD_TO_STD * np.median(np.abs(amplitude - median), axis=0, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z = np.nan_to_num((amplitude - median) / spread)
+        return {
+            'z': z,
+            'bad': np.abs(z) > self.threshold,
+            'window_start': (first_index + np.arange(z.shape[-1])) * self.step / self.sfreq
+        }
+
+
+def _run_in_chunks(stage, read, n_times, chunk_samples):
+    """Feed read(start, stop) to a streaming QC stage in chunks and concatenate the per-window results."""
+    chunk_samples = max(1, int(chunk_samples or n_times))
+    # A recording without samples still yields (empty) masks of the right number of channels
+    results = [stage.update(read(start, min(start + chunk_samples, n_times)))
+               for start in range(0, max(n_times, 1), chunk_samples)]
+    return {key: np.concatenate([result[key] for result in results], axis=-1) for key in results[0]}
+
+
+def _array_reader(data):
+    return lambda start, stop: np.asarray(data[:, start:stop], dtype=float)
+
+
+def scalp_coupling_index(data, sfreq, ch_names, chunk_samples=None, **kwargs):
+    """
+    Sliding-window scalp coupling index of a whole recording (or memory-mapped array).
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_times)
+        Raw intensity or optical density
+    sfreq : float
+        Sampling rate in Hz
+    ch_names : list of str
+        Channel names of the rows of data
+    chunk_samples : int, optional
+        Samples read at once. Defaults to the whole recording.
+    **kwargs
+        Passed to ScalpCouplingIndex
+
+    Returns
+    -------
+    dict
+        ScalpCouplingIndex.update output over all windows
+    """
+    return _run_in_chunks(ScalpCouplingIndex(sfreq, ch_names, **kwargs), _array_reader(data), data.shape[-1],
+                          chunk_samples)
+
+
+def detect_bad_eeg_channels(data, sfreq, chunk_samples=None, **kwargs):
+    """
+    Per-window bad EEG channels of a whole recording (or memory-mapped array).
+
+    Parameters
+    ----------
+    data : ndarray, shape (n_channels, n_times)
+        EEG signals
+    sfreq : float
+        Sampling rate in Hz
+    chunk_samples : int, optional
+        Samples read at once. Defaults to the whole recording.
+    **kwargs
+        Passed to EEGBadChannelDetector
+
+    Returns
+    -------
+    dict
+        EEGBadChannelDetector.update output over all windows
+    """
+    return _run_in_chunks(EEGBadChannelDetector(sfreq, **kwargs), _array_reader(data), data.shape[-1],
+                          chunk_samples)
+
+
+def recording_quality(eeg_raw, fnirs_raw, chunk_seconds=QC_CHUNK_SECONDS):
+    """
+    Per-window quality masks of the raw EEG and fNIRS recordings of a pair.
+
+    Both recordings are read in chunks at their own sampling rates; window
+    start times are seconds from the first sample of each recording.
+
+    Parameters
+    ----------
+    eeg_raw, fnirs_raw : mne.io.Raw
+        Raw recordings, e.g. opened with preload=False
+    chunk_seconds : float, optional
+        Length of the chunks read at once
+
+    Returns
+    -------
+    dict
+        'sci', 'sci_good' (n_pairs, n_windows), 'sci_window_start', 'sci_pairs'
+        and 'eeg_z', 'eeg_bad' (n_eeg, n_windows), 'eeg_window_start',
+        'eeg_channels'. The SCI entries are empty if the fNIRS recording holds
+        no raw intensity or optical density channels.
+    """
+    def reader(raw, picks):
+        return lambda start, stop: raw.get_data(picks=picks, start=start, stop=stop)
+
+    result = {}
+    fnirs_types = np.array(fnirs_raw.get_channel_types())
+    fnirs_picks = np.flatnonzero(np.isin(fnirs_types, RAW_FNIRS_TYPES))
+    if len(fnirs_picks):
+        sfreq = fnirs_raw.info['sfreq']
+        stage = ScalpCouplingIndex(sfreq, [fnirs_raw.ch_names[pick] for pick in fnirs_picks])
+        sci = _run_in_chunks(stage, reader(fnirs_raw, fnirs_picks), fnirs_raw.n_times, chunk_seconds * sfreq)
+        result.update(sci=sci['sci'], sci_good=sci['good'], sci_window_start=sci['window_start'],
+                      sci_pairs=np.array(stage.pair_names))
+    else:
+        print(f"Warning: No raw intensity or optical density channels (types: "
+              f"{', '.join(sorted(set(fnirs_types)))}), skipping the scalp coupling index")
+        result.update(sci=np.empty((0, 0)), sci_good=np.empty((0, 0), dtype=bool), sci_window_start=np.empty(0),
+                      sci_pairs=np.array([], dtype=str))
+
+    eeg_picks = np.flatnonzero(np.array(eeg_raw.get_channel_types()) == 'eeg')
+    sfreq = eeg_raw.info['sfreq']
+    eeg = _run_in_chunks(EEGBadChannelDetector(sfreq), reader(eeg_raw, eeg_picks), eeg_raw.n_times,
+                         chunk_seconds * sfreq)
+    result.update(eeg_z=eeg['z'], eeg_bad=eeg['bad'], eeg_window_start=eeg['window_start'],
+                  eeg_channels=np.array([eeg_raw.ch_names[pick] for pick in eeg_picks]))
+    return result
@@ -0,0 +1,163 @@
+"""
+Polyphase resampling of multi-channel recordings between arbitrary rates.
+
+Rates are related by a rational factor up / down, so non-integer ratios such
+as 512 Hz -> 250 Hz (125 / 256) are exact. The anti-aliasing FIR filter of
+each (sfreq_in, sfreq_out) pair is designed once and memoized; all channels
+are filtered together as one 2-D polyphase operation.
+"""
+
+import math
+from fractions import Fraction
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import firwin, resample_poly
+
+# Kaiser window and filter half length (in multiples of max(up, down)) as in scipy.signal.resample_poly
+DEFAULT_WINDOW = ('kaiser', 5.0)
+HALF_LEN_FACTOR = 10
+
+
+def rational_ratio(sfreq_in, sfreq_out, max_denominator=10000):
+    """
+    Return the resampling factors relating two sampling rates.
+
+    Parameters
+    ----------
+    sfreq_in, sfreq_out : float
+        Input and output sampling rates in Hz
+    max_denominator : int, optional
+        Largest factor allowed when approximating irrational ratios
+
+    Returns
+    -------
+    tuple
+        (up, down) coprime integers with up / down == sfreq_out / sfreq_in
+    """
+    ratio = (Fraction(str(sfreq_out)) / Fraction(str(sfreq_in))).limit_denominator(max_denominator)
+    return ratio.numerator, ratio.denominator
+
+
+@lru_cache(maxsize=None)
+def design_antialias_filter(up, down, window=DEFAULT_WINDOW):
+    """
+    Design the linear-phase low-pass FIR filter for resampling by up / down.
+
+    Parameters
+    ----------
+    up, down : int
+        Coprime resampling factors
+    window : str or tuple, optional
+        Window passed to scipy.signal.firwin
+
+    Returns
+    -------
+    ndarray
+        Read-only filter coefficients of length 2 * 10 * max(up, down) + 1
+    """
+    max_rate = max(up, down)
+    h = firwin(2 * HALF_LEN_FACTOR * max_rate + 1, 1. / max_rate, window=window)
+    h.setflags(write=False)
+    return h
+
+
+@lru_cache(maxsize=None)
+def get_resampler(sfreq_in, sfreq_out):
+    """
+    Return the memoized factors and filter for a pair of sampling rates.
+
+    Parameters
+    ----------
+    sfreq_in, sfreq_out : float
+        Input and output sampling rates in Hz
+
+    Returns
+    -------
+    tuple
+        (up, down, h) with h None if the rates are equal
+    """
+    up, down = rational_ratio(sfreq_in, sfreq_out)
+    h = design_antialias_filter(up, down) if up != down else None
+    return up, down, h
+
+
+def resample(data, sfreq_in, sfreq_out, axis=-1):
+    """
+    Resample all channels of an array in one batched polyphase operation.
+
+    Parameters
+    ----------
+    data : ndarray
+        Signals, e.g. of shape (n_channels, n_times)
+    sfreq_in, sfreq_out : float
+        Input and output sampling rates in Hz
+    axis : int, optional
+        Time axis
+
+    Returns
+    -------
+    ndarray
+        Resampled signals with ceil(n_times * up / down) samples along axis
+    """
+    up, down, h = get_resampler(sfreq_in, sfreq_out)
+    if h is None:
+        return np.array(data, copy=True)
+    data = np.asarray(data)
+    # Filter in the precision of the data, as resample_poly does for its own designs
+    if np.issubdtype(data.dtype, np.floating) and data.dtype != h.dtype:
+        h = h.astype(data.dtype)
+    # resample_poly copies the window, so the cached design stays untouched
+    return resample_poly(data, up, down, axis=axis, window=h)
+
+
+class ChunkedResampler:
+    """
+    Random access to a resampled signal whose input is read in chunks.
+
+    Every chunk is read with enough surrounding input samples for the
+    anti-aliasing filter, so concatenated chunks equal resampling the whole
+    signal at once.
+
+    Parameters
+    ----------
+    read : callable
+        read(start, stop) returning input samples [start, stop) as (n_channels, n) array
+    n_times_in : int
+        Number of input samples
+    sfreq_in, sfreq_out : float
+        Input and output sampling rates in Hz
+    """
+
+    def __init__(self, read, n_times_in, sfreq_in, sfreq_out):
+        self._read = read
+        self.n_times_in = n_times_in
+        self.sfreq_in = sfreq_in
+        self.sfreq_out = sfreq_out
+        self.up, self.down, _ = get_resampler(sfreq_in, sfreq_out)
+        half_len_in = HALF_LEN_FACTOR * max(self.up, self.down) / self.up
+        # Input margin, a multiple of down so every chunk starts on the global output grid
+        self.pad = self.down * math.ceil((half_len_in + 1) / self.down)
+        self.n_times = math.ceil(n_times_in * self.up / self.down)
+
+    def read(self, start, stop):
+        """
+        Return resampled samples [start, stop) of all channels.
+
+        Parameters
+        ----------
+        start, stop : int
+            Sample range at the output rate
+
+        Returns
+        -------
+        ndarray
+            Array of shape (n_channels, stop - start)
+        """
+        if self.up == self.down:
+            return self._read(start, stop)
+        in_start = max(0, (start * self.down // self.up) // self.down * self.down - self.pad)
+        in_stop = min(self.n_times_in, math.ceil(stop * self.down / self.up) + self.pad)
+        resampled = resample(self._read(in_start, in_stop), self.sfreq_in, self.sfreq_out)
+        offset = in_start * self.up // self.down
+        return resampled[:, start - offset:stop - offset]
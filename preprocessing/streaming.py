@@ -0,0 +1,107 @@
+"""
+Building blocks for processing recordings in consecutive time chunks.
+
+StatefulSOSFilter carries the IIR state from one chunk to the next, so
+filtering chunk by chunk equals filtering the concatenated signal.
+WindowBuffer turns a stream of chunks into complete (possibly overlapping)
+analysis windows as strided views, keeping only the samples of the windows
+that are not complete yet.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import sosfilt, sosfilt_zi
+
+
+class StatefulSOSFilter:
+    """
+    Causal second-order-sections filter of all channels with state carried across chunks.
+
+    Parameters
+    ----------
+    sos : ndarray, shape (n_sections, 6)
+        Second-order sections
+    steady_state : bool, optional
+        Start from the steady-state response to the first sample (as
+        scipy.signal.sosfiltfilt does) instead of from zero
+    """
+
+    def __init__(self, sos, steady_state=True):
+        self.sos = np.array(sos, dtype=float)
+        self.steady_state = steady_state
+        self.zi = None
+
+    def reset(self):
+        """Forget the carried state."""
+        self.zi = None
+
+    def __call__(self, chunk):
+        """
+        Filter the next chunk.
+
+        Parameters
+        ----------
+        chunk : ndarray, shape (n_channels, n_times)
+            Next samples of all channels
+
+        Returns
+        -------
+        ndarray, shape (n_channels, n_times)
+            Filtered samples
+        """
+        chunk = np.asarray(chunk, dtype=float)
+        if chunk.shape[-1] == 0:
+            return chunk.copy()
+        if self.zi is None:
+            zi = sosfilt_zi(self.sos)[:, None, :]
+            scale = chunk[:, :1][None] if self.steady_state else np.zeros((1, chunk.shape[0], 1))
+            self.zi = zi * scale
+        filtered, self.zi = sosfilt(self.sos, chunk, axis=-1, zi=self.zi)
+        return filtered
+
+
+class WindowBuffer:
+    """
+    Collect streamed samples into complete analysis windows.
+
+    Parameters
+    ----------
+    window : int
+        Window length in samples
+    step : int, optional
+        Samples between window starts. Defaults to window (no overlap).
+    """
+
+    def __init__(self, window, step=None):
+        self.window = int(window)
+        self.step = int(step or window)
+        self._buffer = None
+        self.n_windows = 0
+
+    def push(self, chunk):
+        """
+        Add samples and return the windows they complete.
+
+        Parameters
+        ----------
+        chunk : ndarray, shape (n_channels, n_times)
+            Next samples of all channels
+
+        Returns
+        -------
+        tuple
+            (windows, first_index): windows of shape (n_channels, n_new, window),
+            a strided view, and the running index of the first new window
+        """
+        chunk = np.asarray(chunk)
+        buffer = chunk if self._buffer is None else np.concatenate([self._buffer, chunk], axis=-1)
+        n_new = 0 if buffer.shape[-1] < self.window else (buffer.shape[-1] - self.window) // self.step + 1
+        first_index = self.n_windows
+        self.n_windows += n_new
+        if n_new:
+            windows = sliding_window_view(buffer, self.window, axis=-1)[:, ::self.step][:, :n_new]
+        else:
+            windows = np.empty(buffer.shape[:-1] + (0, self.window), dtype=buffer.dtype)
+        # Keep the samples needed by the windows that are not complete yet
+        self._buffer = buffer[..., n_new * self.step:].copy()
+        return windows, first_index
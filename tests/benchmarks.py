@@ -0,0 +1,335 @@
+"""
+End-to-end performance benchmarks over generated synthetic studies.
+
+A study of configurable size (subjects x channels x duration) is generated
+with data.synthetic into a scratch directory, then every pipeline stage is
+run on it as in a nightly batch:
+
+    scan        scan_for_matching_ids over the EEG and fNIRS trees
+    pairing     batch_make_pairs into a scratch pair database
+    combine     combine_pairs (resampling and alignment)
+    preprocess  filter_eeg and preprocess_fnirs_resampled of each combined recording
+    time_delay  band_envelope_correlation (EEG band envelopes x HbO)
+    pac         compute_comodulogram (fNIRS phase x EEG amplitude)
+    glm         eeg_band_glm
+
+Each stage is timed (wall and CPU seconds, process peak RSS) in a first pass
+over the study. tracemalloc slows Python-heavy code several-fold, so the
+peak traced allocation of each stage is measured in a second, separate pass
+with its own outputs. Results are written as JSON and compared
+against a stored baseline; a stage whose wall time grows by more than the
+regression threshold fails the run (exit code 1).
+
+Usage:
+    python -m tests.benchmarks --subjects 4 --duration 600 --output bench.json
+    python -m tests.benchmarks --save-baseline
+    python -m tests.benchmarks --baseline tests/benchmark_baseline.json --threshold 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+from config.data_paths_and_config import PROJECT_ROOT
+
+DEFAULT_BASELINE_FILE = os.path.join(PROJECT_ROOT, "tests", "benchmark_baseline.json")
+DEFAULT_THRESHOLD = 0.2       # relative wall-time increase counted as a regression
+DEFAULT_MIN_SECONDS = 0.05    # stages faster than this in the baseline are too noisy to compare
+
+STAGES = ['scan', 'pairing', 'combine', 'preprocess', 'time_delay', 'pac', 'glm']
+
+DEFAULT_STUDY = {
+    'n_subjects': 2,
+    'n_eeg': 64,
+    'n_fnirs_pairs': 20,
+    'duration': 300.0,        # seconds per recording
+    'seed': 0,
+    'n_jobs': 1,
+    'pac_channels': 4,        # EEG and fNIRS channels entering the comodulogram
+    'analysis_sfreq': 10.0,   # rate of the lagged correlation and the GLM
+}
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is in kB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class StageTimer:
+    """
+    Collect wall time, CPU time and memory of named stages.
+
+    A stage may be entered several times (e.g., once per recording); its
+    times are summed, and its traced peak is the maximum. Times are measured
+    while trace_memory is False and traced peaks while it is True, so
+    tracemalloc never runs during a timed call.
+
+    Parameters
+    ----------
+    trace_memory : bool, optional
+        Whether measure traces memory instead of timing
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def measure(self, name, function, *args, **kwargs):
+        """Run function(*args, **kwargs) as (part of) stage name and return its result."""
+        stage = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0,
+                                              'peak_traced_mb': None, 'peak_rss_mb': None})
+        if self.trace_memory:
+            tracemalloc.start()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                stage['peak_traced_mb'] = max(stage['peak_traced_mb'] or 0.0, peak / 2 ** 20)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stage['wall_seconds'] += time.perf_counter() - wall
+            stage['cpu_seconds'] += time.process_time() - cpu
+            stage['calls'] += 1
+            stage['peak_rss_mb'] = _peak_rss_mb()
+
+
+def generate_study(root, study):
+    """Generate the synthetic study under root without registering it."""
+    from data.synthetic import generate_dataset
+
+    settings = {'duration': study['duration'], 'n_eeg': study['n_eeg'], 'n_fnirs_pairs': study['n_fnirs_pairs']}
+    return generate_dataset(study['n_subjects'], root, settings=settings, seed=study['seed'],
+                            n_jobs=study['n_jobs'], register=False)
+
+
+def _analyze_recording(timer, path, study, work_dir):
+    """Run the preprocessing and analysis stages on one combined recording."""
+    from io_mgmt.combined_format import open_combined
+    from preprocessing.eeg import filter_eeg
+    from config.parameters import FNIRS_PREPROCESSING
+    from preprocessing.fnirs import preprocess_fnirs_resampled
+    from methods.time_delay import band_envelope_correlation, select_fnirs_channels, get_filter_bank
+    from methods.pac import compute_comodulogram
+    from methods.glm import eeg_band_glm
+
+    with open(os.path.splitext(path)[0] + '.json') as f:
+        sidecar = json.load(f)
+    sfreq = sidecar['sfreq']
+    ch_types = np.array(sidecar['ch_types'])
+    eeg_picks = np.flatnonzero(ch_types == 'eeg')
+    fnirs_picks = np.flatnonzero(np.isin(ch_types, ['hbo', 'hbr']))
+    data = open_combined(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+
+    def preprocess():
+        eeg = np.lib.format.open_memmap(os.path.join(work_dir, f"{name}_eeg.npy"), mode='w+',
+                                        shape=(len(eeg_picks), data.shape[-1]))
+        filter_eeg(data, sfreq, out=eeg, picks=eeg_picks)
+        fnirs = np.lib.format.open_memmap(os.path.join(work_dir, f"{name}_fnirs.npy"), mode='w+',
+                                          shape=(len(fnirs_picks), data.shape[-1]))
+        fnirs_sfreq = FNIRS_PREPROCESSING['sfreq'] or sidecar.get('source_sfreq', {}).get('fnirs')
+        preprocess_fnirs_resampled(data[fnirs_picks], sfreq, fnirs_sfreq, out=fnirs)
+        return eeg, fnirs
+
+    eeg, fnirs = timer.measure('preprocess', preprocess)
+    hbo = fnirs[select_fnirs_channels(ch_types[fnirs_picks], 'hbo')]
+    sfreq_out = study['analysis_sfreq']
+    timer.measure('time_delay', band_envelope_correlation, eeg, hbo, sfreq, key=name, sfreq_out=sfreq_out)
+    n_pac = study['pac_channels']
+    timer.measure('pac', compute_comodulogram, fnirs[:n_pac], eeg[:n_pac], sfreq, n_jobs=study['n_jobs'])
+    timer.measure('glm', eeg_band_glm, eeg, hbo, sfreq, key=name, sfreq_out=sfreq_out)
+    get_filter_bank(sfreq).clear_cache(name)
+
+
+def _run_stages(timer, study_dir, work_dir, study):
+    """Run every pipeline stage on a generated study, writing all outputs under work_dir."""
+    from io_mgmt.make_pairs import scan_for_matching_ids, batch_make_pairs
+    from io_mgmt.dataset_index import DatasetIndex
+    from io_mgmt.combine_fnirs_eeg import combine_pairs
+
+    os.makedirs(work_dir, exist_ok=True)
+    index = DatasetIndex(index_file=os.path.join(work_dir, 'dataset_index.json'))
+    matching_ids, _, _ = timer.measure('scan', scan_for_matching_ids, os.path.join(study_dir, 'EEG'),
+                                       os.path.join(study_dir, 'fNIRS'), index=index)
+    db_file = os.path.join(work_dir, 'pairs.sqlite')
+    timer.measure('pairing', batch_make_pairs, matching_ids, 'synthetic', type_eeg='.fif', type_fnirs='.fif',
+                  return_folders_fnirs=False, output_file=db_file,
+                  review_file=os.path.join(work_dir, 'review.json'), index=index)
+    combined = timer.measure('combine', combine_pairs, db_file, os.path.join(work_dir, 'combined'),
+                             overwrite=True)
+    for path in combined['combined']:
+        _analyze_recording(timer, path, study, work_dir)
+
+
+def run_benchmarks(study=None, scratch_dir=None, keep=False, trace_memory=True):
+    """
+    Generate a synthetic study and time every pipeline stage on it.
+
+    Parameters
+    ----------
+    study : dict, optional
+        Overrides of DEFAULT_STUDY
+    scratch_dir : str, optional
+        Directory for the study and all outputs. A temporary directory is used if None.
+    keep : bool, optional
+        Whether to keep the scratch directory
+    trace_memory : bool, optional
+        Run the stages a second time under tracemalloc for their peak traced
+        allocation. If False, 'peak_traced_mb' is None.
+
+    Returns
+    -------
+    dict
+        {'created', 'study', 'environment', 'generate_seconds', 'stages': {stage: measurements}}
+    """
+    study = dict(DEFAULT_STUDY, **(study or {}))
+    scratch = scratch_dir or tempfile.mkdtemp(prefix='nvc_benchmark_')
+    os.makedirs(scratch, exist_ok=True)
+    timer = StageTimer()
+    try:
+        t0 = time.perf_counter()
+        generate_study(os.path.join(scratch, 'study'), study)
+        generate_seconds = time.perf_counter() - t0
+
+        # Both passes start from empty indexes and outputs, so neither reuses the other's work
+        _run_stages(timer, os.path.join(scratch, 'study'), os.path.join(scratch, 'timed'), study)
+        if trace_memory:
+            timer.trace_memory = True
+            _run_stages(timer, os.path.join(scratch, 'study'), os.path.join(scratch, 'traced'), study)
+    finally:
+        if not keep and scratch_dir is None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    missing = [stage for stage in STAGES if stage not in timer.stages]
+    if missing:
+        raise RuntimeError(f"Benchmark stages did not run: {', '.join(missing)}")
+
+    return {
+        'created': datetime.now().isoformat(),
+        'study': study,
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'generate_seconds': generate_seconds,
+        'stages': {stage: timer.stages[stage] for stage in STAGES}
+    }
+
+
+def compare_to_baseline(results, baseline, threshold=DEFAULT_THRESHOLD, min_seconds=DEFAULT_MIN_SECONDS):
+    """
+    Compare stage wall times against a baseline.
+
+    Parameters
+    ----------
+    results, baseline : dict
+        Outputs of run_benchmarks
+    threshold : float, optional
+        Relative increase of wall time counted as a regression (0.2 = 20 % slower)
+    min_seconds : float, optional
+        Stages faster than this in the baseline are reported but never regress
+
+    Returns
+    -------
+    dict
+        {stage: {'baseline_seconds', 'seconds', 'ratio', 'regression'}}
+    """
+    if baseline.get('study') != results.get('study'):
+        print("Warning: Baseline was recorded for a different study size, comparison may be meaningless")
+    comparison = {}
+    for stage, measured in results['stages'].items():
+        reference = baseline.get('stages', {}).get(stage)
+        if reference is None:
+            continue
+        ratio = measured['wall_seconds'] / reference['wall_seconds'] if reference['wall_seconds'] > 0 else np.inf
+        comparison[stage] = {
+            'baseline_seconds': reference['wall_seconds'],
+            'seconds': measured['wall_seconds'],
+            'ratio': ratio,
+            'regression': bool(reference['wall_seconds'] >= min_seconds and ratio > 1 + threshold)
+        }
+    return comparison
+
+
+def _format_mb(value):
+    return '-' if value is None else f"{value:.1f}"
+
+
+def print_report(results, comparison=None):
+    """Print a table of the stage measurements and the baseline comparison."""
+    print(f"\n{'stage':<12}{'wall s':>10}{'cpu s':>10}{'traced MB':>12}{'rss MB':>10}{'vs base':>10}")
+    for stage, measured in results['stages'].items():
+        ratio = ''
+        if comparison and stage in comparison:
+            ratio = f"{comparison[stage]['ratio']:.2f}x" + (' !' if comparison[stage]['regression'] else '')
+        print(f"{stage:<12}{measured['wall_seconds']:>10.2f}{measured['cpu_seconds']:>10.2f}"
+              f"{_format_mb(measured['peak_traced_mb']):>12}{_format_mb(measured['peak_rss_mb']):>10}{ratio:>10}")
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the NVC pipeline on a synthetic study.")
+    parser.add_argument('--subjects', type=int, default=DEFAULT_STUDY['n_subjects'], help="Number of subjects")
+    parser.add_argument('--eeg-channels', type=int, default=DEFAULT_STUDY['n_eeg'], help="EEG channels")
+    parser.add_argument('--fnirs-pairs', type=int, default=DEFAULT_STUDY['n_fnirs_pairs'],
+                        help="fNIRS source-detector pairs")
+    parser.add_argument('--duration', type=float, default=DEFAULT_STUDY['duration'], help="Seconds per recording")
+    parser.add_argument('--seed', type=int, default=DEFAULT_STUDY['seed'], help="Random seed of the study")
+    parser.add_argument('--workers', type=int, default=DEFAULT_STUDY['n_jobs'], help="Workers for generation and PAC")
+    parser.add_argument('--output', default=None, help="Write the results JSON to this file")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_FILE, help="Baseline results JSON")
+    parser.add_argument('--save-baseline', action='store_true', help="Store the results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="Relative wall-time increase counted as a regression")
+    parser.add_argument('--min-seconds', type=float, default=DEFAULT_MIN_SECONDS,
+                        help="Ignore regressions of stages faster than this in the baseline")
+    parser.add_argument('--scratch-dir', default=None, help="Keep the study and outputs in this directory")
+    parser.add_argument('--no-trace-memory', action='store_true',
+                        help="Skip the second pass measuring the peak traced allocation of every stage")
+    args = parser.parse_args(argv)
+
+    study = {'n_subjects': args.subjects, 'n_eeg': args.eeg_channels, 'n_fnirs_pairs': args.fnirs_pairs,
+             'duration': args.duration, 'seed': args.seed, 'n_jobs': args.workers}
+    results = run_benchmarks(study, scratch_dir=args.scratch_dir, trace_memory=not args.no_trace_memory)
+
+    comparison = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            comparison = compare_to_baseline(results, json.load(f), args.threshold, args.min_seconds)
+        results['comparison'] = comparison
+    print_report(results, comparison)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline written to {args.baseline}")
+
+    regressions = [stage for stage, item in (comparison or {}).items() if item['regression']]
+    if regressions:
+        print(f"\nPerformance regression (> {args.threshold:.0%} slower): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
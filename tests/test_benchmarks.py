@@ -0,0 +1,28 @@
+"""Tests of the benchmark stage timer (tests/benchmarks.py)."""
+
+import tracemalloc
+
+import numpy as np
+
+from tests.benchmarks import StageTimer
+
+
+def test_timing_runs_without_tracemalloc():
+    timer = StageTimer()
+    assert timer.measure('stage', tracemalloc.is_tracing) is False
+    assert timer.stages['stage']['calls'] == 1
+    assert timer.stages['stage']['peak_traced_mb'] is None
+
+
+def test_memory_pass_leaves_times_untouched():
+    timer = StageTimer()
+    timer.measure('stage', np.zeros, 10)
+    times = dict(timer.stages['stage'])
+    timer.trace_memory = True
+    assert timer.measure('stage', tracemalloc.is_tracing) is True
+    timer.measure('stage', np.ones, 2 ** 20)
+    assert not tracemalloc.is_tracing()
+    stage = timer.stages['stage']
+    assert {key: stage[key] for key in ('wall_seconds', 'cpu_seconds', 'calls')} == \
+        {key: times[key] for key in ('wall_seconds', 'cpu_seconds', 'calls')}
+    assert stage['peak_traced_mb'] >= 8.0
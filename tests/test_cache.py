@@ -0,0 +1,37 @@
+"""Tests of the derived-data cache (utils/cache.py)."""
+
+import numpy as np
+import pytest
+
+from utils.cache import DerivedDataCache, cache_key, resolve_parameters
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with DerivedDataCache(str(tmp_path), max_bytes=1000) as cache:
+        yield cache
+
+
+def test_entry_larger_than_limit_is_returned(cache):
+    arrays = cache.get_or_compute('ab' * 32, lambda: {'x': np.arange(1000.0)})
+    np.testing.assert_array_equal(arrays['x'], np.arange(1000.0))
+    assert 'ab' * 32 in cache
+
+
+def test_eviction_keeps_newest_entry(cache):
+    cache.put('aa' * 32, {'x': np.zeros(100)})
+    cache.put('bb' * 32, {'x': np.zeros(100)})
+    assert 'aa' * 32 not in cache
+    assert 'bb' * 32 in cache
+
+
+def test_cache_key_follows_given_parameters(tmp_path):
+    source = tmp_path / 'input.bin'
+    source.write_bytes(b'x')
+    params = resolve_parameters(['NVC_ANALYSIS.pac'])
+    key = cache_key('pac', params, inputs=[str(source)])
+    assert cache_key('pac', params, inputs=[str(source)]) == key
+    changed = resolve_parameters(['NVC_ANALYSIS.pac'], {'NVC_ANALYSIS.pac.method': 'ozkurt'})
+    assert cache_key('pac', changed, inputs=[str(source)]) != key
+    source.write_bytes(b'xy')
+    assert cache_key('pac', params, inputs=[str(source)]) != key
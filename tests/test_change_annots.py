@@ -0,0 +1,22 @@
+"""Tests of the annotation standardization (io_mgmt/change_annots.py)."""
+
+import pytest
+
+from io_mgmt.change_annots import compile_annotation_rules
+
+
+@pytest.mark.parametrize('description, label', [
+    ('1', 'tapping/start'),
+    ('1.0', 'tapping/start'),
+    ('2', 'tapping/stop'),
+    ('S  1', 'tapping/start'),
+    ('Stimulus/S  2', 'tapping/stop'),
+    ('Rest_block1', 'rest'),
+    ('rest 2', 'rest'),
+    ('BAD_acq 1', 'BAD'),
+    ('bad', 'BAD'),
+    ('block 1', None),
+    ('3', None),
+])
+def test_default_rules(description, label):
+    assert compile_annotation_rules().lookup(description) == label
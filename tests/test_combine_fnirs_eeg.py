@@ -0,0 +1,103 @@
+"""Tests of the EEG-fNIRS combiner (io_mgmt/combine_fnirs_eeg.py)."""
+
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from config.parameters import RECORDING_CLOCKS
+from io_mgmt.combine_fnirs_eeg import _start_time
+
+
+def _raw(meas_date):
+    import mne
+
+    raw = mne.io.RawArray(np.zeros((1, 100)), mne.create_info(['x'], 10.0, 'misc'), verbose='error')
+    raw.set_meas_date(meas_date)
+    return raw
+
+
+@pytest.fixture
+def berlin_clock(monkeypatch):
+    monkeypatch.setitem(RECORDING_CLOCKS, 'nirx_timezone', 'Europe/Berlin')
+
+
+def test_nirx_start_time_converted_from_local_clock(berlin_clock):
+    # mne.io.read_raw_nirx stamps the local header time 14:30 (CET) as 14:30 UTC
+    raw = _raw(datetime(2019, 1, 16, 14, 30, tzinfo=timezone.utc))
+    expected = datetime(2019, 1, 16, 13, 30, tzinfo=timezone.utc).timestamp()
+    assert _start_time(raw, local_clock=True) == expected
+
+
+def test_fif_start_time_is_utc(berlin_clock):
+    raw = _raw(datetime(2019, 1, 16, 13, 30, tzinfo=timezone.utc))
+    assert _start_time(raw) == datetime(2019, 1, 16, 13, 30, tzinfo=timezone.utc).timestamp()
+
+
+def test_output_paths_keep_dotted_run_names(tmp_path):
+    from io_mgmt.combine_fnirs_eeg import combined_output_path
+
+    def path(eeg_name):
+        pair = {'eeg_path': f"/data/{eeg_name}", 'metadata': {'auto': {'subject': 'S01'}}}
+        return combined_output_path(pair, str(tmp_path))
+
+    assert path('x.run1_raw.fif') != path('x.run2_raw.fif')
+    assert path('x.run1_raw.fif').endswith('S01_x.run1_raw.nvc')
+    assert path('x_raw.fif.gz').endswith('S01_x_raw.nvc')
+
+
+def _intensity_raw(n_times=800, sfreq=7.8125):
+    import mne
+
+    names = ['S1_D1 760', 'S1_D1 850', 'S2_D1 760', 'S2_D1 850']
+    info = mne.create_info(names, sfreq, 'fnirs_cw_amplitude')
+    for index, ch in enumerate(info['chs']):
+        ch['loc'][3:6] = [0.0, 0.0, 0.0] if index < 2 else [0.0, 0.06, 0.0]
+        ch['loc'][6:9] = [0.03, 0.03, 0.0]
+        ch['loc'][:3] = (ch['loc'][3:6] + ch['loc'][6:9]) / 2
+        ch['loc'][9] = 760.0 if index % 2 == 0 else 850.0
+    rng = np.random.default_rng(0)
+    raw = mne.io.RawArray(1.0 + 0.01 * rng.standard_normal((4, n_times)), info, verbose='error')
+    raw.set_meas_date(datetime(2019, 1, 16, 13, 30, tzinfo=timezone.utc))
+    return raw
+
+
+def test_intensities_converted_to_hemoglobin():
+    from io_mgmt.combine_fnirs_eeg import hemoglobin_raw
+
+    converted = hemoglobin_raw(_intensity_raw())
+    assert converted.get_channel_types() == ['hbo', 'hbr', 'hbo', 'hbr']
+    assert np.all(np.isfinite(converted.get_data()))
+    assert hemoglobin_raw(converted) is converted
+
+
+def test_combined_intensities_are_analysable(tmp_path):
+    import mne
+    from io_mgmt.combine_fnirs_eeg import combine_pair
+    from analysis.tasks.pair_stages import PairContext
+
+    eeg = mne.io.RawArray(np.zeros((2, 25000)), mne.create_info(['C3', 'C4'], 250.0, 'eeg'), verbose='error')
+    eeg.set_meas_date(datetime(2019, 1, 16, 13, 30, tzinfo=timezone.utc))
+    pair = {'eeg_path': str(tmp_path / 'eeg_raw.fif'), 'fnirs_path': str(tmp_path / 'fnirs_raw.fif'),
+            'metadata': {'auto': {'subject': 'S01'}}}
+    eeg.save(pair['eeg_path'], verbose='error')
+    _intensity_raw().save(pair['fnirs_path'], verbose='error')
+
+    ctx = PairContext(1, pair, str(tmp_path))
+    combine_pair(pair, ctx.combined_path)
+    _, eeg_picks, fnirs_picks, fnirs_types = ctx.channel_picks()
+    assert list(eeg_picks) == [0, 1]
+    assert fnirs_types == ['hbo', 'hbr', 'hbo', 'hbr']
+
+
+def test_recording_without_hemoglobin_is_rejected(tmp_path):
+    import json
+    from analysis.tasks.pair_stages import PairContext
+
+    pair = {'eeg_path': str(tmp_path / 'eeg_raw.fif'), 'metadata': {'auto': {'subject': 'S01'}}}
+    ctx = PairContext(1, pair, str(tmp_path))
+    (tmp_path / 'S01').mkdir()
+    with open(ctx.sidecar_path, 'w') as f:
+        json.dump({'sfreq': 250.0, 'ch_types': ['eeg', 'fnirs_cw_amplitude']}, f)
+    with pytest.raises(ValueError, match='HbO/HbR'):
+        ctx.channel_picks()
@@ -0,0 +1,81 @@
+"""Tests of the chunked combined-recording format (io_mgmt/combined_format.py)."""
+
+import os
+
+import numpy as np
+import pytest
+
+from io_mgmt.combined_format import CombinedWriter, open_combined, sidecar_path, write_sidecar
+
+GROUPS = {'eeg': [0, 1], 'fnirs': [2]}
+
+
+def _write(path, values, fail=False):
+    with CombinedWriter(path, GROUPS, values.shape[-1], 10.0, chunk_seconds=3.0) as writer:
+        writer.write('eeg', 0, values[:2])
+        if fail:
+            raise RuntimeError('interrupted')
+        writer.write('fnirs', 0, values[2:])
+    write_sidecar(path, {'sfreq': 10.0, 'ch_names': ['a', 'b', 'c'], 'ch_types': ['eeg', 'eeg', 'hbo'],
+                         'storage': writer.layout})
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'x.nvc')
+    values = np.arange(3 * 95, dtype=float).reshape(3, 95)
+    _write(path, values)
+    data = open_combined(path)
+    np.testing.assert_array_equal(np.asarray(data), values)
+    np.testing.assert_array_equal(data[[2, 0], 31:64], values[[2, 0], 31:64])
+
+
+def test_failed_rewrite_keeps_recording(tmp_path):
+    path = str(tmp_path / 'x.nvc')
+    values = np.arange(3 * 95, dtype=float).reshape(3, 95)
+    _write(path, values)
+    with pytest.raises(RuntimeError):
+        _write(path, -values[:, :50], fail=True)
+    np.testing.assert_array_equal(np.asarray(open_combined(path)), values)
+    assert sorted(os.listdir(tmp_path)) == ['x.json', 'x.nvc']
+
+
+def test_rewrite_drops_outdated_sidecar(tmp_path):
+    path = str(tmp_path / 'x.nvc')
+    values = np.arange(3 * 95, dtype=float).reshape(3, 95)
+    _write(path, values)
+    with CombinedWriter(path, GROUPS, 50, 10.0) as writer:
+        writer.write('eeg', 0, values[:2, :50])
+    assert os.path.getsize(path) == writer.layout['n_bytes']
+    assert not os.path.exists(sidecar_path(path))
+
+
+def test_time_index_bounds(tmp_path):
+    path = str(tmp_path / 'x.nvc')
+    values = np.arange(3 * 95, dtype=float).reshape(3, 95)
+    _write(path, values)
+    data = open_combined(path)
+    np.testing.assert_array_equal(data[[0, 2], -95], values[[0, 2], 0])
+    assert data[1, 94] == values[1, 94]
+    for index in (95, -96):
+        with pytest.raises(IndexError):
+            data[0, index]
+
+
+def test_epochs_read_without_loading_recording(tmp_path, monkeypatch):
+    from io_mgmt.combined_format import CombinedRecording
+    from preprocessing.epochs import motor_epochs
+
+    path = str(tmp_path / 'x.nvc')
+    values = np.random.default_rng(0).standard_normal((3, 95))
+    _write(path, values)
+
+    def read_all(*args, **kwargs):
+        raise AssertionError("whole recording read")
+
+    monkeypatch.setattr(CombinedRecording, '__array__', read_all)
+    lazy = motor_epochs(open_combined(path), 10.0, [5, 40, 90], tmin=-0.5, tmax=2.0, baseline=(None, 0))
+    expected = motor_epochs(values, 10.0, [5, 40, 90], tmin=-0.5, tmax=2.0, baseline=(None, 0))
+    np.testing.assert_allclose(lazy[:], expected[:])
+    np.testing.assert_allclose(lazy[1], expected[1])
+    with pytest.raises(TypeError):
+        lazy.strided_view()
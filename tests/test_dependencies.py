@@ -0,0 +1,78 @@
+"""Tests of the stage dependency planning (analysis/dependencies.py)."""
+
+import pytest
+
+from analysis.dependencies import DONE, parameter_dependents, plan_pair, stage_signatures
+from analysis.tasks.pair_stages import PAIR_STAGES
+
+
+class FakeContext:
+    """PairContext stand-in whose stage outputs are plain files in a directory."""
+
+    def __init__(self, pair, output_dir):
+        self.pair = pair
+        self.output_dir = output_dir
+
+    def outputs(self, stage):
+        return [str(self.output_dir / f"{stage}.out")]
+
+
+@pytest.fixture
+def ctx(tmp_path):
+    for name in ('eeg_raw.fif', 'fnirs_raw.fif'):
+        (tmp_path / name).write_bytes(b'raw')
+    pair = {'eeg_path': str(tmp_path / 'eeg_raw.fif'), 'fnirs_path': str(tmp_path / 'fnirs_raw.fif'),
+            'metadata': {'auto': {'subject': 'P01'}}}
+    ctx = FakeContext(pair, tmp_path)
+    for stage in PAIR_STAGES:
+        (tmp_path / f"{stage}.out").write_bytes(b'')
+    return ctx
+
+
+def _done_records(pair):
+    """Checkpoint records of a pair whose stages all completed with the configured parameters."""
+    return {stage: {'status': DONE, 'signature': signature, 'dependencies': dependencies}
+            for stage, (signature, dependencies) in stage_signatures(pair).items()}
+
+
+def test_completed_pair_is_up_to_date(ctx):
+    assert plan_pair(ctx, _done_records(ctx.pair)) == {}
+
+
+def test_parameter_change_reruns_dependent_stages_only(ctx):
+    records = _done_records(ctx.pair)
+    plan = plan_pair(ctx, records, overrides={'NVC_ANALYSIS.time_delay.max_lag_seconds': 20.0})
+    assert plan == {'time_delay': 'parameters changed: NVC_ANALYSIS.time_delay.max_lag_seconds'}
+
+    plan = plan_pair(ctx, records, overrides={'EEG_PREPROCESSING.bands.alpha': (8, 12)})
+    assert plan == {'time_delay': 'parameters changed: EEG_PREPROCESSING.bands.alpha',
+                    'glm': 'parameters changed: EEG_PREPROCESSING.bands.alpha'}
+
+
+def test_resume_and_upstream_reasons(ctx):
+    records = _done_records(ctx.pair)
+    records['pac']['status'] = 'failed'
+    del records['glm']
+    assert plan_pair(ctx, records) == {'pac': 'failed', 'glm': 'not run'}
+
+    records = _done_records(ctx.pair)
+    (ctx.output_dir / 'preprocess.out').unlink()
+    assert plan_pair(ctx, records, targets=['glm']) == {'preprocess': 'outputs missing',
+                                                        'glm': 'upstream preprocess reruns'}
+
+
+def test_input_change_reruns_from_raw_stages(ctx):
+    records = _done_records(ctx.pair)
+    with open(ctx.pair['fnirs_path'], 'ab') as f:
+        f.write(b'more samples')
+    plan = plan_pair(ctx, records)
+    assert plan['quality'] == 'inputs changed' and plan['combine'] == 'inputs changed'
+    assert list(plan) == list(PAIR_STAGES)
+
+
+def test_parameter_dependents():
+    assert parameter_dependents('FNIRS_PREPROCESSING.sci.threshold') == ['quality']
+    assert parameter_dependents('NVC_ANALYSIS.pac.method') == ['pac']
+    assert parameter_dependents('FNIRS_PREPROCESSING.filter.l_freq') == ['preprocess', 'time_delay', 'pac', 'glm']
+    assert parameter_dependents('COMBINE_PARAMS') == ['combine', 'annotations', 'preprocess', 'time_delay',
+                                                      'pac', 'glm']
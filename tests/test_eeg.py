@@ -0,0 +1,30 @@
+"""Tests of the block-wise EEG filter (preprocessing/eeg.py)."""
+
+import numpy as np
+import pytest
+from scipy.signal import sosfilt, sosfilt_zi, sosfiltfilt
+
+from preprocessing.eeg import eeg_filter_sos, filter_eeg
+
+PARAMS = {'l_freq': 1.0, 'h_freq': 40.0, 'notch_freq': [50.0]}
+
+
+@pytest.fixture
+def signals():
+    rng = np.random.default_rng(0)
+    return rng.standard_normal((3, 5000)) + np.array([[20.0], [-5.0], [0.0]])
+
+
+@pytest.mark.parametrize('block_seconds', [20.0, 1.0, 0.37])
+def test_forward_filter_starts_from_steady_state(signals, block_seconds):
+    sos = np.array(eeg_filter_sos(250.0, PARAMS))
+    expected, _ = sosfilt(sos, signals, zi=sosfilt_zi(sos)[:, None] * signals[:, :1])
+    result = filter_eeg(signals, 250.0, params=PARAMS, block_seconds=block_seconds)
+    np.testing.assert_allclose(result, expected, atol=1e-10)
+
+
+@pytest.mark.parametrize('block_seconds', [20.0, 0.37])
+def test_zero_phase_filter(signals, block_seconds):
+    expected = sosfiltfilt(np.array(eeg_filter_sos(250.0, PARAMS)), signals, padlen=0)
+    result = filter_eeg(signals, 250.0, params=PARAMS, zero_phase=True, block_seconds=block_seconds)
+    np.testing.assert_allclose(result, expected, atol=1e-10)
@@ -0,0 +1,39 @@
+"""Tests of the strided epoch views (preprocessing/epochs.py)."""
+
+import numpy as np
+
+from preprocessing.epochs import motor_epochs, resting_state_epochs
+
+SFREQ = 10.0
+
+
+def test_motor_epochs_baseline_matches_mne():
+    import mne
+
+    data = np.random.default_rng(0).standard_normal((3, 600))
+    events = np.array([100, 250, 400])
+    epochs = motor_epochs(data, SFREQ, events, tmin=-5.0, tmax=15.0, baseline=(None, 0))
+
+    raw = mne.io.RawArray(data, mne.create_info(3, SFREQ, 'eeg'), verbose='error')
+    reference = mne.Epochs(raw, np.column_stack([events, np.zeros(3, int), np.ones(3, int)]), tmin=-5.0,
+                           tmax=15.0, baseline=(None, 0), preload=True, verbose='error')
+    np.testing.assert_allclose(epochs.times, reference.times)
+    np.testing.assert_allclose(epochs[:], reference.get_data(), atol=1e-12)
+    np.testing.assert_allclose(epochs.mean(), reference.average().data, atol=1e-12)
+
+
+def test_events_near_edges_dropped():
+    data = np.zeros((2, 300))
+    # Epochs need 50 samples before and 150 after the event
+    epochs = motor_epochs(data, SFREQ, [49, 50, 149, 150], tmin=-5.0, tmax=15.0)
+    np.testing.assert_array_equal(epochs.starts + 50, [50, 149])
+
+
+def test_strided_view_shares_memory():
+    data = np.arange(2 * 1000, dtype=float).reshape(2, 1000)
+    epochs = resting_state_epochs(data, SFREQ, duration=30.0, overlap=15.0)
+    view = epochs.strided_view()
+    assert np.shares_memory(view, data)
+    assert view.shape == (2, len(epochs), 300)
+    np.testing.assert_array_equal(view[:, 2], data[:, 300:600])
+    assert np.shares_memory(epochs[0], data)
@@ -0,0 +1,81 @@
+"""Tests of the block-wise fNIRS preprocessing (preprocessing/fnirs.py)."""
+
+import tracemalloc
+
+import numpy as np
+import pytest
+from scipy.signal import butter, sosfiltfilt
+
+from preprocessing.fnirs import TDDR, array_reader, preprocess_fnirs, preprocess_fnirs_resampled
+from preprocessing.resample import resample
+
+
+def reference_tddr(signals, sfreq):
+    """Whole-signal TDDR of every channel (Fishburn et al., 2019)."""
+    corrected = np.empty_like(signals)
+    sos = butter(3, 0.5 * 2 / sfreq, output='sos')
+    for channel, signal in enumerate(signals):
+        mean = signal.mean()
+        low = sosfiltfilt(sos, signal - mean, padlen=0)
+        deriv = np.diff(low)
+        weights = np.ones_like(deriv)
+        mu = np.inf
+        for _ in range(50):
+            mu0 = mu
+            mu = np.sum(weights * deriv) / np.sum(weights)
+            dev = np.abs(deriv - mu)
+            sigma = 1.4826 * np.median(dev)
+            if sigma == 0:
+                break
+            r = dev / (sigma * 4.685)
+            weights = ((1 - r ** 2) * (r < 1)) ** 2
+            if np.abs(mu - mu0) < np.sqrt(np.finfo(float).eps) * max(np.abs(mu), np.abs(mu0)):
+                break
+        low_corrected = np.concatenate([[0], np.cumsum(weights * (deriv - mu))])
+        corrected[channel] = low_corrected - low_corrected.mean() + (signal - mean - low) + mean
+    return corrected
+
+
+@pytest.fixture
+def signals():
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((4, 6000)).cumsum(axis=-1) * 0.01
+    x[:, 2500:] += 2.0
+    x[1] = 1.0
+    return x
+
+
+@pytest.mark.parametrize('block_samples', [6000, 1000, 777])
+def test_tddr_matches_whole_signal(signals, block_samples):
+    tddr = TDDR(array_reader(signals), signals.shape[-1], 10.0, block_samples)
+    blocks = [tddr.read(start, min(start + 500, signals.shape[-1])) for start in range(0, signals.shape[-1], 500)]
+    np.testing.assert_allclose(np.concatenate(blocks, axis=-1), reference_tddr(signals, 10.0), atol=1e-10)
+
+
+def test_tddr_memory_below_recording_size():
+    rng = np.random.default_rng(1)
+    signals = rng.standard_normal((16, 200000)).cumsum(axis=-1)
+    tracemalloc.start()
+    try:
+        TDDR(array_reader(signals), signals.shape[-1], 10.0, 10000)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < signals.nbytes / 2
+
+
+def test_preprocess_at_native_rate():
+    rng = np.random.default_rng(2)
+    native_sfreq, sfreq = 7.8125, 250.0
+    combined = resample(rng.standard_normal((3, 4000)).cumsum(axis=-1), native_sfreq, sfreq)
+    result = preprocess_fnirs_resampled(combined, sfreq, native_sfreq, block_seconds=60)
+    assert result.shape == combined.shape
+    work = resample(combined, sfreq, native_sfreq)
+    expected = resample(preprocess_fnirs(work, native_sfreq), native_sfreq, sfreq)[:, :combined.shape[-1]]
+    np.testing.assert_allclose(result, expected, atol=1e-8 * np.abs(expected).max())
+
+
+def test_preprocess_at_combined_rate():
+    rng = np.random.default_rng(3)
+    data = rng.standard_normal((2, 3000)).cumsum(axis=-1)
+    np.testing.assert_array_equal(preprocess_fnirs_resampled(data, 10.0, None), preprocess_fnirs(data, 10.0))
@@ -0,0 +1,25 @@
+"""Tests of the EEG-informed GLM (methods/glm.py)."""
+
+import numpy as np
+import pytest
+
+from methods.glm import cosine_drift
+
+
+@pytest.mark.parametrize('n_times, sfreq, high_pass, n_cosines', [
+    (3000, 10.0, 0.01, 6),
+    (500, 10.0, 0.01, 1),
+    (100, 10.0, 0.01, 0),
+])
+def test_cosine_drift_columns(n_times, sfreq, high_pass, n_cosines):
+    drift = cosine_drift(n_times, sfreq, high_pass)
+    assert drift.shape == (n_times, n_cosines + 1)
+    np.testing.assert_array_equal(drift[:, -1], 1.0)
+    # Orthonormal cosines, the highest of order floor(2 * n_times * high_pass / sfreq)
+    cosines = drift[:, :-1]
+    np.testing.assert_allclose(cosines.T @ cosines, np.eye(n_cosines), atol=1e-10)
+    if n_cosines:
+        samples = np.arange(n_times)
+        expected = np.sqrt(2.0 / n_times) * np.cos(np.pi / n_times * (samples + 0.5) * n_cosines)
+        np.testing.assert_allclose(cosines[:, -1], expected)
+
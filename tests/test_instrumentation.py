@@ -0,0 +1,86 @@
+"""Tests of the stage instrumentation (utils/instrumentation.py)."""
+
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from utils import instrumentation
+
+
+@pytest.fixture
+def collector(tmp_path):
+    collector = instrumentation.enable(str(tmp_path / 'log.jsonl'), run_id='test')
+    yield collector
+    instrumentation.disable()
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_disabled_stages_record_nothing():
+    instrumentation.disable()
+    assert instrumentation.stage('x') is instrumentation._NULL_STAGE
+
+    @instrumentation.instrumented('y')
+    def function(value):
+        return value + 1
+
+    assert function(1) == 2
+    assert instrumentation.get_collector() is None
+
+
+def test_records_logged_and_summarized(collector, tmp_path):
+    @instrumentation.instrumented('inner', subject=lambda subject: subject)
+    def inner(subject):
+        return subject
+
+    for subject in ('P01', 'P02', 'P01'):
+        with instrumentation.stage('outer', subject=subject, pair=1) as record:
+            inner(subject)
+            record['n_items'] = 3
+    instrumentation.disable()
+
+    with open(tmp_path / 'log.jsonl') as f:
+        logged = [json.loads(line) for line in f]
+    assert [record['stage'] for record in logged] == ['inner', 'outer'] * 3
+    assert all(record['run_id'] == 'test' for record in logged)
+    assert logged[0]['parent'] == 'outer' and logged[1]['parent'] is None
+    assert logged[1]['n_items'] == 3 and logged[1]['pair'] == 1
+
+    summary = collector.summary()
+    assert summary['outer']['calls'] == 3 and summary['inner']['calls'] == 3
+    by_subject = collector.summary(by_subject=True)
+    assert by_subject[('outer', 'P01')]['calls'] == 2
+    assert by_subject[('inner', 'P02')]['calls'] == 1
+
+
+def test_cpu_and_io_exclude_concurrent_threads(collector, tmp_path):
+    def idle():
+        with instrumentation.stage('idle', subject='P01'):
+            time.sleep(0.3)
+
+    def busy():
+        with instrumentation.stage('busy', subject='P02'):
+            with open(tmp_path / 'out.bin', 'wb') as f:
+                f.write(os.urandom(1 << 20))
+            _busy(0.3)
+
+    threads = [threading.Thread(target=target) for target in (idle, busy)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    summary = collector.summary(by_subject=True)
+    idle_record, busy_record = summary[('idle', 'P01')], summary[('busy', 'P02')]
+    assert idle_record['cpu_seconds'] < 0.1
+    assert busy_record['cpu_seconds'] > 0.2
+    if instrumentation.io_bytes()[1] is not None:
+        assert busy_record['bytes_written'] >= 1 << 20
+        assert idle_record['bytes_written'] < 1 << 16
@@ -0,0 +1,70 @@
+"""Tests of the windowed quality control (preprocessing/quality.py)."""
+
+import numpy as np
+import pytest
+
+from preprocessing.quality import (wavelength_pairs, scalp_coupling_index, detect_bad_eeg_channels,
+                                   recording_quality)
+
+SFREQ = 10.0
+# Pair S1_D1 shares a cardiac signal across wavelengths, pair S2_D1 does not; channels are not in pair order
+CH_NAMES = ['S2_D1 850', 'S1_D1 760', 'S2_D1 760', 'S1_D1 850']
+
+
+def _intensities(n_times=int(180 * SFREQ)):
+    rng = np.random.default_rng(0)
+    times = np.arange(n_times) / SFREQ
+    cardiac = np.sin(2 * np.pi * 1.2 * times)
+    data = 1.0 + 0.01 * rng.standard_normal((4, n_times))
+    data[[1, 3]] += 0.05 * cardiac
+    return data
+
+
+def test_wavelength_pairs_from_names():
+    first, second, names = wavelength_pairs(CH_NAMES)
+    assert names == ['S2_D1', 'S1_D1']
+    assert list(first) == [2, 1]
+    assert list(second) == [0, 3]
+    with pytest.raises(ValueError):
+        wavelength_pairs(['S1_D1 hbo', 'S1_D1 hbr'])
+    with pytest.raises(ValueError):
+        wavelength_pairs(['S1_D1 760'])
+
+
+@pytest.mark.parametrize('chunk_samples', [None, 7 * 60, 1000])
+def test_scalp_coupling_index_per_window(chunk_samples):
+    result = scalp_coupling_index(_intensities(), SFREQ, CH_NAMES, chunk_samples=chunk_samples)
+    assert result['sci'].shape == (2, 3)
+    np.testing.assert_array_equal(result['good'], [[False] * 3, [True] * 3])
+    np.testing.assert_allclose(result['window_start'], [0.0, 60.0, 120.0])
+
+
+def test_empty_recording_gives_empty_masks():
+    sci = scalp_coupling_index(np.empty((4, 0)), SFREQ, CH_NAMES)
+    assert sci['good'].shape == (2, 0)
+    eeg = detect_bad_eeg_channels(np.empty((3, 0)), 250.0)
+    assert eeg['bad'].shape == (3, 0)
+
+
+def _raw(data, ch_names, ch_types, sfreq):
+    import mne
+
+    return mne.io.RawArray(data, mne.create_info(ch_names, sfreq, ch_types), verbose='error')
+
+
+def test_recording_quality_reads_raw_intensities():
+    rng = np.random.default_rng(1)
+    eeg = rng.standard_normal((4, 5000))
+    eeg[2] *= 50.0
+    result = recording_quality(_raw(eeg, ['C3', 'C4', 'Cz', 'Pz'], 'eeg', 250.0),
+                               _raw(_intensities(), CH_NAMES, 'fnirs_cw_amplitude', SFREQ), chunk_seconds=7.0)
+    assert list(result['sci_pairs']) == ['S2_D1', 'S1_D1']
+    np.testing.assert_array_equal(result['sci_good'], [[False] * 3, [True] * 3])
+    np.testing.assert_array_equal(result['eeg_bad'].any(axis=-1), [False, False, True, False])
+
+
+def test_recording_quality_skips_sci_without_wavelengths(capsys):
+    hemoglobin = _raw(np.zeros((2, 600)), ['S1_D1 hbo', 'S1_D1 hbr'], ['hbo', 'hbr'], SFREQ)
+    result = recording_quality(_raw(np.zeros((2, 2500)), ['C3', 'C4'], 'eeg', 250.0), hemoglobin)
+    assert result['sci'].size == 0
+    assert 'skipping the scalp coupling index' in capsys.readouterr().out
@@ -0,0 +1,67 @@
+"""Tests of the header-only recording metadata (io_mgmt/recording_metadata.py)."""
+
+from datetime import datetime, timezone
+
+import pytest
+
+from config.parameters import RECORDING_CLOCKS
+from io_mgmt.recording_metadata import read_nirx_header, meas_timestamp, nirx_local_to_utc
+
+HDR = """[GeneralInfo]
+FileName="NIRS-2019-01-16_001"
+Date="Mi, 16 Jan 2019"
+Time="14:30:00"
+
+[ImagingParameters]
+Sources=2
+Detectors=2
+Wavelengths="760 850"
+SamplingRate=7.812500
+
+[DataStructure]
+S-D-Key="1-1:1,1-2:2,2-1:3,2-2:4,"
+"""
+
+
+def _write_nirx(folder, n_lines):
+    folder.mkdir()
+    (folder / 'NIRS-2019-01-16_001.hdr').write_text(HDR)
+    row = ' '.join(['1.234567E-1'] * 4) + '\n'
+    (folder / 'NIRS-2019-01-16_001.wl1').write_text(row * n_lines)
+    return str(folder)
+
+
+@pytest.fixture
+def nirx_timezone(monkeypatch):
+    def set_zone(zone):
+        monkeypatch.setitem(RECORDING_CLOCKS, 'nirx_timezone', zone)
+    return set_zone
+
+
+def test_nirx_time_is_local_wall_clock(tmp_path, nirx_timezone):
+    folder = _write_nirx(tmp_path / 'nirx', 10)
+    metadata = read_nirx_header(folder)
+    assert metadata['meas_date'] == '2019-01-16T14:30:00'
+
+    nirx_timezone('Europe/Berlin')
+    expected = datetime(2019, 1, 16, 13, 30, tzinfo=timezone.utc).timestamp()
+    assert meas_timestamp(metadata) == expected
+
+
+def test_fif_times_stay_utc(nirx_timezone):
+    nirx_timezone('America/New_York')
+    assert meas_timestamp({'meas_date': '2019-01-16T14:30:00+00:00'}) == \
+        datetime(2019, 1, 16, 14, 30, tzinfo=timezone.utc).timestamp()
+
+
+def test_nirx_local_to_utc_handles_dst(nirx_timezone):
+    nirx_timezone('Europe/Berlin')
+    assert nirx_local_to_utc(datetime(2019, 7, 1, 12, 0)) == datetime(2019, 7, 1, 10, 0, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize('n_lines', [0, 1, 500, 20000])
+def test_sample_count_from_file_size(tmp_path, n_lines):
+    folder = _write_nirx(tmp_path / 'nirx', n_lines)
+    metadata = read_nirx_header(folder)
+    assert metadata['n_times'] == n_lines
+    assert metadata['n_channels'] == 4
@@ -0,0 +1,96 @@
+"""Tests of the study scheduler (analysis/scheduler.py) with an in-process stand-in for the worker pool."""
+
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import analysis.scheduler as scheduler
+from analysis.scheduler import DONE, FAILED, RUNNING, CheckpointStore, StudyScheduler
+
+CRASHING_PAIR = 2
+
+
+class WorkerKilled(Exception):
+    """Stands in for the OS killing the worker process of a pair."""
+
+
+class FakePool:
+    """ProcessPoolExecutor stand-in whose futures run only when the fake wait picks them."""
+
+    created = 0
+
+    def __init__(self, max_workers):
+        FakePool.created += 1
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.call = (fn, args)
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+def fake_wait(futures, return_when):
+    """Finish one future; a killed worker breaks every future in flight, like a real process pool."""
+    futures = list(futures)
+    fake_wait.in_flight.append(len(futures))
+    crashing = [future for future in futures if future.call[1][0] == CRASHING_PAIR]
+    future = crashing[0] if crashing else futures[0]
+    fn, args = future.call
+    try:
+        future.set_result(fn(*args))
+    except WorkerKilled:
+        for future in futures:
+            future.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly"))
+        return set(futures), set()
+    return {future}, set(futures) - {future}
+
+
+def fake_run_pair(pair_id, pair, stages, output_dir, checkpoint_file):
+    subject = pair['metadata']['auto']['subject']
+    with CheckpointStore(checkpoint_file) as store:
+        store.set(pair_id, 'combine', RUNNING, subject)
+        if pair_id == CRASHING_PAIR:
+            raise WorkerKilled
+        store.set(pair_id, 'combine', DONE, subject)
+    return {'pair_id': pair_id, 'subject': subject, 'ran': ['combine'], 'failed': None, 'blocked': []}
+
+
+@pytest.fixture
+def study(tmp_path, monkeypatch):
+    pairs = [(pair_id, {'eeg_path': str(tmp_path / f"eeg_{pair_id}.fif"),
+                        'fnirs_path': str(tmp_path / f"fnirs_{pair_id}.fif"),
+                        'metadata': {'auto': {'subject': f"P0{pair_id}"}}}) for pair_id in (1, 2, 3)]
+    FakePool.created = 0
+    fake_wait.in_flight = []
+    monkeypatch.setattr(scheduler, 'ProcessPoolExecutor', FakePool)
+    monkeypatch.setattr(scheduler, 'wait', fake_wait)
+    monkeypatch.setattr(scheduler, 'run_pair', fake_run_pair)
+    monkeypatch.setattr(StudyScheduler, 'pending', lambda self, subjects=None: pairs)
+    return StudyScheduler(output_dir=str(tmp_path), stages=['combine'], n_workers=3, memory_budget_gb=1,
+                          checkpoint_file=str(tmp_path / 'checkpoints.sqlite'))
+
+
+def test_broken_pool_fails_only_the_crashing_pair(study):
+    results = study.run()
+
+    assert sorted(results['completed']) == [1, 3]
+    assert results['failed'] == {'P02': [(CRASHING_PAIR, 'combine')]}
+    with CheckpointStore(study.checkpoint_file) as store:
+        assert store.statuses(1) == {'combine': DONE}
+        assert store.statuses(CRASHING_PAIR) == {'combine': FAILED}
+        assert store.statuses(3) == {'combine': DONE}
+    # All three shared the pool that broke; after the restart each pair ran alone
+    assert fake_wait.in_flight == [3, 1, 1, 1]
+    assert FakePool.created == 3
+
+
+def test_pair_running_alone_is_failed_at_once(study):
+    study.n_workers = 1
+    results = study.run()
+
+    assert sorted(results['completed']) == [1, 3]
+    assert results['failed'] == {'P02': [(CRASHING_PAIR, 'combine')]}
+    assert fake_wait.in_flight == [1, 1, 1]
@@ -0,0 +1,43 @@
+"""Tests of the surrogate statistics (methods/surrogates.py)."""
+
+import numpy as np
+
+from methods.surrogates import NullDistribution, lag_correlation_surrogate_test
+
+
+def test_null_distribution_state_does_not_grow():
+    rng = np.random.default_rng(0)
+    observed = rng.random((4, 3))
+    null = NullDistribution(observed)
+    surrogates = rng.random((200, 4, 3))
+    for values in surrogates:
+        null.update(values)
+    assert all(np.shape(value) in ((), (4, 3)) for value in vars(null).values() if not callable(value))
+
+    maxima = surrogates.max(axis=(1, 2))
+    expected = ((maxima[:, None, None] >= observed).sum(axis=0) + 1) / (len(surrogates) + 1)
+    np.testing.assert_allclose(null.summary()['p_value_fwer'], expected)
+
+
+def test_null_distribution_merge_matches_single_run():
+    rng = np.random.default_rng(1)
+    observed = rng.random(5)
+    surrogates = rng.random((30, 5))
+    single, first, second = NullDistribution(observed), NullDistribution(observed), NullDistribution(observed)
+    for i, values in enumerate(surrogates):
+        single.update(values)
+        (first if i < 10 else second).update(values)
+    merged = first.merge(second).summary()
+    for key, value in single.summary().items():
+        np.testing.assert_allclose(merged[key], value)
+
+
+def test_time_shift_fwer_independent_of_batching():
+    rng = np.random.default_rng(2)
+    x = rng.standard_normal((6, 2, 800))
+    y = rng.standard_normal((3, 800))
+    kwargs = dict(n_surrogates=40, method='time_shift', chunk_size=7, seed=3)
+    one_batch = lag_correlation_surrogate_test(x, y, 10.0, -2, 5, **kwargs)
+    many_batches = lag_correlation_surrogate_test(x, y, 10.0, -2, 5, max_memory_mb=0.05, **kwargs)
+    np.testing.assert_allclose(many_batches['p_value_fwer'], one_batch['p_value_fwer'])
+    np.testing.assert_allclose(many_batches['p_value'], one_batch['p_value'])
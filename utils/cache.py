@@ -0,0 +1,468 @@
+"""
+Content-addressed cache of preprocessed and derived data.
+
+Each entry is keyed by a hash of
+- the stage name,
+- the identity of its input files (absolute path, size and modification
+  time of every file, or of every file in a NIRx folder),
+- the canonical JSON of the parameters the result depends on, as given by
+  the caller (e.g., resolve_parameters of the dotted paths it reads), plus
+  any extra key material.
+
+Which parameters each pipeline stage depends on is defined only in
+analysis.dependencies.STAGE_PARAMETER_KEYS; this module holds no stage table
+of its own.
+
+Entries live under DATA_ROOT/derived_cache/<key[:2]>/<key>/ as .npy arrays
+(or any files a producer writes) with an entry.json manifest holding the
+size and SHA-256 of every file. An SQLite index tracks sizes and last access
+for size-bounded LRU eviction and is safe for concurrent worker processes.
+Entries are written to a temporary directory and renamed into place, so
+readers never see partial entries; entries failing the integrity check are
+dropped and recomputed.
+
+The pair pipeline (analysis/tasks) checkpoints its outputs through the
+project database and only uses the parameter and file-identity helpers of
+this module; DerivedDataCache and cache_key are for scripts and notebooks
+that reuse derived data across runs.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+from config import parameters
+from config.data_paths_and_config import DATA_ROOT
+
+DEFAULT_CACHE_DIR = os.path.join(DATA_ROOT, "derived_cache")
+DEFAULT_MAX_BYTES = 50 * 1024 ** 3
+MANIFEST_FILE = "entry.json"
+INDEX_FILE = "cache_index.sqlite"
+HASH_BLOCK_SIZE = 1 << 22
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    stage TEXT,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_entries_last_access ON entries (last_access);
+"""
+
+
+def _jsonable(value):
+    """Convert tuples, NumPy scalars and arrays to plain JSON types."""
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return _jsonable(value.tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def canonical_json(value):
+    """Deterministic JSON of a (nested) parameter value: sorted keys, tuples as lists, no whitespace."""
+    return json.dumps(_jsonable(value), sort_keys=True, separators=(',', ':'))
+
+
+def get_parameter(path, source=parameters):
+    """
+    Look up a parameter sub-dict by dotted path, e.g. 'NVC_ANALYSIS.pac'.
+
+    Parameters
+    ----------
+    path : str
+        Module attribute followed by dictionary keys
+    source : module, optional
+        Module holding the parameter dicts
+
+    Returns
+    -------
+    object
+        The referenced value
+    """
+    name, *keys = path.split('.')
+    value = getattr(source, name)
+    for key in keys:
+        value = value[key]
+    return value
+
+
+def resolve_parameters(paths, overrides=None):
+    """
+    Current values of dotted parameter paths, with overrides applied.
+
+    Parameters
+    ----------
+    paths : list of str
+        Dotted paths into config.parameters
+    overrides : dict, optional
+        Dotted path -> value replacing the configured value of a path or of anything below it
+
+    Returns
+    -------
+    dict
+        Dotted path -> value
+    """
+    overrides = overrides or {}
+    resolved = {}
+    for path in paths:
+        resolved[path] = get_parameter(path)
+        # Overrides of a path or of anything below it
+        for override_path, value in overrides.items():
+            if override_path == path:
+                resolved[path] = value
+            elif override_path.startswith(path + '.'):
+                resolved[path] = _with_override(resolved[path], override_path[len(path) + 1:].split('.'), value)
+    return resolved
+
+
+def _with_override(value, keys, new_value):
+    """Copy of nested dict value with value[keys[0]][keys[1]]... replaced."""
+    updated = dict(value)
+    updated[keys[0]] = new_value if len(keys) == 1 else _with_override(value[keys[0]], keys[1:], new_value)
+    return updated
+
+
+def file_identity(path):
+    """
+    Identity of an input file or folder without reading its content.
+
+    Returns
+    -------
+    list
+        [absolute path, [[name, size, mtime_ns], ...]] (one item for a file)
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        entries = sorted((entry.name, entry.stat()) for entry in os.scandir(path) if entry.is_file())
+    else:
+        entries = [(os.path.basename(path), os.stat(path))]
+    return [path, [[name, st.st_size, st.st_mtime_ns] for name, st in entries]]
+
+
+def cache_key(stage, params, inputs=(), extra=None):
+    """
+    Hash identifying a derived result.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the producer
+    params : dict
+        Parameters the result depends on, e.g. resolve_parameters(paths)
+    inputs : list of str, optional
+        Input files or folders
+    extra : object, optional
+        Further JSON-serializable key material (e.g., channel picks, upstream keys)
+
+    Returns
+    -------
+    str
+        SHA-256 hex digest
+    """
+    material = {
+        'stage': stage,
+        'inputs': [file_identity(path) for path in inputs],
+        'params': params,
+        'extra': extra
+    }
+    return hashlib.sha256(canonical_json(material).encode()).hexdigest()
+
+
+def file_checksum(path):
+    """SHA-256 of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DerivedDataCache:
+    """
+    Size-bounded, content-addressed cache of derived data.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Cache root. Defaults to DATA_ROOT/derived_cache.
+    max_bytes : int, optional
+        Total size above which least recently used entries are evicted
+    timeout : float, optional
+        Seconds to wait for the index lock held by another process
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, timeout=30.0):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.cache_dir, INDEX_FILE), timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(INDEX_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __contains__(self, key):
+        return self.conn.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def close(self):
+        """Close the index connection."""
+        self.conn.close()
+
+    def entry_dir(self, key):
+        """Directory of an entry."""
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def total_bytes(self):
+        """Total size of all entries in bytes."""
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @contextmanager
+    def writing(self, key, stage=None, metadata=None):
+        """
+        Context manager yielding a temporary directory to write an entry's files into.
+
+        On success, the files are checksummed, the directory is moved into
+        place and the entry is registered (replacing an existing entry).
+        On error, the temporary directory is removed.
+
+        Parameters
+        ----------
+        key : str
+            Entry key
+        stage : str, optional
+            Stage name, stored in the manifest and index
+        metadata : dict, optional
+            JSON-serializable metadata stored in the manifest
+        """
+        os.makedirs(os.path.join(self.cache_dir, key[:2]), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f".{key[:8]}.", dir=os.path.join(self.cache_dir, key[:2]))
+        try:
+            yield tmp_dir
+            files = {}
+            for name in sorted(os.listdir(tmp_dir)):
+                file_path = os.path.join(tmp_dir, name)
+                files[name] = {'size': os.path.getsize(file_path), 'sha256': file_checksum(file_path)}
+            manifest = {'key': key, 'stage': stage, 'created': time.time(), 'files': files,
+                        'metadata': _jsonable(metadata or {})}
+            with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            self._install(key, tmp_dir, stage, sum(info['size'] for info in files.values()))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        # The new entry stays even if it alone exceeds max_bytes; it goes at the next eviction
+        self.evict(keep=(key,))
+
+    def _install(self, key, tmp_dir, stage, size):
+        """Move a written entry into place and register it."""
+        target = self.entry_dir(key)
+        if os.path.exists(target):
+            shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp_dir, target)
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO entries (key, stage, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, stage, size, now, now)
+        )
+
+    def put(self, key, arrays, stage=None, metadata=None):
+        """
+        Store arrays as an entry.
+
+        Parameters
+        ----------
+        key : str
+            Entry key
+        arrays : dict
+            Name -> ndarray, each stored as <name>.npy
+        stage : str, optional
+            Stage name
+        metadata : dict, optional
+            JSON-serializable metadata
+
+        Returns
+        -------
+        str
+            Entry directory
+        """
+        with self.writing(key, stage, metadata) as tmp_dir:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_dir, f"{name}.npy"), np.asarray(array))
+        return self.entry_dir(key)
+
+    def manifest(self, key):
+        """Return the manifest of an entry, or None if it is missing."""
+        try:
+            with open(os.path.join(self.entry_dir(key), MANIFEST_FILE), 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def verify(self, key, checksums=False):
+        """
+        Check that all files of an entry are present with their recorded size (and checksum).
+
+        Parameters
+        ----------
+        key : str
+            Entry key
+        checksums : bool, optional
+            Also compare SHA-256 checksums (reads every file)
+
+        Returns
+        -------
+        bool
+            Whether the entry is intact
+        """
+        manifest = self.manifest(key)
+        if manifest is None:
+            return False
+        for name, info in manifest['files'].items():
+            file_path = os.path.join(self.entry_dir(key), name)
+            if not os.path.isfile(file_path) or os.path.getsize(file_path) != info['size']:
+                return False
+            if checksums and file_checksum(file_path) != info['sha256']:
+                return False
+        return True
+
+    def get_dir(self, key, checksums=False):
+        """
+        Directory of an intact entry, or None on a miss.
+
+        Corrupt entries are removed. A hit updates the entry's last access time.
+
+        Parameters
+        ----------
+        key : str
+            Entry key
+        checksums : bool, optional
+            Verify SHA-256 checksums in addition to file sizes
+        """
+        if key not in self:
+            return None
+        if not self.verify(key, checksums):
+            print(f"Warning: Removing corrupt cache entry {key}")
+            self.remove(key)
+            return None
+        self.conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        return self.entry_dir(key)
+
+    def get(self, key, mmap_mode='r', checksums=False):
+        """
+        Load the arrays of an entry.
+
+        Parameters
+        ----------
+        key : str
+            Entry key
+        mmap_mode : str or None, optional
+            Passed to np.load; 'r' maps arrays instead of reading them
+        checksums : bool, optional
+            Verify SHA-256 checksums in addition to file sizes
+
+        Returns
+        -------
+        dict or None
+            Name -> array for every .npy file, or None on a miss
+        """
+        entry_dir = self.get_dir(key, checksums)
+        if entry_dir is None:
+            return None
+        return {name[:-4]: np.load(os.path.join(entry_dir, name), mmap_mode=mmap_mode)
+                for name in sorted(os.listdir(entry_dir)) if name.endswith('.npy')}
+
+    def get_or_compute(self, key, compute, stage=None, metadata=None, **get_kwargs):
+        """
+        Return the arrays of an entry, computing and storing them on a miss.
+
+        Parameters
+        ----------
+        key : str
+            Entry key
+        compute : callable
+            compute() returning a dict name -> ndarray
+        stage : str, optional
+            Stage name
+        metadata : dict, optional
+            JSON-serializable metadata
+        **get_kwargs
+            Passed to get
+
+        Returns
+        -------
+        dict
+            Name -> array
+        """
+        cached = self.get(key, **get_kwargs)
+        if cached is not None:
+            return cached
+        arrays = compute()
+        self.put(key, arrays, stage, metadata)
+        # Another process may evict the entry before it is read back
+        cached = self.get(key, **get_kwargs)
+        return arrays if cached is None else cached
+
+    def remove(self, key):
+        """Delete an entry and its index row."""
+        shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+        self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def evict(self, max_bytes=None, keep=()):
+        """
+        Remove least recently used entries until the cache fits max_bytes.
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Size limit. Defaults to the cache's max_bytes.
+        keep : iterable of str, optional
+            Keys never removed, even if the cache then stays above max_bytes
+
+        Returns
+        -------
+        list of str
+            Removed keys
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        excess = self.total_bytes() - max_bytes
+        removed = []
+        if excess <= 0:
+            return removed
+        keep = set(keep)
+        for key, size in self.conn.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+            if excess <= 0:
+                break
+            if key in keep:
+                continue
+            self.remove(key)
+            removed.append(key)
+            excess -= size
+        return removed
+
+    def clear(self, stage=None):
+        """Remove all entries, or all entries of one stage."""
+        query, args = ("SELECT key FROM entries", ()) if stage is None else \
+            ("SELECT key FROM entries WHERE stage = ?", (stage,))
+        for (key,) in self.conn.execute(query, args).fetchall():
+            self.remove(key)
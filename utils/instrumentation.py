@@ -0,0 +1,297 @@
+"""
+Per-stage timing and memory instrumentation of pipeline runs.
+
+Code marks its stages with the stage() context manager or the instrumented
+decorator:
+
+    with stage('combine', subject='P01') as record:
+        ...
+        record['n_pairs'] = 3       # optional extra fields
+
+    @instrumented('scan')
+    def scan_for_matching_ids(...):
+
+While a Collector is enabled, every stage produces one record with its wall
+time, the CPU time and bytes read and written by the thread running it, and
+the process peak RSS (and its growth during the stage). Stages of different
+subjects often run concurrently on a thread pool (e.g., make_pairs), so CPU
+time (time.thread_time) and I/O (/proc/thread-self/io where available; this
+counts read/write calls, not page faults of memory-mapped arrays) are per
+thread and do not include the concurrent stages of other threads. Work a
+stage hands to other threads or processes is not included either; the
+process-wide CPU time is kept as 'process_cpu_seconds'. Peak RSS can only be
+measured per process. Records carry the subject, the enclosing stage (for
+nested stages) and the thread, are appended to a JSON-lines log as they
+complete and are summarized per stage by Collector.summary().
+
+Instrumentation is disabled by default. Then stage() returns a shared no-op
+context and instrumented functions cost one global lookup per call. Setting
+the NVC_INSTRUMENTATION_LOG environment variable enables a collector logging
+to that file at import.
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+from datetime import datetime
+from functools import wraps
+
+ENV_LOG_FILE = "NVC_INSTRUMENTATION_LOG"
+PROC_IO_FILE = "/proc/thread-self/io"
+
+_collector = None
+_local = threading.local()
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process in bytes (ru_maxrss is in kB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def io_bytes():
+    """
+    Bytes read and written by the calling thread so far.
+
+    Returns
+    -------
+    tuple
+        (read, written) from /proc/thread-self/io (rchar/wchar, including
+        cached I/O), or (None, None) where it is unavailable
+    """
+    try:
+        with open(PROC_IO_FILE, 'rb') as f:
+            counters = dict(line.split(b':') for line in f.read().splitlines())
+        return int(counters[b'rchar']), int(counters[b'wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class Collector:
+    """
+    Collect stage records and write them as JSON lines.
+
+    Parameters
+    ----------
+    log_file : str, optional
+        JSON-lines file the records are appended to as they complete.
+        If None, records are only kept in memory.
+    run_id : str, optional
+        Identifier added to every record. Defaults to the start time.
+    """
+
+    def __init__(self, log_file=None, run_id=None):
+        self.log_file = log_file
+        self.run_id = run_id or datetime.now().strftime('%Y%m%dT%H%M%S')
+        self.records = []
+        self._lock = threading.Lock()
+        self._file = None
+        if log_file:
+            log_dir = os.path.dirname(os.path.abspath(log_file))
+            os.makedirs(log_dir, exist_ok=True)
+            self._file = open(log_file, 'a', buffering=1)
+
+    def add(self, record):
+        """Store one record and append it to the log."""
+        record['run_id'] = self.run_id
+        with self._lock:
+            self.records.append(record)
+            if self._file is not None:
+                self._file.write(json.dumps(record, default=str) + '\n')
+
+    def close(self):
+        """Close the log file."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def summary(self, by_subject=False):
+        """
+        Aggregate the records per stage (and subject).
+
+        Parameters
+        ----------
+        by_subject : bool, optional
+            Whether to aggregate per (stage, subject) instead of per stage
+
+        Returns
+        -------
+        dict
+            {stage or (stage, subject): {'calls', 'wall_seconds', 'cpu_seconds',
+             'max_wall_seconds', 'peak_rss_mb', 'rss_growth_mb', 'bytes_read', 'bytes_written'}}
+        """
+        summary = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            key = (record['stage'], record.get('subject')) if by_subject else record['stage']
+            item = summary.setdefault(key, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                            'max_wall_seconds': 0.0, 'peak_rss_mb': 0.0, 'rss_growth_mb': 0.0,
+                                            'bytes_read': 0, 'bytes_written': 0})
+            item['calls'] += 1
+            item['wall_seconds'] += record['wall_seconds']
+            item['cpu_seconds'] += record['cpu_seconds']
+            item['max_wall_seconds'] = max(item['max_wall_seconds'], record['wall_seconds'])
+            item['peak_rss_mb'] = max(item['peak_rss_mb'], record['peak_rss_mb'])
+            item['rss_growth_mb'] = max(item['rss_growth_mb'], record['rss_growth_mb'])
+            item['bytes_read'] += record.get('bytes_read') or 0
+            item['bytes_written'] += record.get('bytes_written') or 0
+        return summary
+
+    def print_summary(self, by_subject=False):
+        """Print the summary as a table sorted by total wall time."""
+        summary = self.summary(by_subject)
+        print(f"\n{'stage':<32}{'calls':>7}{'wall s':>10}{'cpu s':>10}{'max s':>9}"
+              f"{'rss MB':>9}{'read MB':>10}{'write MB':>10}")
+        for key, item in sorted(summary.items(), key=lambda entry: -entry[1]['wall_seconds']):
+            name = '/'.join(str(part) for part in key if part is not None) if by_subject else key
+            print(f"{name:<32}{item['calls']:>7}{item['wall_seconds']:>10.2f}{item['cpu_seconds']:>10.2f}"
+                  f"{item['max_wall_seconds']:>9.2f}{item['peak_rss_mb']:>9.0f}"
+                  f"{item['bytes_read'] / 2 ** 20:>10.1f}{item['bytes_written'] / 2 ** 20:>10.1f}")
+
+
+class _NullStage:
+    """Context returned by stage() while instrumentation is disabled."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """Measurement of one stage, recorded in a collector on exit."""
+
+    __slots__ = ('collector', 'record', '_start')
+
+    def __init__(self, collector, name, subject, fields):
+        self.collector = collector
+        self.record = dict(fields, stage=name, subject=subject)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.record['parent'] = stack[-1] if stack else None
+        stack.append(self.record['stage'])
+        self._start = (time.perf_counter(), time.thread_time(), time.process_time(), peak_rss_bytes(), io_bytes())
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        wall, cpu, process_cpu, rss, (read, written) = self._start
+        read_now, written_now = io_bytes()
+        rss_now = peak_rss_bytes()
+        _local.stack.pop()
+        self.record.update({
+            'wall_seconds': time.perf_counter() - wall,
+            'cpu_seconds': time.thread_time() - cpu,
+            'process_cpu_seconds': time.process_time() - process_cpu,
+            'peak_rss_mb': rss_now / 2 ** 20,
+            'rss_growth_mb': (rss_now - rss) / 2 ** 20,
+            'bytes_read': None if read is None else read_now - read,
+            'bytes_written': None if written is None else written_now - written,
+            'thread': threading.current_thread().name,
+            'pid': os.getpid(),
+            'end': time.time(),
+            'error': None if exc_type is None else f"{exc_type.__name__}: {exc}"
+        })
+        self.collector.add(self.record)
+        return False
+
+
+def stage(name, subject=None, **fields):
+    """
+    Context manager measuring one stage while a collector is enabled.
+
+    Parameters
+    ----------
+    name : str
+        Stage name
+    subject : str, optional
+        Subject the stage works on
+    **fields
+        Extra JSON-serializable fields of the record
+
+    Returns
+    -------
+    context manager
+        Yields the record dict (an unused dict while disabled), to which
+        callers may add fields before the stage ends
+    """
+    if _collector is None:
+        return _NULL_STAGE
+    return _Stage(_collector, name, subject, fields)
+
+
+def instrumented(name=None, subject=None):
+    """
+    Decorator measuring every call of a function as a stage.
+
+    Parameters
+    ----------
+    name : str, optional
+        Stage name. Defaults to the function's qualified name.
+    subject : callable, optional
+        subject(*args, **kwargs) returning the subject of a call
+    """
+    def decorator(function):
+        stage_name = name or function.__qualname__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if _collector is None:
+                return function(*args, **kwargs)
+            with _Stage(_collector, stage_name, subject(*args, **kwargs) if subject else None, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable(log_file=None, run_id=None):
+    """
+    Start collecting stage records, replacing any active collector.
+
+    Parameters
+    ----------
+    log_file : str, optional
+        JSON-lines log file
+    run_id : str, optional
+        Identifier of the run
+
+    Returns
+    -------
+    Collector
+        The active collector
+    """
+    global _collector
+    disable()
+    _collector = Collector(log_file, run_id)
+    return _collector
+
+
+def disable():
+    """Stop collecting and close the log. Returns the collector that was active, if any."""
+    global _collector
+    collector, _collector = _collector, None
+    if collector is not None:
+        collector.close()
+    return collector
+
+
+def get_collector():
+    """Return the active collector, or None while disabled."""
+    return _collector
+
+
+if os.environ.get(ENV_LOG_FILE):
+    enable(os.environ[ENV_LOG_FILE])